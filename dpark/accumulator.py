@@ -1,5 +1,6 @@
 from operator import add
 import copy
+import threading
 
 from dpark.serialize import load_func, dump_func
 
@@ -31,8 +32,16 @@ class Accumulator:
         self.register(self, True)
 
     def add(self, v):
-        self.value = self.param.addInPlace(self.value, v)
-        self.register(self, False)
+        updates = getattr(self.local, 'updates', None)
+        if updates is None:
+            self.value = self.param.addInPlace(self.value, v)
+        else:
+            # in a task, keep the updates of current thread
+            if self.id in updates:
+                value = updates[self.id]
+            else:
+                value = copy.copy(self.param.zero)
+            updates[self.id] = self.param.addInPlace(value, v)
 
     def reset(self):
         v = self.value
@@ -45,7 +54,6 @@ class Accumulator:
     def __setstate__(self, s):
         self.id, self.param = s
         self.value = copy.copy(self.param.zero)
-        self.register(self, False)
 
     nextId = 0
     @classmethod
@@ -54,30 +62,30 @@ class Accumulator:
         return cls.nextId
 
     originals = {}
-    localAccums = {}
+    local = threading.local()
+    lock = threading.Lock()
     @classmethod
     def register(cls, acc, original):
         if original:
             cls.originals[acc.id] = acc
-        else:
-            cls.localAccums[acc.id] = acc
 
     @classmethod
     def clear(cls):
-        for acc in cls.localAccums.values():
-            acc.reset()
-        cls.localAccums.clear()
+        "start to collect the updates of a task in current thread"
+        cls.local.updates = {}
 
     @classmethod
     def values(cls):
-        v = dict((id, accum.value) for id,accum in cls.localAccums.items())
-        cls.clear()
+        "the updates since clear(), stop collecting"
+        v = getattr(cls.local, 'updates', None) or {}
+        cls.local.updates = None
         return v
 
     @classmethod
     def merge(cls, values):
-        for id, value in values.items():
-            cls.originals[id].add(value)
+        with cls.lock:
+            for id, value in values.items():
+                cls.originals[id].add(value)
 
 ReadBytes = Accumulator()
 WriteBytes = Accumulator()
@@ -87,3 +95,26 @@ LocalReadBytes = Accumulator()
 
 CacheHits = Accumulator()
 CacheMisses = Accumulator()
+
+def mergeProfiles(x, y):
+    for stage, stats in y.iteritems():
+        merged = x.setdefault(stage, {})
+        for k, v in stats.iteritems():
+            if k in merged:
+                merged[k] = [a + b for a, b in zip(merged[k], v)]
+            else:
+                merged[k] = list(v)
+    return x
+
+# stage id -> {function: [cc, nc, tt, ct]}, see dpark/profiler.py
+Profiles = Accumulator({}, AccumulatorParam({}, mergeProfiles))
+# [(phase, start, end)] of a task, see dpark/trace.py
+TaskSpans = Accumulator([], listAcc)
+
+def addMetrics(x, y):
+    for k, v in y.iteritems():
+        x[k] = x.get(k, 0) + v
+    return x
+
+# name -> value, measured for every task, see dpark/metrics.py
+TaskMetrics = Accumulator({}, AccumulatorParam({}, addMetrics))
@@ -6,16 +6,29 @@ import cPickle
 import logging
 import gc
 import random
+import fcntl
+import mmap
+import struct
+from cStringIO import StringIO
 
 import zmq
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from dpark.util import compress, decompress, getproctitle, setproctitle, spawn
 from dpark.cache import Cache
 from dpark.serialize import marshalable
+from dpark.tracker import GetValueMessage, AddItemMessage
 from dpark.env import env
 
 logger = logging.getLogger("broadcast")
 
+# uuids of cleared broadcasts in tracker, their stored values are
+# removed by HostStore of workers
+CLEARED_KEY = 'broadcast:cleared'
+
 class SourceInfo:
     Stop = -2
 
@@ -37,15 +50,82 @@ class SourceInfo:
                 return True
         return False
 
+def is_array(obj):
+    "numpy arrays of plain values, sent as their buffers"
+    return (numpy is not None and isinstance(obj, numpy.ndarray)
+            and not obj.dtype.hasobject)
+
 class Block:
     def __init__(self, id, data):
         self.id = id
         self.data = data
 
+class HostStore(object):
+    """ serialized values of broadcast received on this host, in files of
+    the work dir, so only one worker of the host receives a value, and
+    the others read it from the page cache shared by them. The values of
+    cleared broadcasts are removed before storing a new one. """
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, uuid, receive):
+        "the stored value, mapped in memory shared by the workers"
+        path, buf = self.store(uuid, receive)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                # copy on write, arrays on it are writable as before
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return buf
+
+    def fetch(self, uuid, receive):
+        "path of the stored value"
+        path, buf = self.store(uuid, receive)
+        if not os.path.exists(path):
+            raise IOError("store broadcast %s failed" % uuid)
+        return path
+
+    def store(self, uuid, receive):
+        "returns path, and the value if received by this worker"
+        path = os.path.join(self.root, uuid)
+        if not os.path.exists(path):
+            if not os.path.exists(self.root):
+                try: os.makedirs(self.root)
+                except OSError: pass
+            with open(path + '.lock', 'w') as lock:
+                # released when closed, also when the worker died
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(path):
+                    self.clean()
+                    buf = receive()
+                    tpath = path + '.%d' % os.getpid()
+                    try:
+                        with open(tpath, 'wb') as f:
+                            f.write(buf)
+                        os.rename(tpath, path)
+                    except (IOError, OSError), e:
+                        logger.warning("store broadcast %s failed: %s", uuid, e)
+                    return path, buf
+        return path, None
+
+    def clean(self):
+        "remove the values of cleared broadcasts"
+        client = getattr(env, 'trackerClient', None)
+        if client is None:
+            return
+        cleared = set(client.call(GetValueMessage(CLEARED_KEY)))
+        for name in os.listdir(self.root):
+            if name.split('.')[0] in cleared:
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+
+
 class Broadcast:
     initialized = False
     is_master = False
     cache = Cache() 
+    store = None # HostStore of workers
     broadcastFactory = None
     BlockSize = 1024 * 1024
 
@@ -97,7 +177,11 @@ class Broadcast:
         oldtitle = getproctitle()
         setproctitle('dpark worker: broadcasting ' + uuid)
 
-        value = self.recv()
+        if self.store is not None:
+            buf = self.store.get(uuid, self.recv)
+        else:
+            buf = self.recv()
+        value = self.loadObject(buf)
         if value is None:
             raise Exception("recv broadcast failed")
         self.value = value
@@ -110,9 +194,12 @@ class Broadcast:
         raise NotImplementedError
 
     def recv(self):
+        "receive the serialized value"
         raise NotImplementedError
 
     def blockifyObject(self, obj):
+        if is_array(obj):
+            return self.blockifyArray(obj)
         try:
             if marshalable(obj):
                 buf = '0'+marshal.dumps(obj)
@@ -128,12 +215,42 @@ class Broadcast:
                     for i in range(blockNum)]
         return val, len(buf)
 
+    def blockifyArray(self, array):
+        """ the header in the first block, then blocks of the buffer of
+        the array, compressed without copying it """
+        array = numpy.ascontiguousarray(array)
+        header = cPickle.dumps((array.dtype, array.shape), -1)
+        head = '2' + struct.pack('I', len(header)) + header
+        N = self.BlockSize
+        val = [Block(0, compress(head))]
+        for i in range(0, array.nbytes, N):
+            val.append(Block(len(val), compress(buffer(array, i, N))))
+        return val, len(head) + array.nbytes
+
     def unBlockifyObject(self, blocks):
-        s = ''.join(decompress(b.data) for b in blocks)
+        return self.loadObject(self.joinBlocks(blocks))
+
+    def joinBlocks(self, blocks):
+        return ''.join(decompress(b.data) for b in blocks)
+
+    def loadObject(self, s):
+        # do not copy s, it may be big, and mapped from the store
         if s[0] == '0':
-            return marshal.loads(s[1:])
+            return marshal.loads(buffer(s, 1))
+        elif s[0] == '2':
+            n, = struct.unpack('I', s[1:5])
+            dtype, shape = cPickle.loads(s[5:5+n])
+            if len(s) == 5 + n:
+                return numpy.empty(shape, dtype)
+            if isinstance(s, str):
+                # read-only, copied to be writable as unpickled arrays
+                return numpy.frombuffer(bytearray(buffer(s, 5+n)), dtype).reshape(shape)
+            # on the mapped buffer of s, not copied
+            return numpy.frombuffer(s, dtype, offset=5+n).reshape(shape)
         else:
-            return cPickle.loads(s[1:])
+            f = StringIO(s)
+            f.seek(1)
+            return cPickle.load(f)
    
     @classmethod
     def initialize(cls, is_master):
@@ -143,6 +260,8 @@ class Broadcast:
         cls.initialized = True
         cls.is_master = is_master
         cls.host = socket.gethostname()
+        if not is_master and env.get('WORKDIR'):
+            cls.store = HostStore(os.path.join(env.get('WORKDIR')[0], 'broadcast'))
 
         logger.debug("Broadcast initialized")
 
@@ -168,12 +287,16 @@ class TreeBroadcast(Broadcast):
 
     def clear(self):
         if not self.is_local:
-            self.stopServer(self.guide_addr)
-            self.guide_thread.join()
-            self.server_thread.join()
+            self.stopGuide()
+            env.trackerClient.call(AddItemMessage(CLEARED_KEY, self.uuid))
         else:
             Broadcast.clear(self)
 
+    def stopGuide(self):
+        self.stopServer(self.guide_addr)
+        self.guide_thread.join()
+        self.server_thread.join()
+
     def send(self):
         logger.debug("start send %s", self.uuid)
         self.blocks, self.bytes = self.blockifyObject(self.value)
@@ -303,10 +426,10 @@ class TreeBroadcast(Broadcast):
 
         start = time.time()
         self.receive(self.uuid)
-        value = self.unBlockifyObject(self.blocks)
+        buf = self.joinBlocks(self.blocks)
         used = time.time() - start
         logger.debug("Reading Broadcasted variable %s took %ss", self.uuid, used)
-        return value
+        return buf
 
     def receive(self, uuid):
         guide_addr, total_blocks = self.get_guide_addr(uuid)
@@ -395,14 +518,18 @@ class TreeBroadcast(Broadcast):
 
     @classmethod
     def shutdown(cls):
+        # the tracker has stopped
         for uuid, obj in cls.guides.items():
-            obj.clear()
+            obj.stopGuide()
         if cls.tracker_thread:
             cls.get_guide_addr('')
             cls.tracker_thread.join()
         Broadcast.shutdown()
 
 class P2PBroadcast(TreeBroadcast):
+    MaxPeers = 8 # downloading from at the same time
+    Window = 4 # requests in flight to a peer
+
     def guide(self, sock):
         sources = {self.server_addr: ([1] * len(self.blocks))}
         bad_servers = []
@@ -449,7 +576,6 @@ class P2PBroadcast(TreeBroadcast):
         self.blocks = [None] * total_blocks
         self.bitmap = ([0] * total_blocks)
         start = time.time()
-        hostname = socket.gethostname()
         random.seed(os.getpid() + int(start*1000)%1000)
 
         while not self.stopped:
@@ -458,8 +584,8 @@ class P2PBroadcast(TreeBroadcast):
             if all(self.bitmap):
                 break
             logger.debug("received SourceInfo from master: %s", source_infos.keys()) 
-            self.receive_from_local(dict((k,v) for k,v in source_infos.iteritems() if hostname in k))
-            self.receive_one(source_infos)
+            if not self.receive_blocks(source_infos):
+                time.sleep(0.1) # wait for the peers to have more blocks
  
         if self.stopped:
             os._exit(0)
@@ -467,100 +593,153 @@ class P2PBroadcast(TreeBroadcast):
         logger.debug("%s got broadcast in %.1fs", self.server_addr, time.time() - start)
         guide_sock.close()
 
-    def receive_from_local(self, sources):
+    def choose_peers(self, sources):
+        "sources on this host first, then random ones on other hosts"
+        def parse_host(addr):
+            return addr.split(':')[1][2:]
+        sources = [(addr, bitmap) for addr, bitmap in sources.items()
+                if addr != self.server_addr]
+        random.shuffle(sources)
+        local = [s for s in sources if parse_host(s[0]) == self.host]
+        peers, hosts = [], set()
+        for addr, bitmap in sources:
+            host = parse_host(addr)
+            if host != self.host and host not in hosts:
+                hosts.add(host)
+                peers.append((addr, bitmap))
+        return (local + peers)[:self.MaxPeers]
+
+    def receive_blocks(self, sources):
+        """ download blocks from many peers at the same time, the rarest
+        blocks first, with a window of requests in flight to every peer,
+        returns the number of blocks received """
+        total = len(self.blocks)
+        counts = [0] * total
+        for bitmap in sources.itervalues():
+            for i, b in enumerate(bitmap):
+                counts[i] += b
+        order = sorted(range(total), key=lambda i: (counts[i], random.random()))
+        requested = set()
+        received = 0
+
+        def request(sock):
+            bitmap = bitmaps[sock]
+            for i in order:
+                if bitmap[i] and self.blocks[i] is None and i not in requested:
+                    requested.add(i)
+                    inflight[sock].append(i)
+                    # REP server works with DEALER, replies in order
+                    sock.send_multipart(['', cPickle.dumps(i, -1)])
+                    return True
+            return False
+
         poller = zmq.Poller()
-        socks = []
-        addrs = {}
-        for addr in sources:
-            i = self.peek(sources[addr])
-            if i is None: continue
-            self.bitmap[i] = 1
-            sock = env.ctx.socket(zmq.REQ)
+        bitmaps, inflight, addrs = {}, {}, {}
+        for addr, bitmap in self.choose_peers(sources):
+            sock = env.ctx.socket(zmq.DEALER)
             sock.setsockopt(zmq.LINGER, 0)
             sock.connect(addr)
-            sock.send_pyobj(i)
-            poller.register(sock, zmq.POLLIN)
-            socks.append(sock)
-            addrs[sock] = addr
+            bitmaps[sock], inflight[sock], addrs[sock] = bitmap, [], addr
+            for j in range(self.Window):
+                if not request(sock):
+                    break
+            if inflight[sock]:
+                poller.register(sock, zmq.POLLIN)
+            else:
+                sock.close()
 
-        while socks:
-            t = time.time()
+        while inflight and any(inflight.values()) and not self.stopped:
             avail = poller.poll(5 * 1000) # unmarshal object will block server thread
             if not avail:
                 break
             for sock, _ in avail:
-                block = sock.recv_pyobj()
-                if block is not None and isinstance(block, Block):
+                _, data = sock.recv_multipart()
+                i = inflight[sock].pop(0)
+                block = cPickle.loads(data)
+                if isinstance(block, Block):
                     self.blocks[block.id] = block
+                    received += 1
                     logger.debug("Received block: %s from %s", block.id, addrs[sock])
-                i = self.peek(sources[addrs[sock]]) 
-                if i is not None:
-                    self.bitmap[i] = 1
-                    sock.send_pyobj(i)
                 else:
+                    requested.discard(i) # the peer does not have it
+                    bitmaps[sock][i] = 0
+                request(sock)
+                if not inflight[sock]:
                     poller.unregister(sock)
-                    socks.remove(sock)
                     sock.close()
+                    del inflight[sock]
 
-        # rebuild bitmap 
-        self.bitmap = ([bool(b) for b in self.blocks])
-        timeout_servers = [addrs.get(sock) for sock in socks]
+        timeout_servers = [addrs[sock] for sock in inflight if inflight[sock]]
+        for sock in inflight:
+            sock.close()
         if timeout_servers:
             logger.debug("recv from %s timeout", timeout_servers)
+        self.bitmap = [bool(b) for b in self.blocks]
+        return received
 
+TheBroadcast = P2PBroadcast
 
-    def receive_one(self, sources):
-        host = socket.gethostname()
-        sources = sources.items() #sorted(sources.items(), key=lambda (k,b):len(b))
-        random.shuffle(sources)
 
-        poller = zmq.Poller()
-        socks = []
-        addrs = {}
-        hosts = set()
-        for addr, bitmap in sources:
-            i = self.peek(bitmap)
-            if i is None: continue
-            self.bitmap[i] = 1
+class FileBlocks(object):
+    "blocks of a file, read when they are sent"
+    def __init__(self, path, size, blockSize):
+        self.path = path
+        self.size = size
+        self.blockSize = blockSize
 
-            host = addr.split(':')[1][5:]
-            if host in hosts: continue
-            hosts.add(host)
+    def __len__(self):
+        return self.size / self.blockSize + 1
 
-            sock = env.ctx.socket(zmq.REQ)
-            sock.setsockopt(zmq.LINGER, 0)
-            sock.connect(addr)
-            addrs[sock] = addr
-            sock.send_pyobj(i)
-            poller.register(sock, zmq.POLLIN)
-            socks.append(sock)
+    def __getitem__(self, i):
+        with open(self.path, 'rb') as f:
+            f.seek(i * self.blockSize)
+            return Block(i, compress(f.read(self.blockSize)))
 
-        while socks:
-            t = time.time()
-            avail = poller.poll(5 * 1000) # unmarshal object will block server thread
-            if not avail:
-                break
-            for sock, _ in avail:
-                block = sock.recv_pyobj()
-                if block is not None and isinstance(block, Block):
-                    self.blocks[block.id] = block
-                    logger.debug("Received block: %s from %s", block.id, addrs.get(sock))
-                poller.unregister(sock)
-                socks.remove(sock)
-                sock.close()
 
-        # rebuild bitmap 
-        self.bitmap = [bool(b) for b in self.blocks]
-        timeout_servers = [addrs.get(sock) for sock in socks]
-        if timeout_servers:
-            logger.debug("recv from %s timeout", timeout_servers)
+class FileBroadcast(TheBroadcast):
+    """ broadcast of a temp file, which is never loaded in memory of
+    driver. The value is the path of it on this host, stored by HostStore
+    in workers. The file is removed when cleared. """
+    def __init__(self, path):
+        self.initializeSlaveVariables()
+        self.uuid = str(uuid.uuid4())
+        self.origin = path
+        self.value = path
+        self.is_local = False
+        self.stopped = False
+        self.send()
+
+    def send(self):
+        self.bytes = os.path.getsize(self.origin)
+        self.blocks = FileBlocks(self.origin, self.bytes, self.BlockSize)
+        logger.debug("broadcast %s of %s: %d bytes", self.uuid, self.origin, self.bytes)
+        self.startServer()
+        self.startGuide()
 
-    def peek(self, bitmap):
-        avails = [i for i in range(len(bitmap)) if not self.bitmap[i] and bitmap[i]]
-        if avails:
-            return random.choice(avails)
+    def clear(self):
+        TheBroadcast.clear(self)
+        if os.path.exists(self.origin):
+            os.remove(self.origin)
 
-TheBroadcast = P2PBroadcast
+    def __getstate__(self):
+        return self.uuid, self.bytes, self.origin
+
+    def __setstate__(self, v):
+        self.stopped = False
+        self.uuid, self.bytes, self.origin = v
+
+    def __getattr__(self, name):
+        if name != 'value':
+            raise AttributeError(name)
+        if self.stopped:
+            raise SystemExit("broadcast has been cleared")
+        if os.path.exists(self.origin): # on the host of driver
+            self.value = self.origin
+        elif self.store is not None:
+            self.value = self.store.fetch(self.uuid, self.recv)
+        else:
+            raise AttributeError(name)
+        return self.value
 
 def _test_init():
     TheBroadcast.initialize(False)
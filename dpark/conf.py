@@ -19,6 +19,24 @@ MOOSEFS_MOUNT_POINTS = {
 # consistant dir cache in client, need patched mfsmaster 
 MOOSEFS_DIR_CACHE = False
 
+# delay scheduling: seconds to wait for a host-local (or rack-local)
+# offer before launching a task on other hosts (or racks)
+LOCALITY_WAIT = 3
+LOCALITY_WAIT_RACK = 3
+# attribute of mesos slaves telling which rack they are in
+MESOS_RACK_ATTRIBUTE = 'rack'
+
+# pools sharing the resources between concurrent jobs, for example:
+# 'etl': dict(weight=1, minShare=0, priority=0, mode='fifo'),
+# 'adhoc': dict(weight=2, minShare=10, priority=1, mode='fair'),
+# jobs go into pool 'default' unless --pool or DparkContext.setPool()
+SCHEDULER_POOLS = {
+}
+
+# peak memory of stages observed in previous runs, used to size
+# the memory requests when the same script runs again
+MEMORY_HISTORY_FILE = '~/.dpark/memory_history'
+
 def load_conf(path):
     if not os.path.exists(path):
         logger.error("conf %s do not exists", path)
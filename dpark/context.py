@@ -1,13 +1,15 @@
 import os, sys
+import re
 import atexit
 import optparse
 import signal
 import logging
 import gc
+import threading
 
 from dpark.rdd import *
 from dpark.accumulator import Accumulator
-from dpark.schedule import LocalScheduler, MultiProcessScheduler, MesosScheduler
+from dpark.schedule import LocalScheduler, MultiProcessScheduler, ForkScheduler, MesosScheduler
 from dpark.env import env
 from dpark.moosefs import walk
 import dpark.conf as conf
@@ -36,6 +38,9 @@ def setup_conf(options):
     import moosefs
     moosefs.MFS_PREFIX = conf.MOOSEFS_MOUNT_POINTS
     moosefs.master.ENABLE_DCACHE = conf.MOOSEFS_DIR_CACHE
+    import job
+    job.LOCALITY_WAIT = float(conf.LOCALITY_WAIT)
+    job.LOCALITY_WAIT_RACK = float(conf.LOCALITY_WAIT_RACK)
 
 @singleton
 class DparkContext(object):
@@ -44,7 +49,9 @@ class DparkContext(object):
         self.master = master
         self.initialized = False
         self.started = False
+        self.statusServer = None
         self.defaultParallelism = 2
+        self.startLock = threading.Lock()
 
     def init(self):
         if self.initialized:
@@ -58,9 +65,15 @@ class DparkContext(object):
         if master == 'local':
             self.scheduler = LocalScheduler()
             self.isLocal = True
+        elif re.match(r'local\[\d+\]$', master):
+            self.scheduler = LocalScheduler(int(master[6:-1]))
+            self.isLocal = True
         elif master == 'process':
             self.scheduler = MultiProcessScheduler(options.parallel)
             self.isLocal = False
+        elif master == 'fork':
+            self.scheduler = ForkScheduler(options.parallel)
+            self.isLocal = False
         else:
             if master == 'mesos':
                 master = conf.MESOS_MASTER
@@ -79,6 +92,18 @@ class DparkContext(object):
             self.isLocal = False
 
         self.master = master
+        if not self.isLocal:
+            # tasks run one by one in local mode, reduce tasks can not
+            # wait for the map tasks
+            self.scheduler.slowStart = options.slow_start
+
+        if options.profile:
+            # tasks send their profiles back, see dpark/profiler.py
+            env.register('PROFILE', True)
+        if options.trace:
+            # tasks send their phases back, see dpark/trace.py
+            env.register('TRACE', True)
+            self.scheduler.traceDir = options.trace
 
         if options.parallel:
             self.defaultParallelism = options.parallel
@@ -217,11 +242,19 @@ class DparkContext(object):
         if self.started:
             return
 
+        with self.startLock: # jobs may be submitted from many threads
+            if not self.started:
+                self._start()
+
+    def _start(self):
         self.init()
 
         env.start(True, isLocal=self.isLocal)
         self.scheduler.start()
-        self.started = True
+        if self.options.web_port is not None:
+            from dpark.web import StatusServer
+            self.statusServer = StatusServer(self.scheduler, self.options.web_port)
+            self.statusServer.start()
         atexit.register(self.stop)
 
         def handler(signm, frame):
@@ -240,6 +273,13 @@ class DparkContext(object):
         except ImportError:
             pass
 
+        self.started = True
+
+    def setPool(self, name):
+        "put the jobs submitted from current thread into pool `name`"
+        self.init()
+        self.scheduler.setPool(name)
+
     def runJob(self, rdd, func, partitions=None, allowLocal=False):
         self.start()
 
@@ -266,6 +306,9 @@ class DparkContext(object):
 
         env.stop()
         self.scheduler.stop()
+        if self.statusServer:
+            self.statusServer.stop()
+            self.statusServer = None
         self.started = False
 
     def __getstate__(self):
@@ -280,7 +323,7 @@ def add_default_options():
     group = optparse.OptionGroup(parser, "Dpark Options")
 
     group.add_option("-m", "--master", type="string", default="local",
-            help="master of Mesos: local, process, host[:port], or mesos://")
+            help="master of Mesos: local, local[N], process, fork, host[:port], or mesos://")
 #    group.add_option("-n", "--name", type="string", default="dpark",
 #            help="job name")
     group.add_option("-p", "--parallel", type="int", default=0,
@@ -288,12 +331,16 @@ def add_default_options():
 
     group.add_option("-c", "--cpus", type="float", default=1.0,
             help="cpus used per task")
-    group.add_option("-M", "--mem", type="float", default=1000.0,
-            help="memory used per task")
+    group.add_option("-M", "--mem", type="float",
+            help="memory used per task (1000)")
     group.add_option("-g", "--group", type="string", default="",
             help="which group of machines")
     group.add_option("--err", type="float", default=0.0,
             help="acceptable ignored error record ratio (0.01%)")
+    group.add_option("--pool", type="string", default="default",
+            help="scheduler pool for the jobs, see SCHEDULER_POOLS in conf")
+    group.add_option("--slow-start", type="float", default=1.0,
+            help="fraction of map tasks finished before starting reduce tasks (1.0)")
     group.add_option("--snapshot_dir", type="string", default="",
             help="shared dir to keep snapshot of RDDs")
 
@@ -302,7 +349,11 @@ def add_default_options():
     group.add_option("--self", action="store_true",
             help="user self as exectuor")
     group.add_option("--profile", action="store_true",
-            help="do profiling")
+            help="profile the tasks, report top functions of stages")
+    group.add_option("--trace", type="string", default="",
+            help="dir to save the timeline of jobs in Chrome trace format")
+    group.add_option("--web-port", type="int",
+            help="serve the status of jobs by http on it, 0 for a random port")
     group.add_option("--keep-order", action="store_true",
             help="deprecated, always keep order")
 
@@ -315,6 +366,12 @@ add_default_options()
 
 def parse_options():
     options, args = parser.parse_args()
+    if not 0 < options.slow_start <= 1:
+        parser.error("--slow-start should be in (0, 1]")
+    # the memory learned from history is not less than the given one
+    options.explicit_mem = options.mem is not None
+    if options.mem is None:
+        options.mem = 1000.0
     options.logLevel = (options.quiet and logging.ERROR
                   or options.verbose and logging.DEBUG or logging.INFO)
 
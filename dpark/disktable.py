@@ -0,0 +1,188 @@
+""" read-only dict on disk, for lookups into a table too big to be
+broadcast as a dict
+
+Items are hashed into chunks, which are built one at a time into buckets
+with an index of their offsets. All chunks are in one file, broadcast
+once and fetched by a worker at the first lookup, then memory-mapped, so
+a lookup only decodes the small bucket of the key. The file is removed
+when the broadcast is cleared, at last when the context stops.
+"""
+import os
+import mmap
+import uuid
+import struct
+import marshal
+import cPickle
+import logging
+
+from dpark.util import portable_hash
+from dpark.env import env
+
+logger = logging.getLogger("disktable")
+
+# collected tables bigger than it are kept on disk
+DISK_TABLE_THRESHOLD = 256 << 20
+CHUNK_SIZE = 64 << 20
+MAX_CHUNKS = 512
+BUCKET_ITEMS = 16
+
+# offsets in the file, and the counts of chunks and buckets
+OFFSET = struct.Struct('<Q')
+RANGE = struct.Struct('<QQ')
+
+def estimate_size(items, samples=100):
+    "bytes of pickled items, estimated by some of them"
+    if not items:
+        return 0
+    sample = items[:samples]
+    return len(cPickle.dumps(sample, -1)) * len(items) / len(sample)
+
+def collect_table(rdd, limit=None):
+    """ collect the rdd as a dict like collectAsMap(), or a DiskTable if
+    it is bigger than limit """
+    limit = limit or DISK_TABLE_THRESHOLD
+    d, size = {}, 0
+    results = rdd.ctx.runJob(rdd, lambda x: list(x))
+    for i, items in enumerate(results):
+        d.update(items)
+        size += estimate_size(items)
+        if size > limit:
+            total = size * len(rdd.splits) / (i + 1)
+            nchunks = min(max(total / CHUNK_SIZE, 1), MAX_CHUNKS)
+            logger.info("%s is about %dMB, keep it on disk in %d chunks",
+                    rdd, total >> 20, nchunks)
+            builder = DiskTableBuilder(nchunks)
+            builder.add(d.iteritems())
+            d = None
+            for items in results:
+                builder.add(items)
+            return builder.build()
+    return d
+
+
+def dumps_bucket(items):
+    try:
+        return '0' + marshal.dumps(items)
+    except ValueError:
+        return '1' + cPickle.dumps(items, -1)
+
+def loads_bucket(s):
+    if s[0] == '0':
+        return marshal.loads(s[1:])
+    return cPickle.loads(s[1:])
+
+
+class DiskTableBuilder(object):
+    def __init__(self, nchunks):
+        self.nchunks = nchunks
+        self.path = os.path.join(env.workdir[0], 'table-%s' % uuid.uuid4())
+        self.spools = [open('%s-%d.tmp' % (self.path, i), 'wb+')
+                for i in range(nchunks)]
+
+    def add(self, items):
+        n = self.nchunks
+        groups = [[] for i in range(n)]
+        for k, v in items:
+            groups[portable_hash(k) % n].append((k, v))
+        for f, group in zip(self.spools, groups):
+            if group:
+                cPickle.dump(group, f, -1)
+
+    def build(self):
+        from dpark.broadcast import FileBroadcast
+        n, size = self.nchunks, 0
+        # nchunks, offsets of n chunks and the end, chunks
+        starts = []
+        with open(self.path, 'wb') as f:
+            f.seek(OFFSET.size * (n + 2))
+            for spool in self.spools:
+                spool.seek(0)
+                d = {}
+                while True:
+                    try:
+                        d.update(cPickle.load(spool))
+                    except EOFError:
+                        break
+                spool.close()
+                os.remove(spool.name)
+                starts.append(f.tell())
+                if d:
+                    self.write_chunk(f, d)
+                    size += len(d)
+            starts.append(f.tell())
+            f.seek(0)
+            write_offsets(f, [n] + starts)
+        return DiskTable(FileBroadcast(self.path), n, size)
+
+    def write_chunk(self, f, d):
+        # k, offsets of k buckets and the end, buckets
+        n = self.nchunks
+        k = max(len(d) / BUCKET_ITEMS, 1)
+        buckets = [[] for i in range(k)]
+        for key, v in d.iteritems():
+            buckets[portable_hash(key) // n % k].append((key, v))
+        datas = [dumps_bucket(b) for b in buckets]
+        offsets = [f.tell() + OFFSET.size * (k + 2)]
+        for data in datas:
+            offsets.append(offsets[-1] + len(data))
+        write_offsets(f, [k] + offsets)
+        for data in datas:
+            f.write(data)
+
+
+def write_offsets(f, offsets, batch=4096):
+    for i in xrange(0, len(offsets), batch):
+        part = offsets[i:i + batch]
+        f.write(struct.pack('<%dQ' % len(part), *part))
+
+
+class DiskTable(object):
+    "read-only dict in the broadcast file"
+    def __init__(self, broadcast, nchunks, size):
+        self.broadcast = broadcast
+        self.nchunks = nchunks
+        self.size = size
+        self.map = None
+        self.last = None, None # (chunk, bucket), dict of the bucket
+
+    def __getstate__(self):
+        return self.broadcast, self.nchunks, self.size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return self.size
+
+    def open(self):
+        with open(self.broadcast.value, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def clear(self):
+        "stop serving the file and remove it, in driver"
+        self.broadcast.clear()
+
+    def bucket(self, key):
+        h = portable_hash(key)
+        n = self.nchunks
+        c = h % n
+        m = self.map or self.open()
+        start, end = RANGE.unpack_from(m, OFFSET.size * (c + 1))
+        if start == end:
+            return {}
+        k, = OFFSET.unpack_from(m, start)
+        b = h // n % k
+        if self.last[0] != (c, b):
+            lo, hi = RANGE.unpack_from(m, start + OFFSET.size * (b + 1))
+            self.last = (c, b), dict(loads_bucket(m[lo:hi]))
+        return self.last[1]
+
+    def get(self, key, default=None):
+        return self.bucket(key).get(key, default)
+
+    def __contains__(self, key):
+        return key in self.bucket(key)
+
+    def __getitem__(self, key):
+        return self.bucket(key)[key]
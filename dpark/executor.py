@@ -20,8 +20,6 @@ import marshal
 import cPickle
 import multiprocessing
 import threading
-import SocketServer
-import SimpleHTTPServer
 import shutil
 import socket
 import urllib2
@@ -35,18 +33,31 @@ import pymesos.mesos_pb2 as mesos_pb2
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from dpark.util import compress, decompress, getproctitle, setproctitle, spawn
+from dpark.util import set_memory_pressure_flag, clear_memory_pressure
 from dpark.serialize import marshalable
-from dpark.accumulator import Accumulator
+from dpark.accumulator import Accumulator, TaskMetrics
 from dpark.schedule import Success, FetchFailed, OtherFailure
 from dpark.env import env
-from dpark.shuffle import LocalFileShuffle
+from dpark.result import send_result
+from dpark.fileserver import FileServer
+from dpark import profiler
+from dpark import trace
 
 logger = logging.getLogger("executor@%s" % socket.gethostname())
 
 TASK_RESULT_LIMIT = 1024 * 256
 DEFAULT_WEB_PORT = 5055
 MAX_WORKER_IDLE_TIME = 60
+# the last idle workers are kept longer, the modules imported, broadcast
+# values and lineage decoded by them are reused by the following tasks,
+# they are stopped first when the running tasks are short of memory
+MAX_WARM_WORKERS = multiprocessing.cpu_count()
+MAX_WARM_WORKER_IDLE_TIME = 60 * 30
+# full collection after a task only when rss grew by this since the last
+GC_FULL_GROWTH = 1.25
 MAX_EXECUTOR_IDLE_TIME = 60 * 60 * 24
+# seconds given to a task over the hard limit to spill before killed
+MEMORY_PRESSURE_GRACE = 10
 Script = ''
 
 def reply_status(driver, task_id, state, data=None):
@@ -57,16 +68,31 @@ def reply_status(driver, task_id, state, data=None):
         status.data = data
     driver.sendStatusUpdate(status)
 
-def run_task(task_data):
+def run_task(task_id, task_data):
     try:
         gc.disable()
+        reset_peak_memory()
+        clear_memory_pressure()
+        start = time.time()
         task, ntry = cPickle.loads(decompress(task_data))
+        deserializeTime = time.time() - start
         setproctitle('dpark worker %s: run task %s' % (Script, task))
 
         Accumulator.clear()
-        result = task.run(ntry)
-        accUpdate = Accumulator.values()
+        start = time.time()
+        if profiler.is_profiling():
+            result = profiler.run_task(task, ntry)
+        else:
+            result = task.run(ntry)
+        trace.record('run', start)
+        runTime = time.time() - start
+
+        # gc is disabled while running the task
+        start = time.time()
+        collect_garbage()
+        gcTime = time.time() - start
 
+        start = time.time()
         if marshalable(result):
             try:
                 flag, data = 0, marshal.dumps(result)
@@ -76,40 +102,45 @@ def run_task(task_data):
         else:
             flag, data = 1, cPickle.dumps(result, -1)
         data = compress(data)
+        TaskMetrics.add({'deserializeTime': deserializeTime, 'runTime': runTime,
+            'gcTime': gcTime, 'serializeTime': time.time() - start,
+            'resultBytes': len(data), 'peakMemory': get_peak_memory()})
+        accUpdate = Accumulator.values()
 
         if len(data) > TASK_RESULT_LIMIT:
-            path = LocalFileShuffle.getOutputFile(0, ntry, task.id, len(data))
-            f = open(path, 'w')
-            f.write(data)
-            f.close()
-            data = '/'.join([LocalFileShuffle.getServerUri()] + path.split('/')[-3:])
+            # stream it to driver, status update only carries a mark
+            send_result(env.get('ResultAddr'), task_id, data)
+            data = ''
             flag += 2
 
-        return mesos_pb2.TASK_FINISHED, cPickle.dumps((Success(), (flag, data), accUpdate), -1)
+        return mesos_pb2.TASK_FINISHED, cPickle.dumps((Success(), (flag, data), accUpdate, get_peak_memory()), -1)
     except FetchFailed, e:
-        return mesos_pb2.TASK_FAILED, cPickle.dumps((e, None, None), -1)
+        return mesos_pb2.TASK_FAILED, cPickle.dumps((e, None, None, get_peak_memory()), -1)
     except :
         import traceback
         msg = traceback.format_exc()
-        return mesos_pb2.TASK_FAILED, cPickle.dumps((OtherFailure(msg), None, None), -1)
+        return mesos_pb2.TASK_FAILED, cPickle.dumps((OtherFailure(msg), None, None, get_peak_memory()), -1)
     finally:
         setproctitle('dpark worker: idle')
-        gc.collect()
         gc.enable()
 
-def init_env(args):
-    setproctitle('dpark worker: idle')
-    env.start(False, args)
+_last_full_gc_rss = [0]
 
+def collect_garbage():
+    """ objects created by the task are in the young generations, the old
+    one holding the caches of worker is only scanned when rss grows """
+    rss = get_rss()
+    if rss > _last_full_gc_rss[0] * GC_FULL_GROWTH:
+        gc.collect()
+        _last_full_gc_rss[0] = get_rss()
+    else:
+        gc.collect(1)
 
-class LocalizedHTTP(SimpleHTTPServer.SimpleHTTPRequestHandler):
-    basedir = None
-    def translate_path(self, path):
-        out = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
-        return self.basedir + '/' + os.path.relpath(out)
+def init_env(args, pressure=None):
+    setproctitle('dpark worker: idle')
+    set_memory_pressure_flag(pressure)
+    env.start(False, args)
 
-    def log_message(self, format, *args):
-        pass
 
 def startWebServer(path):
     # check the default web server
@@ -128,10 +159,8 @@ def startWebServer(path):
         pass
 
     logger.warning("default webserver at %s not available", DEFAULT_WEB_PORT)
-    LocalizedHTTP.basedir = os.path.dirname(path)
-    ss = SocketServer.TCPServer(('0.0.0.0', 0), LocalizedHTTP)
-    spawn(ss.serve_forever)
-    uri = "http://%s:%d/%s" % (socket.gethostname(), ss.server_address[1],
+    port = FileServer(os.path.dirname(path)).start()
+    uri = "http://%s:%d/%s" % (socket.gethostname(), port,
             os.path.basename(path))
     return uri
 
@@ -171,6 +200,29 @@ def get_pool_memory(pool):
     except Exception:
         return 0
 
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5') # reset VmHWM, since linux 4.0
+    except IOError:
+        pass
+
+def get_peak_memory():
+    return get_proc_status('VmHWM:')
+
+def get_rss():
+    return get_proc_status('VmRSS:')
+
+def get_proc_status(name):
+    "value of name in /proc/self/status, in MB"
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith(name):
+                return int(line.split()[1]) >> 10
+    except IOError:
+        pass
+    return 0
+
 def get_task_memory(task):
     for r in task.resources:
         if r.name == 'mem':
@@ -236,11 +288,13 @@ class MyExecutor(mesos.Executor):
             return
 
         mem_limit = {}
+        over_since = {} # tid -> time when it is over the hard limit
         idle_since = time.time()
 
         while True:
             self.lock.acquire()
 
+            over = 0 # MB used by the running tasks more than offered
             for tid, (task, pool) in self.busy_workers.items():
                 task_id = task.task_id
                 try:
@@ -262,7 +316,14 @@ class MyExecutor(mesos.Executor):
                 offered = get_task_memory(task)
                 if not offered:
                     continue
+                if rss > offered:
+                    over += rss - offered
                 if rss > offered * 1.5:
+                    since = over_since.setdefault(tid, time.time())
+                    if since + MEMORY_PRESSURE_GRACE > time.time():
+                        # ask the task to spill, kill it if it can not
+                        pool.pressure.value = 1
+                        continue
                     logger.warning("task %s used too much memory: %dMB > %dMB * 1.5, kill it. "
                             + "use -M argument or taskMemory to request more memory.", tid, rss, offered)
                     reply_status(driver, task_id, mesos_pb2.TASK_KILLED)
@@ -272,13 +333,29 @@ class MyExecutor(mesos.Executor):
                     logger.debug("task %s used too much memory: %dMB > %dMB, "
                             + "use -M to request or taskMemory for more memory", tid, rss, offered)
                     mem_limit[tid] = rss / offered + 0.1
+                    pool.pressure.value = 1
+                    over_since.pop(tid, None)
+                else:
+                    over_since.pop(tid, None)
+
+            for tid in over_since.keys():
+                if tid not in self.busy_workers:
+                    over_since.pop(tid)
+
+            if over and self.idle_workers:
+                self.trim_idle_workers(over)
 
             now = time.time() 
-            n = len([1 for t, p in self.idle_workers if t + MAX_WORKER_IDLE_TIME < now])
-            if n:
-                for _, p in self.idle_workers[:n]:
+            # idle workers are in the order of time, the last ones are warm
+            surplus = len(self.idle_workers) - MAX_WARM_WORKERS
+            idle_workers = []
+            for i, (t, p) in enumerate(self.idle_workers):
+                idle = MAX_WORKER_IDLE_TIME if i < surplus else MAX_WARM_WORKER_IDLE_TIME
+                if t + idle < now:
                     p.terminate()
-                self.idle_workers = self.idle_workers[n:]
+                else:
+                    idle_workers.append((t, p))
+            self.idle_workers = idle_workers
 
             if self.busy_workers or self.idle_workers:
                 idle_since = now
@@ -289,6 +366,18 @@ class MyExecutor(mesos.Executor):
             
             time.sleep(1) 
 
+    def trim_idle_workers(self, need):
+        """ stop idle workers from the oldest one, until the memory
+        they used is more than need (MB), which is not offered to any
+        task """
+        freed = 0
+        while self.idle_workers and freed < need:
+            _, p = self.idle_workers.pop(0)
+            freed += get_pool_memory(p)
+            p.terminate()
+        logger.debug("stopped idle workers for %dMB (need %dMB), %d left",
+                freed, need, len(self.idle_workers))
+
     @safe
     def registered(self, driver, executorInfo, frameworkInfo, slaveInfo):
         try:
@@ -334,7 +423,9 @@ class MyExecutor(mesos.Executor):
         try:
             return self.idle_workers.pop()[1]
         except IndexError:
-            p = multiprocessing.Pool(1, init_env, [self.init_args])
+            pressure = multiprocessing.RawValue('b', 0)
+            p = multiprocessing.Pool(1, init_env, [self.init_args, pressure])
+            p.pressure = pressure
             p.done = 0
             return p
 
@@ -353,7 +444,7 @@ class MyExecutor(mesos.Executor):
         
             pool = self.get_idle_worker()
             self.busy_workers[task.task_id.value] = (task, pool)
-            pool.apply_async(run_task, [task.data], callback=callback)
+            pool.apply_async(run_task, [task_id.value, task.data], callback=callback)
 
         except Exception, e:
             import traceback
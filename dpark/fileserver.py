@@ -0,0 +1,237 @@
+""" file server of the workers, serving the shuffle outputs, cached
+partitions, big results and MutableDict files by http
+
+Files are sent by sendfile(2) when available, connections are kept alive
+for HTTP/1.1 clients, and byte ranges (also multiple ranges) are supported.
+Every client can transfer at most MAX_CLIENT_TRANSFERS files at the same
+time, others wait for their turn.
+"""
+import os
+import sys
+import errno
+import select
+import socket
+import urllib
+import posixpath
+import threading
+import logging
+import SocketServer
+import BaseHTTPServer
+
+from dpark.util import spawn
+
+logger = logging.getLogger("fileserver")
+
+KEEPALIVE_TIMEOUT = 60
+MAX_CLIENT_TRANSFERS = 8
+COPY_BUFFER_SIZE = 256 << 10
+BOUNDARY = 'DPARK_BYTE_RANGES'
+
+def _libc_sendfile():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        n = func(out_fd, in_fd, ctypes.byref(off), count)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return sendfile
+
+sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+def copy_range(sock, f, start, length, timeout=KEEPALIVE_TIMEOUT):
+    "send length bytes of f from start to sock"
+    if sendfile is None:
+        f.seek(start)
+        while length > 0:
+            buf = f.read(min(length, COPY_BUFFER_SIZE))
+            if not buf:
+                raise IOError("%s is truncated" % f.name)
+            sock.sendall(buf)
+            length -= len(buf)
+        return
+
+    fd = sock.fileno()
+    while length > 0:
+        try:
+            n = sendfile(fd, f.fileno(), start, length)
+        except OSError, e:
+            if e.errno == errno.EAGAIN: # socket with timeout is non-blocking
+                if not select.select([], [fd], [], timeout)[1]:
+                    raise socket.timeout("send timed out")
+                continue
+            raise
+        if n == 0:
+            raise IOError("%s is truncated" % f.name)
+        start += n
+        length -= n
+
+def parse_ranges(header, size):
+    """ parse the Range header into [(start, end)], end is inclusive,
+    None if it should be ignored, [] if not satisfiable """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes':
+        return None
+    ranges = []
+    for r in spec.split(','):
+        first, sep, last = r.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+            else:
+                start, end = max(size - int(last), 0), size - 1
+                if not int(last):
+                    continue
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges
+
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT # of idle connections
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # headers and body are sent separately
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split('?')[0].split('#')[0]))
+        parts = [p for p in path.split('/') if p and p not in (os.curdir, os.pardir)]
+        return os.path.join(self.server.basedir, *parts)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        path = self.translate_path(self.path)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return self.send_error(404, "File not found")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            ranges = None
+            if 'Range' in self.headers:
+                ranges = parse_ranges(self.headers['Range'], size)
+                if ranges == []:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    return self.end_headers()
+
+            if not ranges:
+                self.send_headers(200, 'application/octet-stream', size)
+                parts = [('', 0, size)]
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_headers(206, 'application/octet-stream', end - start + 1,
+                    {'Content-Range': 'bytes %d-%d/%d' % (start, end, size)})
+                parts = [('', start, end - start + 1)]
+            else:
+                parts = []
+                for start, end in ranges:
+                    head_ = ('--%s\r\nContent-Type: application/octet-stream\r\n'
+                        'Content-Range: bytes %d-%d/%d\r\n\r\n' % (BOUNDARY, start, end, size))
+                    parts.append((head_, start, end - start + 1))
+                tail = '\r\n--%s--\r\n' % BOUNDARY
+                length = sum(len(h) + n for h, s, n in parts) + \
+                        2 * (len(parts) - 1) + len(tail)
+                self.send_headers(206, 'multipart/byteranges; boundary=' + BOUNDARY, length)
+
+            if head:
+                return
+            with self.server.transfer(self.client_address[0]):
+                for i, (h, start, length) in enumerate(parts):
+                    if i:
+                        h = '\r\n' + h
+                    if h:
+                        self.wfile.write(h)
+                    copy_range(self.connection, f, start, length)
+                if len(parts) > 1:
+                    self.wfile.write(tail)
+        finally:
+            f.close()
+
+    def send_headers(self, code, ctype, length, extra={}):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        for k, v in extra.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ClientTransfers(object):
+    "limit the files sent to a client at the same time"
+    def __init__(self, server, client):
+        self.server = server
+        self.client = client
+
+    def __enter__(self):
+        with self.server.lock:
+            sem = self.server.clients.get(self.client)
+            if sem is None:
+                sem = self.server.clients[self.client] = [
+                    threading.Semaphore(self.server.maxTransfers), 0]
+            sem[1] += 1
+        sem[0].acquire()
+        self.sem = sem
+
+    def __exit__(self, *a):
+        self.sem[0].release()
+        with self.server.lock:
+            self.sem[1] -= 1
+            if not self.sem[1]:
+                self.server.clients.pop(self.client, None)
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, basedir, port=0, maxTransfers=MAX_CLIENT_TRANSFERS):
+        BaseHTTPServer.HTTPServer.__init__(self, ('0.0.0.0', port), FileHandler)
+        self.basedir = basedir
+        self.maxTransfers = maxTransfers
+        self.clients = {} # client -> [semaphore, transfers waiting or running]
+        self.lock = threading.Lock()
+
+    def transfer(self, client):
+        return ClientTransfers(self, client)
+
+    def handle_error(self, request, client_address):
+        logger.debug("serve %s failed", client_address, exc_info=True)
+
+    def start(self):
+        spawn(self.serve_forever)
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -2,7 +2,6 @@ import time
 import sys
 import logging
 import socket
-from operator import itemgetter
 
 logger = logging.getLogger("job")
 
@@ -41,10 +40,22 @@ class Job:
         cls.nextJobId += 1
         return cls.nextJobId
 
-LOCALITY_WAIT = 0
+# delay scheduling: seconds to wait for a host-local (or rack-local)
+# offer before launching tasks at the next locality level
+LOCALITY_WAIT = 3
+LOCALITY_WAIT_RACK = 3
+LOCALITY_HOST, LOCALITY_RACK, LOCALITY_ANY, LOCALITY_NOPREF = range(4)
+LOCALITY_NAMES = ['host', 'rack', 'any', 'nopref']
 WAIT_FOR_RUNNING = 10
 MAX_TASK_FAILURES = 4
 MAX_TASK_MEMORY = 15 << 10 # 15GB
+# speculation starts after this fraction of tasks finished
+SPECULATION_QUANTILE = 0.75
+# tasks running longer than median * SPECULATION_MULTIPLIER are speculated
+SPECULATION_MULTIPLIER = 1.5
+MIN_SPECULATION_TIME = 10
+# split a straggler into at most these pieces, instead of speculating
+MAX_SPLIT_PIECES = 8
 
 # A Job that runs a set of tasks with no interdependencies.
 class SimpleJob(Job):
@@ -53,6 +64,9 @@ class SimpleJob(Job):
         Job.__init__(self)
         self.sched = sched
         self.tasks = tasks
+        self.cpus = cpus
+        self.minMem = mem # of all the pending tasks
+        self.urgent = False # served before the other jobs in pool
 
         for t in tasks:
             t.status = None
@@ -64,27 +78,40 @@ class SimpleJob(Job):
         self.launched = [False] * len(tasks)
         self.finished = [False] * len(tasks)
         self.numFailures = [0] * len(tasks)
+        self.numRunning = [0] * len(tasks) # running attempts of each task
+        self.abandoned = set() # (index, tried) re-assigned after WAIT_FOR_RUNNING
         self.blacklist = [[] for i in xrange(len(tasks))]
+        self.speculatable = set()
+        self.runningTasks = set()
+        self.durations = [] # of finished tasks
         self.tidToIndex = {}
         self.numTasks = len(tasks)
         self.tasksLaunched = 0
         self.tasksFinished = 0
         self.total_used = 0
+        self.peakMemory = 0 # MB, of all the attempts
 
-        self.lastPreferredLaunchTime = time.time()
+        self.lastLaunchTime = time.time()
+        self.localityIndex = LOCALITY_HOST
+        self.localityWaited = [0.0] * LOCALITY_ANY
+        self.localityLaunched = [0] * len(LOCALITY_NAMES)
+        self.rackOfHost = {}
 
+        # pending lists are used as stacks, tasks are popped from the
+        # end, launched or finished ones are removed lazily
         self.pendingTasksForHost = {}
+        self.pendingTasksForRack = {}
         self.pendingTasksWithNoPrefs = []
         self.allPendingTasks = []
+        self.host_cache = {}
 
         self.reasons = set()
         self.failed = False
         self.causeOfFailure = ""
         self.last_check = 0
 
-        for i in range(len(tasks)):
+        for i in reversed(xrange(len(tasks))):
             self.addPendingTask(i)
-        self.host_cache = {}
 
     @property
     def taskEverageTime(self):
@@ -93,80 +120,161 @@ class SimpleJob(Job):
         return max(self.total_used / self.tasksFinished, 5)
 
     def addPendingTask(self, i):
+        self.minMem = min(self.minMem, self.tasks[i].mem)
         loc = self.tasks[i].preferredLocations()
         if not loc:
             self.pendingTasksWithNoPrefs.append(i)
         else:
             for host in loc:
                 self.pendingTasksForHost.setdefault(host, []).append(i)
+                rack = self.rackOfHost.get(host)
+                if rack is not None:
+                    self.pendingTasksForRack.setdefault(rack, []).append(i)
         self.allPendingTasks.append(i)
 
-    def getPendingTasksForHost(self, host):
+    def getHostNames(self, host):
         try:
             return self.host_cache[host]
         except KeyError:
-            v = self._getPendingTasksForHost(host)
-            self.host_cache[host] = v
-            return v
+            try:
+                h, hs, ips = socket.gethostbyname_ex(host)
+            except Exception:
+                h, hs, ips = host, [], []
+            names = [host] + [n for n in [h] + hs + ips if n != host]
+            self.host_cache[host] = names
+            return names
+
+    def addHostRack(self, host, rack):
+        for h in self.getHostNames(host):
+            if h in self.rackOfHost:
+                continue
+            self.rackOfHost[h] = rack
+            if h in self.pendingTasksForHost:
+                self.pendingTasksForRack.setdefault(rack, []).extend(
+                        self.pendingTasksForHost[h])
+
+    def isPending(self, i):
+        return not self.launched[i] and not self.finished[i]
+
+    def hasPendingTasks(self, level):
+        if level == LOCALITY_HOST:
+            lists = self.pendingTasksForHost
+        elif level == LOCALITY_RACK:
+            lists = self.pendingTasksForRack
+        else:
+            return True
+        found = False
+        empty = []
+        for key, l in lists.iteritems():
+            while l and not self.isPending(l[-1]):
+                l.pop()
+            if l:
+                found = True
+                break
+            empty.append(key)
+        for key in empty:
+            del lists[key]
+        return found
+
+    def getAllowedLocality(self, now):
+        waits = [LOCALITY_WAIT, LOCALITY_WAIT_RACK]
+        while self.localityIndex < LOCALITY_ANY:
+            level = self.localityIndex
+            if self.hasPendingTasks(level):
+                if now - self.lastLaunchTime < waits[level]:
+                    break
+                self.localityWaited[level] += waits[level]
+                self.lastLaunchTime += waits[level]
+            self.localityIndex += 1
+        return self.localityIndex
 
-    def _getPendingTasksForHost(self, host):
-        try:
-            h, hs, ips = socket.gethostbyname_ex(host)
-        except Exception:
-            h, hs, ips = host, [], []
-        tasks = sum((self.pendingTasksForHost.get(h, [])
-            for h in [h] + hs + ips), [])
-        st = {}
-        for t in tasks:
-            st[t] = st.get(t, 0) + 1
-        ts = sorted(st.items(), key=itemgetter(1), reverse=True)
-        return [t for t,_ in ts ]
+    def isWaitingForLocality(self):
+        return (self.tasksLaunched < self.numTasks
+                and self.getAllowedLocality(time.time()) < LOCALITY_ANY)
 
     def findTaskFromList(self, l, host, cpus, mem):
-        for i in l:
-            if self.launched[i] or self.finished[i]:
+        j = len(l)
+        while j > 0:
+            j -= 1
+            i = l[j]
+            if not self.isPending(i):
+                del l[j] # only skipped tasks are after it
                 continue
             if host in self.blacklist[i]:
                 continue
             t = self.tasks[i]
             if t.cpus <= cpus+1e-4 and t.mem <= mem:
+                del l[j]
                 return i
 
-    def findTask(self, host, localOnly, cpus, mem):
-        localTask = self.findTaskFromList(self.getPendingTasksForHost(host), host, cpus, mem)
-        if localTask is not None:
-            return localTask, True
+    def findTask(self, host, rack, maxLocality, cpus, mem):
+        if cpus+1e-4 < self.cpus or mem < self.minMem:
+            return None, None
+        for h in self.getHostNames(host):
+            if h in self.pendingTasksForHost:
+                localTask = self.findTaskFromList(self.pendingTasksForHost[h], host, cpus, mem)
+                if localTask is not None:
+                    return localTask, LOCALITY_HOST
         noPrefTask = self.findTaskFromList(self.pendingTasksWithNoPrefs, host, cpus, mem)
         if noPrefTask is not None:
-            return noPrefTask, True
-        if not localOnly:
-            return self.findTaskFromList(self.allPendingTasks, host, cpus, mem), False
-#        else:
-#            print repr(host), self.pendingTasksForHost
-        return None, False
+            return noPrefTask, LOCALITY_NOPREF
+        if maxLocality >= LOCALITY_RACK and rack in self.pendingTasksForRack:
+            rackTask = self.findTaskFromList(self.pendingTasksForRack[rack], host, cpus, mem)
+            if rackTask is not None:
+                return rackTask, LOCALITY_RACK
+        if maxLocality >= LOCALITY_ANY:
+            return self.findTaskFromList(self.allPendingTasks, host, cpus, mem), LOCALITY_ANY
+        return None, None
+
+    def findSpeculativeTask(self, host, cpus, mem):
+        for i in self.speculatable:
+            if self.finished[i] or host in self.blacklist[i]:
+                continue
+            t = self.tasks[i]
+            if t.cpus <= cpus+1e-4 and t.mem <= mem:
+                return i
 
     # Respond to an offer of a single slave from the scheduler by finding a task
-    def slaveOffer(self, host, availableCpus=1, availableMem=100):
+    def slaveOffer(self, host, availableCpus=1, availableMem=100, rack=None):
         now = time.time()
-        localOnly = (now - self.lastPreferredLaunchTime < LOCALITY_WAIT)
-        i, preferred = self.findTask(host, localOnly, availableCpus, availableMem)
+        if rack is not None and host not in self.rackOfHost:
+            self.addHostRack(host, rack)
+        maxLocality = self.getAllowedLocality(now)
+        i, locality = self.findTask(host, rack, maxLocality, availableCpus, availableMem)
         if i is not None:
             task = self.tasks[i]
             task.status = TASK_STARTING
             task.start = now
             task.host = host
             task.tried += 1
-            prefStr = preferred and "preferred" or "non-preferred"
             logger.debug("Starting task %d:%d as TID %s on slave %s (%s)",
-                self.id, i, task, host, prefStr)
+                self.id, i, task, host, LOCALITY_NAMES[locality])
             self.tidToIndex[task.id] = i
             self.launched[i] = True
             self.tasksLaunched += 1
+            self.numRunning[i] += 1
+            self.runningTasks.add(i)
             self.blacklist[i].append(host)
-            if preferred:
-                self.lastPreferredLaunchTime = now
+            self.localityLaunched[locality] += 1
+            if locality != LOCALITY_NOPREF:
+                # back to the level of launched task, wait again from now
+                self.localityIndex = locality
+                self.lastLaunchTime = now
             return task
-        logger.debug("no task found %s", localOnly)
+
+        i = self.findSpeculativeTask(host, availableCpus, availableMem)
+        if i is not None:
+            # keep start and host of the first attempt for timing
+            task = self.tasks[i]
+            task.tried += 1
+            logger.info("Starting speculative task %d:%d (try %d) on slave %s, "
+                "running for %.1fs at %s", self.id, i, task.tried, host,
+                now - task.start, task.host)
+            self.speculatable.remove(i)
+            self.numRunning[i] += 1
+            self.blacklist[i].append(host)
+            return task
+        logger.debug("no task found at locality %s", LOCALITY_NAMES[maxLocality])
 
     def statusUpdate(self, tid, tried, status, reason=None, result=None, update=None):
         logger.debug("job status update %s %s %s", tid, status, reason)
@@ -180,23 +288,36 @@ class SimpleJob(Job):
             return 
 
         task = self.tasks[i]
-        task.status = status
+        if status != TASK_FINISHED and (i, tried) in self.abandoned:
+            # not counted as running any more, but it can still finish it
+            return
+
         # when checking, task been masked as not launched
         if not self.launched[i]:
             self.launched[i] = True
             self.tasksLaunched += 1
+            self.runningTasks.add(i)
 
         if status == TASK_FINISHED:
             self.taskFinished(tid, tried, result, update)
         elif status in (TASK_LOST, TASK_FAILED, TASK_KILLED):
             self.taskLost(tid, tried, status, reason)
-        task.start = time.time()
+        elif self.numRunning[i] <= 1: # not speculated
+            task.status = status
+            if status == TASK_RUNNING:
+                task.start = time.time()
+
+    def addMemoryUsage(self, peak):
+        self.peakMemory = max(self.peakMemory, peak)
 
     def taskFinished(self, tid, tried, result, update):
         i = self.tidToIndex[tid]
         self.finished[i] = True
         self.tasksFinished += 1
+        self.speculatable.discard(i)
+        self.runningTasks.discard(i)
         task = self.tasks[i]
+        self.durations.append(time.time() - task.start)
         task.used += time.time() - task.start
         self.total_used += task.used
         if sys.stderr.isatty():
@@ -208,6 +329,11 @@ class SimpleJob(Job):
         from dpark.schedule import Success
         self.sched.taskEnded(task, Success(), result, update)
 
+        # kill the other attempts, the first finished one wins
+        if self.numRunning[i] > 1:
+            logger.debug("task %d:%d finished by try %d, kill the others",
+                self.id, i, tried)
+        self.numRunning[i] = 0
         for t in range(task.tried):
             if t + 1 != tried:
                 self.sched.killTask(self.id, task.id, t + 1)
@@ -218,6 +344,13 @@ class SimpleJob(Job):
             logger.info("Job %d finished in %.1fs: min=%.1fs, avg=%.1fs, max=%.1fs, maxtry=%d",
                 self.id, time.time()-self.start,
                 min(ts), sum(ts)/len(ts), max(ts), max(tried))
+            if self.pendingTasksForHost:
+                total = sum(self.localityLaunched)
+                logger.info("Job %d locality: %s, waited %s", self.id,
+                    ', '.join('%s=%d%%' % (name, n * 100 / total)
+                        for name, n in zip(LOCALITY_NAMES, self.localityLaunched)),
+                    ', '.join('%s=%.1fs' % (name, w)
+                        for name, w in zip(LOCALITY_NAMES, self.localityWaited)))
             from dpark.accumulator import LocalReadBytes, RemoteReadBytes
             lb, rb = LocalReadBytes.reset(), RemoteReadBytes.reset()
             if rb > 0:
@@ -234,7 +367,8 @@ class SimpleJob(Job):
             logger.warning("Task %s was Lost due to fetch failure from %s",
                 tid, reason.serverUri)
             self.sched.taskEnded(self.tasks[index], reason, None, None)
-            # cancel tasks
+            # cancel tasks, they are submitted again after the map
+            # outputs are computed
             if not self.finished[index]:
                 self.finished[index] = True
                 self.tasksFinished += 1
@@ -244,16 +378,20 @@ class SimpleJob(Job):
                     self.tasksLaunched += 1
                     self.finished[i] = True
                     self.tasksFinished += 1
+                    self.sched.taskEnded(self.tasks[i], reason, None, None)
             if self.tasksFinished == self.numTasks:
                 self.sched.jobFinished(self) # cancel job
             return
 
         task = self.tasks[index]
         if status == TASK_KILLED:
+            # killed by executor after using more than 1.5 times of mem
+            self.addMemoryUsage(int(task.mem * 1.5))
             task.mem = min(task.mem * 2, MAX_TASK_MEMORY)
             for i,t in enumerate(self.tasks):
                 if not self.launched[i]:
                     t.mem = max(task.mem, t.mem)
+            self.minMem = task.mem
 
         elif status == TASK_FAILED:
             _logger = logger.error if self.numFailures[index] == MAX_TASK_FAILURES\
@@ -274,8 +412,17 @@ class SimpleJob(Job):
                 index, MAX_TASK_FAILURES)
             self.abort("Task %d failed more than %d times"
                 % (index, MAX_TASK_FAILURES))
-        
+
+        self.numRunning[index] = max(self.numRunning[index] - 1, 0)
+        if self.numRunning[index] > 0:
+            # the other attempt is still running
+            return
+
+        if getattr(task, 'splitting', False):
+            self.sched.cancelSplit(task)
         self.launched[index] = False
+        self.runningTasks.discard(index)
+        self.addPendingTask(index)
         if self.tasksLaunched == self.numTasks:    
             self.sched.requestMoreResources()
         self.tasksLaunched -= 1
@@ -286,45 +433,62 @@ class SimpleJob(Job):
             return False
         self.last_check = now
 
-        n = self.launched.count(True)
-        if n != self.tasksLaunched:
-            logger.warning("bug: tasksLaunched(%d) != %d", self.tasksLaunched, n)
-            self.tasksLaunched = n
-
-        for i in xrange(self.numTasks):
+        n = self.tasksLaunched
+        for i in list(self.runningTasks):
+            if not self.launched[i] or self.finished[i]:
+                self.runningTasks.discard(i)
+                continue
             task = self.tasks[i]
-            if (self.launched[i] and task.status == TASK_STARTING
+            if (task.status == TASK_STARTING
                     and task.start + WAIT_FOR_RUNNING < now):
                 logger.debug("task %d timeout %.1f (at %s), re-assign it", 
                         task.id, now - task.start, task.host)
+                self.abandoned.add((i, task.tried))
+                self.sched.killTask(self.id, task.id, task.tried)
+                self.numRunning[i] -= 1
+                if self.numRunning[i] > 0:
+                    # the other attempt is still running
+                    continue
                 self.launched[i] = False
                 self.tasksLaunched -= 1
+                self.runningTasks.discard(i)
+                self.addPendingTask(i)
 
-        if self.tasksFinished > self.numTasks * 2.0 / 3:
-            scale = 1.0 * self.numTasks / self.tasksFinished
-            avg = max(self.taskEverageTime, 10)
-            tasks = sorted((task.start, i, task) 
-                for i,task in enumerate(self.tasks) 
-                if self.launched[i] and not self.finished[i])
-            for _t, idx, task in tasks:
-                used = now - task.start
-                #logger.debug("task %s used %.1f (avg = %.1f)", task.id, used, avg)
-                if used > avg * (2 ** task.tried) * scale:
-                    # re-submit timeout task
-                    if task.tried <= MAX_TASK_FAILURES:
-                        logger.debug("re-submit task %s for timeout %.1f, try %d",
-                            task.id, used, task.tried)
-                        task.used += used
-                        task.start = now
-                        self.launched[idx] = False
-                        self.tasksLaunched -= 1
-                    else:
-                        logger.error("task %s timeout, aborting job %s",
-                            task, self.id)
-                        self.abort("task %s timeout" % task)
-                else:
-                    break
-        return self.tasksLaunched < n
+        return self.tasksLaunched < n or self.checkSpeculatableTasks(now)
+
+    def checkSpeculatableTasks(self, now):
+        # run a copy of the tasks much slower than the finished ones
+        if (self.tasksFinished < self.numTasks * SPECULATION_QUANTILE
+                or not self.durations):
+            return False
+        self.durations.sort() # mostly sorted already
+        median = self.durations[len(self.durations) / 2]
+        threshold = max(median * SPECULATION_MULTIPLIER, MIN_SPECULATION_TIME)
+        found = False
+        for i in self.runningTasks:
+            task = self.tasks[i]
+            if (self.launched[i] and not self.finished[i]
+                    and self.numRunning[i] == 1 and i not in self.speculatable
+                    and task.status == TASK_RUNNING
+                    and not getattr(task, 'splitting', False)
+                    and now - task.start > threshold):
+                split = getattr(task, 'split', None)
+                if (getattr(split, 'ctrl', None)
+                        and not getattr(task, 'splitRequested', False)):
+                    # the rest of a slow split can be run by others
+                    pieces = min(max(int((now - task.start) / median), 2),
+                            MAX_SPLIT_PIECES)
+                    logger.info("task %d:%d has run %.1fs at %s (median %.1fs), "
+                        "split it into %d", self.id, i, now - task.start,
+                        task.host, median, pieces + 1)
+                    task.splitRequested = task.splitting = True
+                    self.sched.requestSplit(task, pieces)
+                    continue
+                logger.info("task %d:%d has run %.1fs at %s (median %.1fs), "
+                    "speculate it", self.id, i, now - task.start, task.host, median)
+                self.speculatable.add(i)
+                found = True
+        return found
 
     def abort(self, message):
         logger.error("abort the job: %s", message)
@@ -0,0 +1,54 @@
+""" metrics of tasks, measured by workers with the TaskMetrics
+accumulator, and summarized per stage in driver when it finished
+"""
+import logging
+
+from dpark.job import readable
+
+logger = logging.getLogger("metrics")
+
+QUANTILES = [0, 0.25, 0.5, 0.75, 1.0]
+
+# name -> unit, in the order of reporting
+METRICS = [
+    ('runTime', 'time'),
+    ('deserializeTime', 'time'),
+    ('inputBytes', 'bytes'),
+    ('inputRecords', 'count'),
+    ('fetchBytes', 'bytes'),
+    ('fetchTime', 'time'),
+    ('shuffleWriteBytes', 'bytes'),
+    ('shuffleWriteTime', 'time'),
+    ('resultBytes', 'bytes'),
+    ('serializeTime', 'time'),
+    ('gcTime', 'time'),
+    ('peakMemory', 'MB'),
+]
+
+def fmt(unit, v):
+    if unit == 'time':
+        return '%.2fs' % v
+    if unit == 'bytes':
+        return readable(v)
+    if unit == 'MB':
+        return '%dMB' % v
+    return str(v)
+
+def quantiles(values):
+    values = sorted(values)
+    return [values[int(q * (len(values) - 1))] for q in QUANTILES]
+
+def summarize(stage, records):
+    "the quantiles of every metric in records of tasks, as lines"
+    lines = ['metrics of %d tasks in %s (min, 25%%, median, 75%%, max):'
+        % (len(records), stage)]
+    for name, unit in METRICS:
+        values = [r[name] for r in records if name in r]
+        if values:
+            lines.append('  %-18s %s' % (name,
+                ' '.join('%8s' % fmt(unit, v) for v in quantiles(values))))
+    return lines
+
+def report(stage, records):
+    if records:
+        logger.info('\n'.join(summarize(stage, records)))
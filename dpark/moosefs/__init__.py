@@ -1,5 +1,6 @@
 import os
 import socket
+import threading
 from cStringIO import StringIO
 import logging
 
@@ -281,6 +282,7 @@ class ReadableFile(File):
         self.generator = None
 
 _mfs = {}
+_mfs_lock = threading.Lock()
 
 MFS_PREFIX = {
     }
@@ -288,7 +290,9 @@ MFS_PREFIX = {
 def get_mfs(master, mountpoint=''):
     if master in _mfs:
         return _mfs[master]
-    _mfs[master] = MooseFS(master, mountpoint=mountpoint)
+    with _mfs_lock:
+        if master not in _mfs:
+            _mfs[master] = MooseFS(master, mountpoint=mountpoint)
     return _mfs[master]
 
 def mfsopen(path, master='mfsmaster'):
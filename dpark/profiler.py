@@ -0,0 +1,65 @@
+""" profile the tasks with cProfile, and merge them per stage in driver
+
+Enabled by --profile, each task sends the stats of its top functions
+back by the Profiles accumulator, which is reported when a job finished.
+"""
+import os
+import sys
+import cProfile
+import pstats
+
+from dpark.accumulator import Profiles
+from dpark.env import env
+
+# functions kept in the profile of a task, by cumulative time
+MAX_PROFILE_FUNCS = 300
+
+def is_profiling():
+    return bool(env.get('PROFILE'))
+
+def run_task(task, aid):
+    "run the task with cProfile, add the stats of it into Profiles"
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(task.run, aid)
+    finally:
+        prof.create_stats()
+        funcs = sorted(prof.stats.iteritems(), key=lambda (k, v): -v[3])
+        Profiles.add({task.stageId: dict((k, v[:4])
+            for k, v in funcs[:MAX_PROFILE_FUNCS])})
+
+
+class MergedProfile(object):
+    "merged stats of a stage, can be loaded by pstats"
+    def __init__(self, stats):
+        self.stats = dict((k, tuple(v) + ({},)) for k, v in stats.iteritems())
+
+    def create_stats(self):
+        pass
+
+def module_of(path):
+    if path == '~':
+        return 'builtins'
+    name = os.path.splitext(os.path.basename(path))[0]
+    if os.path.basename(os.path.dirname(path)) == 'dpark':
+        return 'dpark.' + name
+    return name
+
+def report(stages, limit=20, out=None):
+    "print the top functions of the stages over all their tasks"
+    out = out or sys.stdout
+    for stage in stages:
+        stats = Profiles.value.pop(stage.id, None)
+        if not stats:
+            continue
+        own = {}
+        for (path, line, func), (cc, nc, tt, ct) in stats.iteritems():
+            m = module_of(path)
+            own[m] = own.get(m, 0) + tt
+        total = sum(own.values()) or 1
+        print >>out, 'Profile of %s, %.1fs in total' % (stage, total)
+        print >>out, '  own time by module: ' + ', '.join('%s=%.1f%%' % (m, t * 100 / total)
+                for m, t in sorted(own.items(), key=lambda x: -x[1])[:10])
+        ps = pstats.Stats(MergedProfile(stats), stream=out)
+        ps.sort_stats('cumulative')
+        ps.print_stats(limit)
@@ -21,8 +21,9 @@ import struct
 from dpark.serialize import load_func, dump_func
 from dpark.dependency import *
 from dpark.util import spawn, chain
-from dpark.shuffle import Merger, CoGroupMerger
+from dpark.shuffle import Merger, SpillMerger, CoGroupMerger
 from dpark.env import env
+from dpark.accumulator import TaskMetrics
 from dpark import moosefs
 
 logger = logging.getLogger("rdd")
@@ -96,6 +97,16 @@ class RDD(object):
         self._pickle_cache = None # clear pickle cache
         return self
 
+    # a range of a split can be computed on its own, see TextFileRDD
+    splittable = False
+
+    threadSafe = True
+    def notThreadSafe(self):
+        "run the tasks of it one by one in local[N] mode"
+        self.threadSafe = False
+        self._pickle_cache = None
+        return self
+
     def preferredLocations(self, split):
         if self.shouldCache:
             locs = env.cacheTracker.getCachedLocs(self.id, split.index)
@@ -205,10 +216,20 @@ class RDD(object):
 
 
     def collect(self):
-        return sum(self.ctx.runJob(self, lambda x:list(x)), [])
+        result = []
+        for part in self.ctx.runJob(self, lambda x:list(x)):
+            result.extend(part)
+        return result
+
+    def toLocalIterator(self):
+        "iterate the RDD in driver, holding only one partition at a time"
+        for i in range(len(self)):
+            part = list(self.ctx.runJob(self, lambda x:list(x), [i]))[0]
+            for v in part:
+                yield v
 
     def __iter__(self):
-        return self.collect()
+        return iter(self.collect())
 
     def reduce(self, f):
         def reducePartition(it):
@@ -251,7 +272,7 @@ class RDD(object):
         else:
             def topk(it):
                 return heapq.nlargest(n, it, key)
-        return topk(sum(self.ctx.runJob(self, topk), []))
+        return topk(chain(self.ctx.runJob(self, topk)))
 
     def hot(self, n=10, numSplits=None, taskMemory=None):
         st = self.map(lambda x:(x,1)).reduceByKey(lambda x,y:x+y, numSplits, taskMemory)
@@ -353,10 +374,15 @@ class RDD(object):
         return self.groupByKey(numSplits, taskMemory).flatMapValue(lambda x: x)
 
     def innerJoin(self, other):
-        o_b = self.ctx.broadcast(other.collectAsMap())
-        r = self.filter(lambda (k,v):k in o_b.value).map(lambda (k,v):(k,(v,o_b.value[k])))
-        r.mem += (o_b.bytes * 10) >> 20 # memory used by broadcast obj
-        return r
+        from dpark.disktable import collect_table
+        o = collect_table(other)
+        if isinstance(o, dict):
+            o_b = self.ctx.broadcast(o)
+            r = self.filter(lambda (k,v):k in o_b.value).map(lambda (k,v):(k,(v,o_b.value[k])))
+            r.mem += (o_b.bytes * 10) >> 20 # memory used by broadcast obj
+            return r
+        # too big, looked up on disk, the last bucket is cached
+        return self.filter(lambda (k,v):k in o).map(lambda (k,v):(k,(v,o[k])))
 
     def update(self, other, replace_only=False):
         
@@ -479,6 +505,8 @@ class DerivedRDD(RDD):
 
 
 class MappedRDD(DerivedRDD):
+    splittable = True
+
     def __init__(self, prev, func=lambda x:x):
         DerivedRDD.__init__(self, prev)
         self.func = func
@@ -567,10 +595,14 @@ class GlommedRDD(DerivedRDD):
         yield list(self.prev.iterator(split))
 
 class MapPartitionsRDD(MappedRDD):
+    splittable = False
+
     def compute(self, split):
         return self.func(self.prev.iterator(split))
 
 class EnumeratePartitionsRDD(MappedRDD):
+    splittable = False
+
     def compute(self, split):
         return self.func(split.index, self.prev.iterator(split))
 
@@ -704,7 +736,7 @@ class ShuffledRDD(RDD):
         return d
 
     def compute(self, split):
-        merger = Merger(self.numParts, self.aggregator.mergeCombiners) 
+        merger = SpillMerger(self.numParts, self.aggregator.mergeCombiners)
         fetcher = env.shuffleFetcher
         fetcher.fetch(self.shuffleId, split.index, merger.merge)
         return merger
@@ -1015,9 +1047,14 @@ class PartialSplit(Split):
         self.begin = begin
         self.end = end
 
+# seconds between checks of split requests
+SPLIT_CHECK_INTERVAL = 5
+MIN_SPLIT_SIZE = 1 << 20
+
 class TextFileRDD(RDD):
 
     DEFAULT_SPLIT_SIZE = 64*1024*1024
+    splittable = True
 
     def __init__(self, ctx, path, numSplits=None, splitSize=None):
         RDD.__init__(self, ctx)
@@ -1090,14 +1127,49 @@ class TextFileRDD(RDD):
         #    f.seek(start)
         #    return f
 
+        ctrl = getattr(split, 'ctrl', None)
+        if ctrl:
+            return self.readWithControl(f, start, end, ctrl)
         return self.read(f, start, end)
 
     def read(self, f, start, end):
+        begin, n = start, 0
         for line in f:
             yield line[:-1]
+            n += 1
             start += len(line)
             if start >= end: break
         f.close()
+        TaskMetrics.add({'inputBytes': start - begin, 'inputRecords': n})
+
+    def readWithControl(self, f, start, end, ctrl):
+        """ read lines in [start, end), the scheduler can ask to split
+        it by setting `ctrl` in tracker to [pieces], then the unread
+        range [cut, end) is given up and replied in `ctrl:reply`.
+        """
+        from dpark.tracker import GetValueMessage, SetValueMessage
+        client = env.trackerClient
+        last_check = time.time()
+        begin, n = start, 0
+        for line in f:
+            yield line[:-1]
+            start += len(line)
+            if start >= end: break
+            n += 1
+            if n % 1000 == 0 and time.time() > last_check + SPLIT_CHECK_INTERVAL:
+                last_check = time.time()
+                req = client.call(GetValueMessage(ctrl))
+                if req:
+                    pieces, = req
+                    cut = start + (end - start) / (pieces + 1)
+                    if end - cut < MIN_SPLIT_SIZE:
+                        cut = end # too small to split
+                    client.call(SetValueMessage(ctrl, []))
+                    client.call(SetValueMessage(ctrl + ':reply', [cut, end]))
+                    end = cut
+                    if start >= end: break
+        f.close()
+        TaskMetrics.add({'inputBytes': start - begin, 'inputRecords': n})
 
 
 class PartialTextFileRDD(TextFileRDD):
@@ -1135,6 +1207,7 @@ class GZipFileRDD(TextFileRDD):
     "the gziped file must be seekable, compressed by pigz -i"
     BLOCK_SIZE = 64 << 10
     DEFAULT_SPLIT_SIZE = 32 << 20
+    splittable = False
 
     def __init__(self, ctx, path, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, None, splitSize)
@@ -1238,6 +1311,7 @@ class GZipFileRDD(TextFileRDD):
 class TableFileRDD(TextFileRDD):
 
     DEFAULT_SPLIT_SIZE = 32 << 20
+    splittable = False
 
     def __init__(self, ctx, path, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, None, splitSize)
@@ -1287,6 +1361,7 @@ class BZip2FileRDD(TextFileRDD):
 
     DEFAULT_SPLIT_SIZE = 32*1024*1024
     BLOCK_SIZE = 9000
+    splittable = False
 
     def __init__(self, ctx, path, numSplits=None, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
@@ -1341,6 +1416,8 @@ class BZip2FileRDD(TextFileRDD):
 
 
 class BinaryFileRDD(TextFileRDD):
+    splittable = False
+
     def __init__(self, ctx, path, fmt=None, length=None, numSplits=None, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
         self.fmt = fmt
@@ -1716,6 +1793,8 @@ def prepare_value(val, compress):
 
 
 class BeansdbFileRDD(TextFileRDD):
+    splittable = False
+
     def __init__(self, ctx, path, filter=None, fullscan=False, raw=False):
         if not fullscan:
             hint = path[:-5] + '.hint'
@@ -0,0 +1,95 @@
+import socket
+import time
+import threading
+import logging
+
+import zmq
+
+from dpark.util import spawn
+from dpark.env import env
+
+logger = logging.getLogger("result")
+
+RESULT_CHUNK_SIZE = 1 << 20
+# chunks in flight, a worker blocks when the driver falls behind
+RESULT_HWM = 16
+RESULT_WAIT_TIMEOUT = 60
+# forget a discarded result after it, if its chunks never come
+RESULT_DISCARD_TIMEOUT = RESULT_WAIT_TIMEOUT * 10
+
+class ResultServer(object):
+    """ collect big task results streamed from workers in chunks
+
+    Each result is sent as multipart messages [key, chunk] over a
+    PUSH socket, ending with an empty chunk.
+    """
+    def __init__(self):
+        self.addr = None
+        self.thread = None
+        self.chunks = {}
+        self.finished = set()
+        self.discarded = {} # unfinished result -> time, dropped when received
+        self.cond = threading.Condition()
+
+    def start(self):
+        started = threading.Event()
+        self.thread = spawn(self.run, started)
+        started.wait()
+
+    def run(self, started):
+        sock = env.ctx.socket(zmq.PULL)
+        sock.setsockopt(zmq.RCVHWM, RESULT_HWM)
+        port = sock.bind_to_random_port("tcp://0.0.0.0")
+        self.addr = "tcp://%s:%d" % (socket.gethostname(), port)
+        logger.debug("ResultServer started at %s", self.addr)
+        started.set()
+        while True:
+            key, chunk = sock.recv_multipart()
+            with self.cond:
+                if key in self.discarded:
+                    if not chunk:
+                        del self.discarded[key]
+                    continue
+                if chunk:
+                    self.chunks.setdefault(key, []).append(chunk)
+                else:
+                    self.finished.add(key)
+                    self.cond.notifyAll()
+
+    def get(self, key, timeout=RESULT_WAIT_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.cond:
+            while key not in self.finished:
+                left = deadline - time.time()
+                if left <= 0:
+                    self.discard(key)
+                    raise IOError("result of %s is not received" % key)
+                self.cond.wait(left)
+            self.finished.remove(key)
+            return ''.join(self.chunks.pop(key, []))
+
+    def discard(self, key):
+        now = time.time()
+        with self.cond:
+            if key in self.finished:
+                self.finished.remove(key)
+            else:
+                # the chunks may be coming
+                self.discarded[key] = now
+            self.chunks.pop(key, None)
+            for k, t in self.discarded.items():
+                if t + RESULT_DISCARD_TIMEOUT < now:
+                    del self.discarded[k]
+
+
+def send_result(addr, key, data):
+    sock = env.ctx.socket(zmq.PUSH)
+    sock.setsockopt(zmq.SNDHWM, RESULT_HWM)
+    sock.setsockopt(zmq.LINGER, RESULT_WAIT_TIMEOUT * 1000)
+    sock.connect(addr)
+    try:
+        for i in xrange(0, len(data), RESULT_CHUNK_SIZE):
+            sock.send_multipart([key, data[i:i+RESULT_CHUNK_SIZE]], copy=False)
+        sock.send_multipart([key, ''])
+    finally:
+        sock.close()
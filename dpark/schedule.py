@@ -7,11 +7,11 @@ import threading, Queue
 import time
 import random
 import getpass
-import urllib
 import warnings
 import weakref
 import multiprocessing
 import platform
+import hashlib
 
 import zmq
 
@@ -19,20 +19,32 @@ import pymesos as mesos
 import pymesos.mesos_pb2 as mesos_pb2
 
 from dpark.util import compress, decompress, spawn
-from dpark.dependency import NarrowDependency, ShuffleDependency 
-from dpark.accumulator import Accumulator
+from dpark.serialize import dump_func
+from dpark.dependency import NarrowDependency, ShuffleDependency, OneToOneDependency
+from dpark.accumulator import Accumulator, TaskSpans, TaskMetrics
 from dpark.task import ResultTask, ShuffleMapTask
-from dpark.job import SimpleJob
+from dpark.rdd import PartialSplit
+from dpark.tracker import GetValueMessage, SetValueMessage, DeleteValueMessage
+from dpark.job import SimpleJob, MAX_TASK_MEMORY
 from dpark.env import env
+from dpark import profiler
+from dpark import metrics
+from dpark import trace
+import dpark.conf as conf
 
 logger = logging.getLogger("scheduler")
 
 MAX_FAILED = 3
 EXECUTOR_MEMORY = 64 # cache
 POLL_TIMEOUT = 0.1
+CHECK_INTERVAL = 1
 RESUBMIT_TIMEOUT = 60
+# lineage smaller than it is still pickled into every task
+STAGE_BINARY_MIN_SIZE = 50 << 10
 MAX_IDLE_TIME = 60 * 30
 PLATFORM = platform.python_implementation()
+TASK_STATE_NAMES = dict((getattr(mesos_pb2, name), name)
+    for name in ('TASK_FAILED', 'TASK_KILLED', 'TASK_LOST'))
 
 class TaskEndReason: pass
 class Success(TaskEndReason): pass
@@ -52,6 +64,17 @@ class OtherFailure(TaskEndReason):
     def __str__(self):
         return '<OtherFailure %s>' % self.message
 
+def splittable(rdd):
+    "whether a range of a split of rdd can be computed as a task"
+    while rdd.splittable and not rdd.shouldCache and not rdd.snapshot_path:
+        if not rdd.dependencies:
+            return True
+        if (len(rdd.dependencies) != 1
+                or not isinstance(rdd.dependencies[0], OneToOneDependency)):
+            return False
+        rdd = rdd.dependencies[0].rdd
+    return False
+
 class Stage:
     def __init__(self, rdd, shuffleDep, parents):
         self.id = self.newId()
@@ -60,6 +83,31 @@ class Stage:
         self.parents = parents
         self.numPartitions = len(rdd)
         self.outputLocs = [[] for i in range(self.numPartitions)]
+        self.numAvailableOutputs = 0
+        self.outputBytes = 0 # written by the finished tasks
+        self.splittable = shuffleDep is not None and splittable(rdd)
+        self.splits = {} # partition -> split, after splitting stragglers
+
+    def getSplit(self, partition):
+        split = self.splits.get(partition)
+        if split is None:
+            split = self.rdd.splits[partition]
+        return split
+
+    def splitPartition(self, partition, cut, end, pieces):
+        """ shrink the partition to end at cut, and add at most pieces
+        partitions for [cut, end), returns the added partitions """
+        split = self.getSplit(partition)
+        self.splits[partition] = PartialSplit(split.index, split.begin, cut)
+        size = (end - cut + pieces - 1) / pieces
+        added = []
+        for begin in range(cut, end, size):
+            p = self.numPartitions
+            self.splits[p] = PartialSplit(split.index, begin, min(begin + size, end))
+            self.outputLocs.append([])
+            self.numPartitions += 1
+            added.append(p)
+        return added
 
     def __str__(self):
         return '<Stage(%d) for %s>' % (self.id, self.rdd)
@@ -74,20 +122,31 @@ class Stage:
         return all(self.outputLocs)
 
     def addOutputLoc(self, partition, host):
-        self.outputLocs[partition].append(host)
+        locs = self.outputLocs[partition]
+        if host in locs: # duplicated attempt
+            return
+        if not locs:
+            self.numAvailableOutputs += 1
+        locs.append(host)
 
 #    def removeOutput(self, partition, host):
 #        prev = self.outputLocs[partition]
 #        self.outputLocs[partition] = [h for h in prev if h != host]
 
     def removeHost(self, host):
+        "remove the outputs on host, return the partitions became unavailable"
         becameUnavailable = False
-        for ls in self.outputLocs:
+        lost = []
+        for p, ls in enumerate(self.outputLocs):
             if host in ls:
                 ls.remove(host)
                 becameUnavailable = True
+                if not ls:
+                    self.numAvailableOutputs -= 1
+                    lost.append(p)
         if becameUnavailable:
             logger.info("%s is now unavailable on host %s", self, host)
+        return lost
 
     nextId = 0
     @classmethod
@@ -101,6 +160,7 @@ class Scheduler:
     def runJob(self, rdd, func, partitions, allowLocal): pass
     def clear(self): pass
     def stop(self): pass
+    def setPool(self, name): pass
     def defaultParallelism(self):
         return 2
 
@@ -113,17 +173,82 @@ class CompletionEvent:
 
 
 class DAGScheduler(Scheduler):
+    # fraction of map outputs that must be available before the
+    # stages reading them are submitted, 1.0 means all of them
+    slowStart = 1.0
+    # broadcast the lineage of a stage once, instead of pickling
+    # it into every task
+    useStageBinary = True
+    # split straggling map tasks of text files, see requestSplit()
+    canSplitTasks = False
+    # save the timeline of jobs into it, see dpark/trace.py
+    traceDir = None
 
     def __init__(self):
-        self.completionEvents = Queue.Queue()
+        self.activeJobEvents = set() # event queues of running jobs
+        self.taskEvents = {} # task id -> event queue of its job
+        self.stageOwners = {} # running map stage -> event queue of its job
+        self.dagLock = threading.RLock()
         self.idToStage = weakref.WeakValueDictionary()
         self.shuffleToMapStage = {}
         self.cacheLocs = {}
         self._shutdown = False
+        self._ticker = None
+        self.splitRequests = {} # ctrl key -> (task, pieces)
+        self.splitKeys = {} # stage id -> ctrl keys set in tracker
+        self.splitLock = threading.Lock()
+        self.jobTraces = {} # event queue of job -> JobTrace
+        self.jobStates = {} # event queue of job -> state of it in runJob
+        self.numJobs = 0
 
     def check(self):
         pass
 
+    def requestSplit(self, task, pieces):
+        """ ask the running task to give up the unread part of its split,
+        which will be run as new tasks by runJob() """
+        ctrl = task.split.ctrl
+        with self.splitLock:
+            self.splitRequests[ctrl] = (task, pieces)
+            self.splitKeys.setdefault(task.stageId, set()).add(ctrl)
+            env.trackerClient.call(SetValueMessage(ctrl + ':reply', []))
+            env.trackerClient.call(SetValueMessage(ctrl, [pieces]))
+
+    def cancelSplit(self, task):
+        # the task will be run again, with the split it has
+        ctrl = task.split.ctrl
+        with self.splitLock:
+            if self.splitRequests.pop(ctrl, None) is None:
+                return
+            task.splitting = False
+            env.trackerClient.call(SetValueMessage(ctrl, []))
+            env.trackerClient.call(SetValueMessage(ctrl + ':reply', []))
+
+    def clearSplits(self, stage):
+        # no more requests for the stage, remove its keys from tracker
+        with self.splitLock:
+            for ctrl in self.splitKeys.pop(stage.id, ()):
+                env.trackerClient.call(DeleteValueMessage(ctrl))
+                env.trackerClient.call(DeleteValueMessage(ctrl + ':reply'))
+
+    def startTicker(self):
+        # wake up runJob() periodically for check() and resubmission,
+        # so that it can block on its event queue without polling
+        if self._ticker is not None:
+            return
+        # module globals may be gone while exiting, keep them in closure
+        def tick(sleep=time.sleep, interval=CHECK_INTERVAL):
+            while not self._shutdown:
+                sleep(interval)
+                for events in list(self.activeJobEvents):
+                    if events.empty():
+                        events.put(None)
+        self._ticker = spawn(tick)
+
+    def wakeup(self):
+        for events in list(self.activeJobEvents):
+            events.put(None)
+
     def clear(self):
         self.idToStage.clear()
         self.shuffleToMapStage.clear()
@@ -133,6 +258,7 @@ class DAGScheduler(Scheduler):
 
     def shutdown(self):
         self._shutdown = True
+        self.wakeup()
 
     @property
     def cacheTracker(self):
@@ -145,8 +271,48 @@ class DAGScheduler(Scheduler):
     def submitTasks(self, tasks):
         raise NotImplementedError
 
+    def getStatus(self):
+        "progress of the running jobs, read by the status server"
+        jobs = []
+        for state in sorted(self.jobStates.values(), key=lambda s: s['id']):
+            finished = state['finished']
+            stages = []
+            for name in ('running', 'waiting', 'failed'):
+                for stage in list(state[name]):
+                    stages.append(self.getStageStatus(stage, name, state))
+            jobs.append({'id': state['id'], 'rdd': state['rdd'],
+                'elapsed': time.time() - state['start'],
+                'partitions': len(finished),
+                'finished': len([f for f in finished if f]),
+                'stages': sorted(stages, key=lambda s: s['id'])})
+        shuffles = []
+        for shuffleId, stage in sorted(self.shuffleToMapStage.items()):
+            shuffles.append({'id': shuffleId, 'stage': stage.id,
+                'maps': stage.numPartitions, 'available': stage.numAvailableOutputs,
+                'bytes': stage.outputBytes})
+        return {'jobs': jobs, 'shuffles': shuffles}
+
+    def getStageStatus(self, stage, name, state):
+        available = stage.numAvailableOutputs
+        if stage is state['finalStage']:
+            available = len([f for f in state['finished'] if f])
+        return {'id': stage.id, 'rdd': str(stage.rdd), 'state': name,
+            'partitions': stage.numPartitions, 'available': available,
+            'pendingTasks': len(state['pendingTasks'].get(stage, ()))}
+
+    def getTrace(self, task):
+        events = self.taskEvents.get(task.id)
+        return events is not None and self.jobTraces.get(events)
+
     def taskEnded(self, task, reason, result, accumUpdates):
-        self.completionEvents.put(CompletionEvent(task, reason, result, accumUpdates))
+        events = self.taskEvents.pop(task.id, None)
+        if events is None: # job has gone
+            return
+        jobTrace = self.jobTraces.get(events)
+        if jobTrace:
+            jobTrace.taskEnded(task, reason,
+                accumUpdates and accumUpdates.pop(TaskSpans.id, None))
+        events.put(CompletionEvent(task, reason, result, accumUpdates))
 
     def getCacheLocs(self, rdd):
         return self.cacheLocs.get(rdd.id, [[] for i in range(len(rdd))])
@@ -208,25 +374,33 @@ class DAGScheduler(Scheduler):
     def runJob(self, finalRdd, func, partitions, allowLocal):
         outputParts = list(partitions)
         numOutputParts = len(partitions)
-        finalStage = self.newStage(finalRdd, None)
         results = [None]*numOutputParts
         finished = [None]*numOutputParts
         lastFinished = 0
         numFinished = 0
 
+        events = Queue.Queue()
         waiting = set()
         running = set()
+        borrowed = set() # running stages submitted by other jobs
         failed = set()
+        pipelined = set() # running map stages with children started
+        lostOutputs = {} # running map stage -> partitions lost by fetch failures
         pendingTasks = {}
+        binaries = {}
+        stageMetrics = {} # stage -> metrics of finished tasks
         lastFetchFailureTime = 0
 
-        self.updateCacheLocs()
+        with self.dagLock:
+            finalStage = self.newStage(finalRdd, None)
+            self.updateCacheLocs()
+            missing = self.getMissingParentStages(finalStage)
 
         logger.debug("Final stage: %s, %d", finalStage, numOutputParts)
         logger.debug("Parents of final stage: %s", finalStage.parents)
-        logger.debug("Missing parents: %s", self.getMissingParentStages(finalStage))
+        logger.debug("Missing parents: %s", missing)
 
-        if allowLocal and (not finalStage.parents or not self.getMissingParentStages(finalStage)) and numOutputParts == 1:
+        if allowLocal and (not finalStage.parents or not missing) and numOutputParts == 1:
             split = finalRdd.splits[outputParts[0]]
             yield func(finalRdd.iterator(split))
             return
@@ -236,14 +410,46 @@ class DAGScheduler(Scheduler):
             if stage not in waiting and stage not in running:
                 missing = self.getMissingParentStages(stage)
                 if not missing:
-                    submitMissingTasks(stage)
-                    running.add(stage)
+                    runStage(stage)
                 else:
                     for parent in missing:
                         submitStage(parent)
                     waiting.add(stage)
 
-        def submitMissingTasks(stage):
+        def runStage(stage):
+            running.add(stage)
+            if self.stageOwners.get(stage, events) is not events:
+                logger.debug("%s is running in other job, wait for it", stage)
+                borrowed.add(stage)
+            else:
+                submitMissingTasks(stage)
+
+        def getStageBinary(stage):
+            if not self.useStageBinary:
+                return
+            if stage not in binaries:
+                from dpark.broadcast import TheBroadcast
+                if stage == finalStage:
+                    value = (finalRdd, dump_func(func))
+                else:
+                    dep = stage.shuffleDep
+                    value = (stage.rdd, dep.aggregator, dep.partitioner)
+                size = len(cPickle.dumps(value, -1))
+                if size < STAGE_BINARY_MIN_SIZE:
+                    binaries[stage] = None
+                else:
+                    logger.debug("broadcast lineage of %s: %d bytes", stage, size)
+                    binaries[stage] = TheBroadcast(value, False)
+            return binaries[stage]
+
+        def getTaskSplit(stage, p):
+            split = stage.getSplit(p)
+            if self.canSplitTasks and stage.splittable and self.slowStart >= 1:
+                split = PartialSplit(split.index, split.begin, split.end)
+                split.ctrl = 'split:%d:%d' % (stage.id, p)
+            return split
+
+        def submitMissingTasks(stage, partitions=None):
             myPending = pendingTasks.setdefault(stage, set())
             tasks = []
             have_prefer = True
@@ -260,84 +466,263 @@ class DAGScheduler(Scheduler):
                         tasks.append(ResultTask(finalStage.id, finalRdd,
                             func, part, locs, i))
             else:
-                for p in range(stage.numPartitions):
+                self.stageOwners[stage] = events
+                if partitions is None:
+                    partitions = range(stage.numPartitions)
+                for p in partitions:
                     if not stage.outputLocs[p]:
+                        split = getTaskSplit(stage, p)
                         if have_prefer:
-                            locs = self.getPreferredLocs(stage.rdd, p)
+                            locs = stage.rdd.preferredLocations(split)
                             if not locs:
                                 have_prefer = False
                         else:
                             locs = []
                         tasks.append(ShuffleMapTask(stage.id, stage.rdd,
-                            stage.shuffleDep, p, locs))
+                            stage.shuffleDep, p, locs, split))
+            if stage in pipelined:
+                # lost outputs, the started children are waiting for them
+                for t in tasks:
+                    t.urgent = True
             logger.debug("add to pending %s tasks", len(tasks))
             myPending |= set(t.id for t in tasks)
+            binary = tasks and getStageBinary(stage)
+            for t in tasks:
+                t.binary = binary
+                self.taskEvents[t.id] = events
+                if jobTrace:
+                    jobTrace.taskSubmitted(t)
+            if jobTrace and tasks:
+                jobTrace.stageSubmitted(stage, len(tasks))
             self.submitTasks(tasks)
 
-        submitStage(finalStage)
+        def submitNewlyRunnableStages():
+            self.updateCacheLocs()
+            newlyRunnable = set(stage for stage in waiting if not self.getMissingParentStages(stage))
+            waiting.difference_update(newlyRunnable)
+            logger.debug("newly runnable: %s, %s", waiting, newlyRunnable)
+            for stage in newlyRunnable:
+                runStage(stage)
 
-        while numFinished != numOutputParts:
-            try:
-                evt = self.completionEvents.get(False)
-            except Queue.Empty:
-                self.check()
-                if self._shutdown:
-                    sys.exit(1)
-
-                if failed and time.time() > lastFetchFailureTime + RESUBMIT_TIMEOUT:
-                    self.updateCacheLocs()
-                    for stage in failed:
-                        logger.info("Resubmitting failed stages: %s", stage)
-                        submitStage(stage)
-                    failed.clear()
-                else:
-                    time.sleep(0.1)
-                continue
-               
-            task, reason = evt.task, evt.reason
-            stage = self.idToStage[task.stageId]
-            if stage not in pendingTasks: # stage from other job
-                continue
-            logger.debug("remove from pedding %s from %s", task, stage)
-            pendingTasks[stage].remove(task.id)
-            if isinstance(reason, Success):
-                Accumulator.merge(evt.accumUpdates)
-                if isinstance(task, ResultTask):
-                    finished[task.outputId] = True
-                    numFinished += 1
-                    results[task.outputId] = evt.result
-                    while lastFinished < numOutputParts and finished[lastFinished]:
-                        yield results[lastFinished]
-                        results[lastFinished] = None
-                        lastFinished += 1
-
-                elif isinstance(task, ShuffleMapTask):
-                    stage = self.idToStage[task.stageId]
-                    stage.addOutputLoc(task.partition, evt.result)
-                    if not pendingTasks[stage] and all(stage.outputLocs):
-                        logger.debug("%s finished; looking for newly runnable stages", stage)
-                        running.remove(stage)
-                        if stage.shuffleDep != None:
-                            self.mapOutputTracker.registerMapOutputs(
-                                    stage.shuffleDep.shuffleId,
-                                    [l[-1] for l in stage.outputLocs])
+        def submitSlowStartStages():
+            for stage in list(waiting):
+                missing = self.getMissingParentStages(stage)
+                if not all(p in running and p not in borrowed and p.numAvailableOutputs
+                        >= p.numPartitions * self.slowStart for p in missing):
+                    continue
+                for p in missing:
+                    if p not in pipelined:
+                        pipelined.add(p)
+                        self.mapOutputTracker.registerMapOutputs(
+                                p.shuffleDep.shuffleId,
+                                [l and l[-1] or None for l in p.outputLocs])
+                logger.debug("slow start %s before %s finished", stage, missing)
+                waiting.remove(stage)
+                runStage(stage)
+
+        def resolveSplit(task, stage):
+            # the task has given up [cut, end) if it replied
+            ctrl = task.split.ctrl
+            with self.splitLock:
+                reply = env.trackerClient.call(GetValueMessage(ctrl + ':reply'))
+                if not reply or ctrl not in self.splitRequests:
+                    return False
+                _, pieces = self.splitRequests.pop(ctrl)
+                env.trackerClient.call(SetValueMessage(ctrl + ':reply', []))
+                task.splitting = False
+                cut, end = reply
+                if cut >= end:
+                    logger.debug("%s refused to split", task)
+                    return True
+                added = stage.splitPartition(task.partition, cut, end, pieces)
+                task.split = getTaskSplit(stage, task.partition)
+            logger.info("split %s at %d, run the rest in %d new tasks",
+                task, cut, len(added))
+            submitMissingTasks(stage, added)
+            return True
+
+        def checkSplits():
+            for ctrl, (task, _) in self.splitRequests.items():
+                stage = self.idToStage.get(task.stageId)
+                if (stage in running and stage not in pipelined
+                        and self.stageOwners.get(stage) is events):
+                    resolveSplit(task, stage)
+
+        def checkBorrowedStages():
+            for stage in list(borrowed):
+                if stage.isAvailable:
+                    logger.debug("%s finished in other job", stage)
+                    borrowed.remove(stage)
+                    running.remove(stage)
+                    submitNewlyRunnableStages()
+                elif stage not in self.stageOwners:
+                    # the other job has gone
+                    borrowed.remove(stage)
+                    running.remove(stage)
+                    submitStage(stage)
+
+        jobTrace = None
+        with self.dagLock:
+            self.numJobs += 1
+            # shared with getStatus(), only the references are kept
+            self.jobStates[events] = {'id': self.numJobs, 'rdd': str(finalRdd),
+                'start': time.time(), 'finalStage': finalStage,
+                'finished': finished, 'running': running, 'waiting': waiting,
+                'failed': failed, 'pendingTasks': pendingTasks}
+            if self.traceDir:
+                jobTrace = trace.JobTrace(self.numJobs, str(finalRdd))
+                self.jobTraces[events] = jobTrace
+
+        self.activeJobEvents.add(events)
+        try:
+            with self.dagLock:
+                submitStage(finalStage)
+            self.startTicker()
+            lastCheckTime = time.time()
+
+            while numFinished != numOutputParts:
+                evt = events.get()
+                ready = []
+
+                self.dagLock.acquire()
+                try:
+                    now = time.time()
+                    if evt is None or now > lastCheckTime + CHECK_INTERVAL:
+                        self.check()
+                        if self.splitRequests:
+                            checkSplits()
+                        lastCheckTime = now
+                    if self._shutdown:
+                        sys.exit(1)
+
+                    if failed and now > lastFetchFailureTime + RESUBMIT_TIMEOUT:
                         self.updateCacheLocs()
-                        newlyRunnable = set(stage for stage in waiting if not self.getMissingParentStages(stage))
-                        waiting -= newlyRunnable
-                        running |= newlyRunnable
-                        logger.debug("newly runnable: %s, %s", waiting, newlyRunnable)
-                        for stage in newlyRunnable:
-                            submitMissingTasks(stage)
-            elif isinstance(reason, FetchFailed):
-                if stage in running:
-                    waiting.add(stage)
-                mapStage = self.shuffleToMapStage[reason.shuffleId]
-                mapStage.removeHost(reason.serverUri)
-                failed.add(mapStage)
-                lastFetchFailureTime = time.time()
-            else:
-                logger.error("task %s failed: %s %s %s", task, reason, type(reason), reason.message)
-                raise Exception(reason.message)
+                        for stage in failed:
+                            logger.info("Resubmitting failed stages: %s", stage)
+                            if jobTrace:
+                                jobTrace.instant('resubmit stage %d' % stage.id)
+                            lost = lostOutputs.pop(stage, None)
+                            if stage in running and stage not in borrowed:
+                                # map stage started its children by slow start,
+                                # submitStage() does nothing for it
+                                lost = sorted(p for p in lost or [] if not stage.outputLocs[p])
+                                if lost:
+                                    submitMissingTasks(stage, lost)
+                            else:
+                                submitStage(stage)
+                        failed.clear()
+
+                    if borrowed:
+                        checkBorrowedStages()
+
+                    if evt is None: # tick or wakeup
+                        continue
+
+                    task, reason = evt.task, evt.reason
+                    stage = self.idToStage[task.stageId]
+                    if stage not in pendingTasks: # stage from other job
+                        continue
+                    logger.debug("remove from pedding %s from %s", task, stage)
+                    if task.id not in pendingTasks[stage]:
+                        logger.debug("ignore duplicated result of %s", task)
+                        continue
+                    pendingTasks[stage].remove(task.id)
+                    if isinstance(reason, Success):
+                        m = evt.accumUpdates.pop(TaskMetrics.id, None)
+                        if m:
+                            stageMetrics.setdefault(stage, []).append(m)
+                        Accumulator.merge(evt.accumUpdates)
+                        if isinstance(task, ResultTask):
+                            finished[task.outputId] = True
+                            numFinished += 1
+                            results[task.outputId] = evt.result
+                            while lastFinished < numOutputParts and finished[lastFinished]:
+                                ready.append(results[lastFinished])
+                                results[lastFinished] = None
+                                lastFinished += 1
+
+                        elif isinstance(task, ShuffleMapTask):
+                            stage = self.idToStage[task.stageId]
+                            if m:
+                                stage.outputBytes += m.get('shuffleWriteBytes', 0)
+                            if (getattr(task, 'splitting', False)
+                                    and not resolveSplit(task, stage)):
+                                self.cancelSplit(task) # finished before asked
+                            stage.addOutputLoc(task.partition, evt.result)
+                            if stage in pipelined:
+                                self.mapOutputTracker.registerMapOutput(
+                                        stage.shuffleDep.shuffleId,
+                                        task.partition, evt.result)
+                            if not pendingTasks[stage] and all(stage.outputLocs):
+                                logger.debug("%s finished; looking for newly runnable stages", stage)
+                                running.remove(stage)
+                                if jobTrace:
+                                    jobTrace.stageFinished(stage)
+                                metrics.report(stage, stageMetrics.pop(stage, None))
+                                pipelined.discard(stage)
+                                if stage.id in self.splitKeys:
+                                    self.clearSplits(stage)
+                                if stage.shuffleDep != None:
+                                    self.mapOutputTracker.registerMapOutputs(
+                                            stage.shuffleDep.shuffleId,
+                                            [l[-1] for l in stage.outputLocs])
+                                if self.stageOwners.get(stage) is events:
+                                    del self.stageOwners[stage]
+                                    self.wakeup() # jobs waiting for it
+                                submitNewlyRunnableStages()
+                            elif (self.slowStart < 1 and stage in running
+                                    and stage.numAvailableOutputs >= stage.numPartitions * self.slowStart):
+                                submitSlowStartStages()
+                    elif isinstance(reason, FetchFailed):
+                        if stage in running:
+                            waiting.add(stage)
+                        mapStage = self.shuffleToMapStage[reason.shuffleId]
+                        lost = mapStage.removeHost(reason.serverUri)
+                        if mapStage in running:
+                            lostOutputs.setdefault(mapStage, set()).update(lost)
+                        failed.add(mapStage)
+                        lastFetchFailureTime = time.time()
+                        if jobTrace:
+                            jobTrace.instant('fetch failed', {'from': reason.serverUri,
+                                'shuffle': reason.shuffleId, 'map': reason.mapId})
+                    else:
+                        logger.error("task %s failed: %s %s %s", task, reason, type(reason), reason.message)
+                        raise Exception(reason.message)
+                finally:
+                    self.dagLock.release()
+
+                for r in ready:
+                    yield r
+
+            metrics.report(finalStage, stageMetrics.pop(finalStage, None))
+
+        finally:
+            for b in binaries.values():
+                if b is not None:
+                    b.clear()
+            if profiler.is_profiling():
+                profiler.report(sorted(pendingTasks, key=lambda s: s.id))
+            if jobTrace:
+                jobTrace.stageFinished(finalStage)
+                jobTrace.save(os.path.join(self.traceDir,
+                    'dpark-%d-job%d.json' % (os.getpid(), jobTrace.jobId)))
+            with self.dagLock:
+                self.activeJobEvents.discard(events)
+                self.jobTraces.pop(events, None)
+                self.jobStates.pop(events, None)
+                for task, _ in self.splitRequests.values():
+                    if self.taskEvents.get(task.id) is events:
+                        self.cancelSplit(task)
+                for stage in pendingTasks:
+                    if stage.id in self.splitKeys:
+                        self.clearSplits(stage)
+                for stage, owner in self.stageOwners.items():
+                    if owner is events:
+                        del self.stageOwners[stage]
+                for tid, owner in self.taskEvents.items():
+                    if owner is events:
+                        del self.taskEvents[tid]
+            self.wakeup()
 
         assert not any(results)
         return
@@ -350,10 +735,17 @@ def run_task(task, aid):
     logger.debug("Running task %r", task)
     try:
         Accumulator.clear()
-        result = task.run(aid)
+        start = time.time()
+        if profiler.is_profiling():
+            result = profiler.run_task(task, aid)
+        else:
+            result = task.run(aid)
+        trace.record('run', start)
+        TaskMetrics.add({'runTime': time.time() - start})
         accumUpdates = Accumulator.values()
         return (task.id, Success(), result, accumUpdates)
     except Exception, e:
+        Accumulator.values() # drop the updates
         logger.error("error in task %s", task)
         import traceback
         traceback.print_exc()
@@ -362,17 +754,46 @@ def run_task(task, aid):
 
 class LocalScheduler(DAGScheduler):
     attemptId = 0
+    useStageBinary = False # tasks are not serialized
+
+    def __init__(self, threads=1):
+        DAGScheduler.__init__(self)
+        self.threads = threads
+        self.threadPool = None
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            self.threadPool = ThreadPool(threads)
+
     def nextAttempId(self):
         self.attemptId += 1
         return self.attemptId
 
+    def isThreadSafe(self, rdd):
+        if not rdd.threadSafe:
+            return False
+        return all(self.isThreadSafe(dep.rdd) for dep in rdd.dependencies
+                if isinstance(dep, NarrowDependency))
+
     def submitTasks(self, tasks):
         logger.debug("submit tasks %s in LocalScheduler", tasks)
+        if self.threadPool and tasks and self.isThreadSafe(tasks[0].rdd):
+            idToTask = dict((t.id, t) for t in tasks)
+            def callback((tid, reason, result, update)):
+                self.taskEnded(idToTask.pop(tid), reason, result, update)
+            for task in tasks:
+                self.threadPool.apply_async(run_task,
+                    [task, self.nextAttempId()], callback=callback)
+            return
+
         for task in tasks:
 #            task = cPickle.loads(cPickle.dumps(task, -1))
             _, reason, result, update = run_task(task, self.nextAttempId())
             self.taskEnded(task, reason, result, update)
 
+    def stop(self):
+        if self.threadPool:
+            self.threadPool.terminate()
+
 def run_task_in_process(task, tid, environ):
     from dpark.env import env
     env.start(False, environ)
@@ -384,6 +805,8 @@ def run_task_in_process(task, tid, environ):
         sys.exit(0)
 
 class MultiProcessScheduler(LocalScheduler):
+    useStageBinary = True
+
     def __init__(self, threads):
         LocalScheduler.__init__(self)
         self.threads = threads
@@ -396,15 +819,15 @@ class MultiProcessScheduler(LocalScheduler):
 
         logger.info("Got a job with %d tasks: %s", len(tasks), tasks[0].rdd)
         
-        total, self.finished, start = len(tasks), 0, time.time()
+        total, finished, start = len(tasks), [0], time.time()
         def callback(args):
             logger.debug("got answer: %s", args)
             tid, reason, result, update = args
             task = self.tasks.pop(tid)
-            self.finished += 1
+            finished[0] += 1
             logger.info("Task %s finished (%d/%d)        \x1b[1A",
-                tid, self.finished, total)
-            if self.finished == total:
+                tid, finished[0], total)
+            if finished[0] == total:
                 logger.info("Job finished in %.1f seconds" + " "*20,  time.time() - start)
             self.taskEnded(task, reason, result, update)
 
@@ -421,6 +844,119 @@ class MultiProcessScheduler(LocalScheduler):
         logger.debug("process pool stopped")
 
 
+def reinit_logging_locks():
+    # the locks may be held by other threads of the driver at fork,
+    # which do not exist in the child
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        h = ref()
+        if h is not None:
+            h.createLock()
+
+def run_tasks_in_fork(tasks, indices, lock, output):
+    reinit_logging_locks()
+    # forked from the driver, the env of it can not be used any more
+    from dpark.env import env
+    environ = dict(env.environ)
+    env.started = False
+    env.start(False, environ)
+
+    try:
+        while True:
+            item = indices.get()
+            if item is None:
+                break
+            i, aid = item
+            r = run_task(tasks[i], aid)
+            with lock:
+                try:
+                    output.send(r)
+                except Exception, e:
+                    output.send((r[0], OtherFailure("send result failed: %s" % e),
+                        None, None))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+class ForkScheduler(LocalScheduler):
+    """ run the tasks of a stage in processes forked from the driver
+
+    Workers are forked after the tasks are built, so they share the RDD
+    graph and broadcast values with the driver (copy-on-write), only the
+    indices of tasks and the results go through pipes.
+
+    The driver has other threads running (ticker, tracker, fetchers), so
+    the workers only use what they create after fork: a new env, and the
+    logging locks are re-created. Forks are serialized by forkLock, and
+    the logging lock is held during fork, so that the loggers are not
+    being changed.
+    """
+    forkLock = threading.Lock()
+
+    def __init__(self, threads):
+        LocalScheduler.__init__(self)
+        self.threads = threads or multiprocessing.cpu_count()
+        self.workers = set()
+
+    def submitTasks(self, tasks):
+        if not tasks:
+            return
+
+        logger.info("Got a job with %d tasks: %s", len(tasks), tasks[0].rdd)
+        indices = multiprocessing.Queue()
+        for i in range(len(tasks)):
+            indices.put((i, self.nextAttempId()))
+        n = min(self.threads, len(tasks))
+        for i in range(n):
+            indices.put(None)
+
+        reader, writer = multiprocessing.Pipe(False)
+        lock = multiprocessing.Lock()
+        workers = [multiprocessing.Process(target=run_tasks_in_fork,
+                        args=(tasks, indices, lock, writer))
+                    for i in range(n)]
+        with self.forkLock:
+            logging._acquireLock()
+            try:
+                for w in workers:
+                    w.daemon = True
+                    w.start()
+            finally:
+                logging._releaseLock()
+        writer.close()
+        self.workers.update(workers)
+        spawn(self.collect, tasks, workers, reader)
+
+    def collect(self, tasks, workers, reader):
+        start = time.time()
+        remain = dict((t.id, t) for t in tasks)
+        while remain:
+            try:
+                if not reader.poll(1):
+                    continue
+                tid, reason, result, update = reader.recv()
+            except (EOFError, IOError):
+                break # all workers exited
+            task = remain.pop(tid)
+            logger.info("Task %s finished (%d/%d)        \x1b[1A",
+                tid, len(tasks) - len(remain), len(tasks))
+            self.taskEnded(task, reason, result, update)
+        reader.close()
+
+        for w in workers:
+            w.join()
+            self.workers.discard(w)
+        for task in remain.values():
+            self.taskEnded(task, OtherFailure("worker exited with %s"
+                % [w.exitcode for w in workers]), None, None)
+        if not remain:
+            logger.info("Job finished in %.1f seconds" + " "*20,  time.time() - start)
+
+    def stop(self):
+        for w in list(self.workers):
+            w.terminate()
+        logger.debug("forked workers stopped")
+
+
 def profile(f):
     def func(*args, **kwargs):
         path = '/tmp/worker-%s.prof' % os.getpid()
@@ -444,10 +980,140 @@ def safe(f):
         return r
     return _
 
+class Pool:
+    """ a group of jobs sharing resources in MesosScheduler
+
+    Pools with higher priority are served first, then the pools running
+    less tasks than their minShare, then the others by running tasks
+    per weight. Jobs inside a pool are served in submission order
+    ('fifo') or by running tasks ('fair'), after the urgent ones.
+    """
+    def __init__(self, name, weight=1, minShare=0, priority=0, mode='fifo'):
+        assert mode in ('fifo', 'fair'), 'invalid mode of pool %s: %s' % (name, mode)
+        assert weight > 0, 'weight of pool %s must be positive' % name
+        self.name = name
+        self.weight = weight
+        self.minShare = minShare
+        self.priority = priority
+        self.mode = mode
+        self.jobs = []
+        self.numJobs = 0
+        self.totalWait = 0
+        self.maxWait = 0
+
+    def __str__(self):
+        return '<Pool %s>' % self.name
+
+    def key(self, running):
+        needy = running < self.minShare
+        if needy:
+            share = float(running) / self.minShare
+        else:
+            share = float(running) / self.weight
+        return (-self.priority, not needy, share, self.name)
+
+    def sortedJobs(self, running):
+        if self.mode == 'fair':
+            return sorted(self.jobs, key=lambda j: (not j.urgent, running(j), j.id))
+        return self.jobs
+
+    def addWait(self, wait):
+        self.numJobs += 1
+        self.totalWait += wait
+        self.maxWait = max(self.maxWait, wait)
+
+    def report(self):
+        if self.numJobs:
+            logger.info("pool %s: %d jobs, waited %.1fs in average, %.1fs at most",
+                self.name, self.numJobs, self.totalWait / self.numJobs, self.maxWait)
+
+# request this much more memory than the peak of previous runs
+MEMORY_HISTORY_MARGIN = 1.2
+# a smaller peak only lowers the kept one by this ratio each run
+MEMORY_HISTORY_DECAY = 0.9
+
+def func_location(f):
+    code = getattr(f, 'func_code', None)
+    if code is None:
+        return ''
+    return '%s:%s:%d' % (os.path.basename(code.co_filename),
+            code.co_name, code.co_firstlineno)
+
+def stage_signature(task):
+    """ signature of the lineage of a stage, stable between runs
+
+    It is made of the script, the kind of RDDs in the stage and where
+    their functions are defined, so the size of the input does not
+    change it.
+    """
+    parts = [os.path.realpath(sys.argv[0]), task.__class__.__name__]
+    if isinstance(task, ResultTask):
+        parts.append(func_location(task.func))
+    visited = set()
+    def visit(rdd):
+        if rdd.id in visited:
+            return
+        visited.add(rdd.id)
+        parts.append('%s(%s)' % (rdd.__class__.__name__,
+            func_location(getattr(rdd, 'func', None))))
+        for dep in rdd.dependencies:
+            if isinstance(dep, ShuffleDependency):
+                parts.append('shuffle(%d)' % len(rdd))
+            else:
+                visit(dep.rdd)
+    visit(task.rdd)
+    return hashlib.md5('|'.join(parts)).hexdigest()
+
+class MemoryHistory:
+    """ peak memory (MB) of the tasks in stages of previous runs
+
+    It is kept in a local file, keyed by stage_signature(), and used to
+    size the memory requests of the same stages in later runs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.history = {}
+        self.changed = False
+        if path and os.path.exists(path):
+            try:
+                self.history = marshal.load(open(path, 'rb'))
+            except Exception, e:
+                logger.warning("load memory history from %s failed: %s", path, e)
+
+    def get(self, sig):
+        peak = self.history.get(sig)
+        if peak:
+            return min(int(peak * MEMORY_HISTORY_MARGIN) + 1, MAX_TASK_MEMORY)
+
+    def update(self, sig, peak):
+        if not peak:
+            return
+        # one run on a small input should not shrink it too much
+        peak = max(peak, int(self.history.get(sig, 0) * MEMORY_HISTORY_DECAY))
+        if self.history.get(sig) != peak:
+            self.history[sig] = peak
+            self.changed = True
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        try:
+            d = os.path.dirname(self.path)
+            if d and not os.path.exists(d):
+                os.makedirs(d)
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                marshal.dump(self.history, f)
+            os.rename(tmp, self.path)
+            self.changed = False
+        except Exception, e:
+            logger.warning("save memory history to %s failed: %s", self.path, e)
+
 def int2ip(n):
     return "%d.%d.%d.%d" % (n & 0xff, (n>>8)&0xff, (n>>16)&0xff, n>>24)
 
 class MesosScheduler(DAGScheduler):
+    canSplitTasks = True
 
     def __init__(self, master, options):
         DAGScheduler.__init__(self)
@@ -466,12 +1132,23 @@ class MesosScheduler(DAGScheduler):
         self.driver = None
         self.out_logger = None
         self.err_logger = None
+        self.resultServer = None
         self.lock = threading.RLock()
+        self.registeredCond = threading.Condition(self.lock)
+        self.local = threading.local()
+        self.pools = {}
+        for name, params in getattr(conf, 'SCHEDULER_POOLS', {}).items():
+            self.pools[name] = Pool(name, **params)
+        self.memoryHistory = MemoryHistory(os.path.expanduser(
+            getattr(conf, 'MEMORY_HISTORY_FILE', '')))
         self.init_job()
 
     def init_job(self):
         self.activeJobs = {}
         self.activeJobsQueue = []
+        self.jobPool = {}
+        for pool in self.pools.values():
+            pool.jobs = []
         self.taskIdToJobId = {}
         self.taskIdToSlaveId = {}
         self.jobTasks = {}
@@ -487,6 +1164,11 @@ class MesosScheduler(DAGScheduler):
             self.out_logger = self.start_logger(sys.stdout) 
         if not self.err_logger:
             self.err_logger = self.start_logger(sys.stderr)
+        if not self.resultServer:
+            from dpark.result import ResultServer
+            self.resultServer = ResultServer()
+            self.resultServer.start()
+            env.register('ResultAddr', self.resultServer.addr)
 
     def start_driver(self):
         name = '[dpark@%s] ' % socket.gethostname()
@@ -537,6 +1219,7 @@ class MesosScheduler(DAGScheduler):
     @safe
     def registered(self, driver, frameworkId, masterInfo):
         self.isRegistered = True
+        self.registeredCond.notifyAll()
         logger.debug("connect to master %s:%s(%s), registered as %s",
             int2ip(masterInfo.ip), masterInfo.port, masterInfo.id,
             frameworkId.value)
@@ -577,24 +1260,53 @@ class MesosScheduler(DAGScheduler):
             self.task_per_node, self.out_logger, self.err_logger, self.logLevel, env.environ))
         return info
 
+    def setPool(self, name):
+        # jobs submitted by current thread will go into this pool
+        self.local.pool = name
+
+    def getPool(self, name):
+        if name not in self.pools:
+            self.pools[name] = Pool(name)
+        return self.pools[name]
+
     @safe
     def submitTasks(self, tasks):
         if not tasks:
             return
 
-        job = SimpleJob(self, tasks, self.cpus, tasks[0].rdd.mem or self.mem)
+        mem = tasks[0].rdd.mem or self.mem
+        sig = stage_signature(tasks[0])
+        learned = self.memoryHistory.get(sig)
+        if learned:
+            logger.debug("use memory %dMB learned from history instead of %dMB",
+                learned, mem)
+            if mem != self.mem or getattr(self.options, 'explicit_mem', False):
+                # by taskMemory or -M
+                mem = max(mem, learned)
+            else:
+                mem = learned
+        job = SimpleJob(self, tasks, self.cpus, mem)
+        job.signature = sig
+        job.urgent = getattr(tasks[0], 'urgent', False)
         self.activeJobs[job.id] = job
         self.activeJobsQueue.append(job)
         self.jobTasks[job.id] = set()
-        logger.info("Got job %d with %d tasks: %s", job.id, len(tasks), tasks[0].rdd)
+        pool = self.getPool(getattr(self.local, 'pool', None) or self.options.pool)
+        if job.urgent:
+            # the reduce tasks started by slow start are holding the
+            # resources, launch the lost map outputs before more of them
+            pool.jobs.insert(sum(j.urgent for j in pool.jobs), job)
+        else:
+            pool.jobs.append(job)
+        self.jobPool[job.id] = pool
+        logger.info("Got job %d with %d tasks in pool %s: %s", job.id, len(tasks),
+            pool.name, tasks[0].rdd)
       
         need_revive = self.started
         if not self.started:
             self.start_driver()
         while not self.isRegistered:
-            self.lock.release()
-            time.sleep(0.01)
-            self.lock.acquire()
+            self.registeredCond.wait()
         
         if need_revive:
             self.requestMoreResources()
@@ -622,38 +1334,32 @@ class MesosScheduler(DAGScheduler):
         logger.debug("get %d offers (%s cpus, %s mem), %d jobs",
             len(offers), sum(cpus), sum(mems), len(self.activeJobs))
 
+        usable = [i for i,o in enumerate(offers)
+                  if (not self.group or (self.getAttribute(o.attributes, 'group') or 'none') in self.group)
+                  and self.canLaunch(o, cpus[i], mems[i])]
         tasks = {}
-        for job in self.activeJobsQueue:
-            while True:
-                launchedTask = False
-                for i,o in enumerate(offers):
-                    sid = o.slave_id.value
-                    if self.group and (self.getAttribute(o.attributes, 'group') or 'none') not in self.group:
-                        continue
-                    if self.slaveFailed.get(sid, 0) >= MAX_FAILED:
-                        continue
-                    if self.slaveTasks.get(sid, 0) >= self.task_per_node:
-                        continue
-                    if mems[i] < self.mem or cpus[i]+1e-4 < self.cpus:
-                        continue
-                    t = job.slaveOffer(str(o.hostname), cpus[i], mems[i])
-                    if not t:
-                        continue
-                    task = self.createTask(o, job, t, cpus[i])
-                    tasks.setdefault(o.id.value, []).append(task)
-
-                    logger.debug("dispatch %s into %s", t, o.hostname)
-                    tid = task.task_id.value
-                    self.jobTasks[job.id].add(tid)
-                    self.taskIdToJobId[tid] = job.id
-                    self.taskIdToSlaveId[tid] = sid
-                    self.slaveTasks[sid] = self.slaveTasks.get(sid, 0)  + 1 
-                    cpus[i] -= min(cpus[i], t.cpus)
-                    mems[i] -= t.mem
-                    launchedTask = True
-
-                if not launchedTask:
-                    break
+        launched = 0
+        # jobs having no task for any of the offers, they will not have
+        # one later in this round, offers are only getting smaller
+        declined = set()
+        # launch one task at a time, then re-sort the jobs, so that
+        # offers are split across pools by their priority and share
+        while usable:
+            pos = launched % len(usable)
+            order = usable[pos:] + usable[:pos]
+            for job in self.sortedJobs():
+                if job.id in declined:
+                    continue
+                i = self.launchTask(job, offers, order, cpus, mems, tasks)
+                if i is None:
+                    declined.add(job.id)
+                    continue
+                launched += 1
+                if not self.canLaunch(offers[i], cpus[i], mems[i]):
+                    usable.remove(i)
+                break
+            else:
+                break
 
         used = time.time() - start
         if used > 10:
@@ -666,6 +1372,47 @@ class MesosScheduler(DAGScheduler):
         logger.debug("reply with %d tasks, %s cpus %s mem left", 
             sum(len(ts) for ts in tasks.values()), sum(cpus), sum(mems))
    
+    def sortedJobs(self):
+        running = lambda job: len(self.jobTasks[job.id])
+        pools = [p for p in self.pools.values() if p.jobs]
+        pools.sort(key=lambda p: p.key(sum(running(j) for j in p.jobs)))
+        for pool in pools:
+            for job in pool.sortedJobs(running):
+                yield job
+
+    def canLaunch(self, o, cpus, mems):
+        sid = o.slave_id.value
+        return (self.slaveFailed.get(sid, 0) < MAX_FAILED
+            and self.slaveTasks.get(sid, 0) < self.task_per_node
+            and mems >= self.mem and cpus + 1e-4 >= self.cpus)
+
+    def launchTask(self, job, offers, order, cpus, mems, tasks):
+        "launch a task of job in the first offer it accepts, return its index"
+        for i in order:
+            o = offers[i]
+            sid = o.slave_id.value
+            rack = self.getAttribute(o.attributes, conf.MESOS_RACK_ATTRIBUTE)
+            t = job.slaveOffer(str(o.hostname), cpus[i], mems[i], rack)
+            if not t:
+                continue
+            task = self.createTask(o, job, t, cpus[i])
+            tasks.setdefault(o.id.value, []).append(task)
+            jobTrace = self.getTrace(t)
+            if jobTrace:
+                jobTrace.taskLaunched(t, str(o.hostname))
+
+            logger.debug("dispatch %s into %s", t, o.hostname)
+            if job.tasksLaunched == 1 and t.tried == 1:
+                self.jobPool[job.id].addWait(time.time() - job.start)
+            tid = task.task_id.value
+            self.jobTasks[job.id].add(tid)
+            self.taskIdToJobId[tid] = job.id
+            self.taskIdToSlaveId[tid] = sid
+            self.slaveTasks[sid] = self.slaveTasks.get(sid, 0)  + 1 
+            cpus[i] -= min(cpus[i], t.cpus)
+            mems[i] -= t.mem
+            return i
+
     @safe
     def offerRescinded(self, driver, offer_id):
         logger.debug("rescinded offer: %s", offer_id)
@@ -704,22 +1451,63 @@ class MesosScheduler(DAGScheduler):
         mem.scalar.value = t.mem
         return task
 
-    @safe
     def statusUpdate(self, driver, status):
+        # results streamed by workers are received out of the lock,
+        # it may take a while
+        loaded = None
+        tid = status.task_id.value
+        if (status.state in (mesos_pb2.TASK_FINISHED, mesos_pb2.TASK_FAILED)
+                and status.data and tid in self.taskIdToJobId):
+            try:
+                loaded = self.loadResult(tid, status.data)
+            except Exception, e:
+                logger.warning("error when cPickle.loads(): %s, data:%s", e, len(status.data))
+                loaded = e
+        self._statusUpdate(driver, status, loaded)
+
+    def loadResult(self, tid, data):
+        reason, result, accUpdate, peak = cPickle.loads(data)
+        if result:
+            flag, data = result
+            if flag >= 2:
+                data = self.resultServer.get(tid)
+                flag -= 2
+            data = decompress(data)
+            if flag == 0:
+                result = marshal.loads(data)
+            else:
+                result = cPickle.loads(data)
+        return reason, result, accUpdate, peak
+
+    @safe
+    def _statusUpdate(self, driver, status, loaded):
         tid = status.task_id.value
         state = status.state
         logger.debug("status update: %s %s", tid, state)
 
+        if state not in (mesos_pb2.TASK_RUNNING, mesos_pb2.TASK_FINISHED):
+            # chunks of a failed attempt
+            self.resultServer.discard(tid)
+
         jid = self.taskIdToJobId.get(tid)
         if jid not in self.activeJobs:
             logger.debug("Ignoring update from TID %s " +
                 "because its job is gone", tid)
+            if state != mesos_pb2.TASK_RUNNING:
+                self.resultServer.discard(tid)
             return
 
         job = self.activeJobs[jid]
         _, task_id, tried = map(int, tid.split(':'))
+        i = job.tidToIndex.get(task_id)
+        jobTrace = i is not None and self.getTrace(job.tasks[i])
         if state == mesos_pb2.TASK_RUNNING:
+            if jobTrace:
+                jobTrace.taskRunning(job.tasks[i])
             return job.statusUpdate(task_id, tried, state)
+        if jobTrace and state != mesos_pb2.TASK_FINISHED:
+            jobTrace.taskEnded(job.tasks[i], TASK_STATE_NAMES.get(state, 'TASK_FAILED'),
+                final=False)
 
         del self.taskIdToJobId[tid]
         self.jobTasks[jid].remove(tid)
@@ -728,41 +1516,54 @@ class MesosScheduler(DAGScheduler):
             self.slaveTasks[slave_id] -= 1
         del self.taskIdToSlaveId[tid]
 
-        if state in (mesos_pb2.TASK_FINISHED, mesos_pb2.TASK_FAILED) and status.data:
-            try:
-                reason,result,accUpdate = cPickle.loads(status.data)
-                if result:
-                    flag, data = result
-                    if flag >= 2:
-                        try:
-                            data = urllib.urlopen(data).read()
-                        except IOError:
-                            # try again
-                            data = urllib.urlopen(data).read()
-                        flag -= 2
-                    data = decompress(data)
-                    if flag == 0:
-                        result = marshal.loads(data)
-                    else:
-                        result = cPickle.loads(data)
-            except Exception, e:
-                logger.warning("error when cPickle.loads(): %s, data:%s", e, len(status.data))
-                state = mesos_pb2.TASK_FAILED
-                return job.statusUpdate(task_id, tried, mesos_pb2.TASK_FAILED, 'load failed: %s' % e)
-            else:
-                return job.statusUpdate(task_id, tried, state, 
-                    reason, result, accUpdate)
+        if loaded is not None:
+            if isinstance(loaded, Exception):
+                return job.statusUpdate(task_id, tried, mesos_pb2.TASK_FAILED,
+                    'load failed: %s' % loaded)
+            reason, result, accUpdate, peak = loaded
+            job.addMemoryUsage(peak)
+            return job.statusUpdate(task_id, tried, state,
+                reason, result, accUpdate)
 
         # killed, lost, load failed
         job.statusUpdate(task_id, tried, state, status.data)
         #if state in (mesos_pb2.TASK_FAILED, mesos_pb2.TASK_LOST):
         #    self.slaveFailed[slave_id] = self.slaveFailed.get(slave_id,0) + 1
 
+    def getStatus(self):
+        status = DAGScheduler.getStatus(self)
+        tasks = {} # stage id -> counts of tasks
+        hosts = {} # host -> running tasks
+        for job in self.activeJobs.values():
+            if not job.tasks:
+                continue
+            c = tasks.setdefault(job.tasks[0].stageId, {'running': 0,
+                'pending': 0, 'finished': 0, 'failures': 0})
+            for i, t in enumerate(job.tasks):
+                if job.finished[i]:
+                    c['finished'] += 1
+                elif job.launched[i]:
+                    c['running'] += 1
+                    host = getattr(t, 'host', None)
+                    hosts[host] = hosts.get(host, 0) + 1
+                else:
+                    c['pending'] += 1
+                c['failures'] += job.numFailures[i]
+        for job in status['jobs']:
+            for stage in job['stages']:
+                if stage['id'] in tasks:
+                    stage['tasks'] = tasks[stage['id']]
+        status['hosts'] = hosts
+        return status
+
     def jobFinished(self, job):
         logger.debug("job %s finished", job.id)
         if job.id in self.activeJobs:
             del self.activeJobs[job.id]
             self.activeJobsQueue.remove(job)
+            self.jobPool.pop(job.id).jobs.remove(job)
+            if job.tasksFinished == job.numTasks and not job.failed:
+                self.memoryHistory.update(job.signature, job.peakMemory)
             for id in self.jobTasks[job.id]:
                 del self.taskIdToJobId[id]
                 del self.taskIdToSlaveId[id]
@@ -776,7 +1577,7 @@ class MesosScheduler(DAGScheduler):
     @safe
     def check(self):
         for job in self.activeJobs.values():
-            if job.check_task_timeout():
+            if job.check_task_timeout() or job.isWaitingForLocality():
                 self.requestMoreResources()
 
     @safe
@@ -790,6 +1591,9 @@ class MesosScheduler(DAGScheduler):
         if not self.started:
             return
         logger.debug("stop scheduler")
+        for pool in self.pools.values():
+            pool.report()
+        self.memoryHistory.save()
         self.started = False
         self.isRegistered = False
         self.driver.stop(False)
@@ -27,7 +27,66 @@ def dumps(o):
 def loads(s):
     return cPickle.loads(s)
 
-dump_func = dumps
+# dumped functions are kept in driver, keyed by their code and the values
+# they captured, then the same closure of many tasks and stages is pickled
+# once. Functions capturing any object that can't be keyed by value
+# (instances, arrays, ...) may be changed in place, they are always dumped.
+MAX_CACHED_FUNCS = 256
+dumped_funcs = {} # key -> bytes
+
+SCALAR_TYPES = (types.NoneType, str, unicode, bool, int, long, float, complex)
+CONTAINER_TYPES = (list, dict, set, frozenset)
+
+def fingerprint(o, seen):
+    "the key of a captured value by its value, ValueError if it has none"
+    t = type(o)
+    if t in SCALAR_TYPES:
+        return t, o
+    if t is tuple:
+        return t, tuple(fingerprint(v, seen) for v in o)
+    if t in CONTAINER_TYPES:
+        # raise ValueError if not marshalable
+        return t, marshal.dumps(o)
+    if t is types.FunctionType:
+        if o in seen:
+            return t, o.func_name
+        return t, func_key(o, seen)
+    if t is types.ModuleType:
+        return t, o.__name__
+    if t is types.BuiltinFunctionType and o.__self__ is None:
+        return t, o.__module__, o.__name__
+    if t in (types.ClassType, types.TypeType) and o.__module__ != '__main__':
+        # dumped by name
+        return t, o.__module__, o.__name__
+    raise ValueError("%s can't be keyed by value" % t)
+
+def func_key(f, seen):
+    seen.add(f)
+    code = f.func_code
+    glob = tuple((n, fingerprint(f.func_globals.get(n), seen))
+            for n in get_co_names(code))
+    closure = f.func_closure and tuple(fingerprint(c.cell_contents, seen)
+            for c in f.func_closure)
+    return (code, code.co_filename, f.func_name, f.__module__,
+        fingerprint(f.func_defaults, seen), closure, glob)
+
+def dump_func(f):
+    if not MAX_CACHED_FUNCS or type(f) is not types.FunctionType:
+        return dumps(f)
+    try:
+        key = func_key(f, set())
+        hash(key)
+    except (ValueError, TypeError):
+        return dumps(f)
+    r = dumped_funcs.get(key)
+    if r is None:
+        r = dumps(f)
+        if len(dumped_funcs) >= MAX_CACHED_FUNCS:
+            dumped_funcs.clear()
+        dumped_funcs[key] = r
+    return r
+
+# every task gets a new function, not sharing the state in its closure
 load_func = loads
 
 def reduce_module(mod):
@@ -11,11 +11,17 @@ import Queue
 import heapq
 import platform
 
-from dpark.util import decompress, spawn
+from dpark.util import decompress, spawn, memory_pressure, clear_memory_pressure
 from dpark.env import env
-from dpark.tracker import GetValueMessage, SetValueMessage
+from dpark.tracker import GetValueMessage, SetValueMessage, SetItemMessage
+from dpark.accumulator import TaskMetrics
+from dpark import trace
 
 MAX_SHUFFLE_MEMORY = 2000  # 2 GB
+LATE_OUTPUT_WAIT = 1 # seconds
+# a reduce task started by slow start gives up after no late map output
+# came in it, the slot it holds may be needed by the lost map outputs
+LATE_OUTPUT_TIMEOUT = 60
 
 logger = logging.getLogger("shuffle")
 
@@ -31,6 +37,10 @@ class LocalFileShuffle:
         cls.serverUri = env.get('SERVER_URI', 'file://' + cls.shuffleDir[0])
         logger.debug("shuffle dir: %s", cls.shuffleDir)
 
+    @classmethod
+    def getTempFile(cls, name):
+        return os.path.join(cls.shuffleDir[0], '%s-%d.tmp' % (name, os.getpid()))
+
     @classmethod
     def getOutputFile(cls, shuffleId, inputId, outputId, datasize=0):
         path = os.path.join(cls.shuffleDir[0], str(shuffleId), str(inputId))
@@ -63,6 +73,45 @@ class LocalFileShuffle:
 
 class ShuffleFetcher:
     def fetch(self, shuffleId, reduceId, func):
+        logger.debug("Fetching outputs for shuffle %d, reduce %d", shuffleId, reduceId)
+        serverUris = env.mapOutputTracker.getServerUris(shuffleId)
+        if not serverUris:
+            return
+
+        fetched = [False] * len(serverUris)
+        begin, size = time.time(), 0
+        progress = begin
+        while True:
+            parts = [(part, uri) for part, uri in enumerate(serverUris)
+                        if uri and not fetched[part]]
+            random.shuffle(parts)
+            start = time.time()
+            size += self.fetch_parts(shuffleId, reduceId, parts, func)
+            trace.record('fetch', start)
+            for part, _ in parts:
+                fetched[part] = True
+            if all(fetched):
+                break
+
+            # reduce task was started before all the map tasks finished,
+            # wait for the late map outputs
+            start = time.time()
+            if parts:
+                progress = start
+            elif start > progress + LATE_OUTPUT_TIMEOUT:
+                from dpark.schedule import FetchFailed
+                part = fetched.index(False)
+                logger.warning("map output %d of shuffle %d is not available in %ds",
+                    part, shuffleId, LATE_OUTPUT_TIMEOUT)
+                raise FetchFailed(None, shuffleId, part, reduceId)
+            time.sleep(LATE_OUTPUT_WAIT)
+            serverUris = env.mapOutputTracker.getServerUris(shuffleId)
+            trace.record('wait', start)
+
+        TaskMetrics.add({'fetchBytes': size, 'fetchTime': time.time() - begin})
+
+    def fetch_parts(self, shuffleId, reduceId, parts, func):
+        "fetch and merge the parts by func, returns the bytes fetched"
         raise NotImplementedError
     def stop(self):
         pass
@@ -97,7 +146,7 @@ class SimpleShuffleFetcher(ShuffleFetcher):
                     d = cPickle.loads(d)
                 else:
                     raise ValueError("invalid flag")
-                return d
+                return length, d
             except Exception, e:
                 logger.debug("Fetch failed for shuffle %d, reduce %d, %d, %s, %s, try again",
                         shuffleId, reduceId, part, url, e)
@@ -109,14 +158,13 @@ class SimpleShuffleFetcher(ShuffleFetcher):
                     raise FetchFailed(uri, shuffleId, part, reduceId)
                 time.sleep(2**(2-tries)*0.1)
 
-    def fetch(self, shuffleId, reduceId, func):
-        logger.debug("Fetching outputs for shuffle %d, reduce %d", shuffleId, reduceId)
-        serverUris = env.mapOutputTracker.getServerUris(shuffleId)
-        parts = zip(range(len(serverUris)), serverUris)
-        random.shuffle(parts)
+    def fetch_parts(self, shuffleId, reduceId, parts, func):
+        size = 0
         for part, uri in parts:
-            d = self.fetch_one(uri, shuffleId, part, reduceId)
+            length, d = self.fetch_one(uri, shuffleId, part, reduceId)
             func(d.iteritems())
+            size += length
+        return size
 
 
 class ParallelShuffleFetcher(SimpleShuffleFetcher):
@@ -126,7 +174,6 @@ class ParallelShuffleFetcher(SimpleShuffleFetcher):
 
     def start(self):        
         self.requests = Queue.Queue()
-        self.results = Queue.Queue(self.nthreads)
         self.threads = [spawn(self._worker_thread) for i in range(self.nthreads)]
 
     def _worker_thread(self):
@@ -136,41 +183,44 @@ class ParallelShuffleFetcher(SimpleShuffleFetcher):
             if r is None:
                 break
 
-            uri, shuffleId, part, reduceId = r
+            uri, shuffleId, part, reduceId, results, failed = r
+            if failed:
+                results.put(None) # skipped
+                continue
             try:
-                d = self.fetch_one(*r)
-                self.results.put((shuffleId, reduceId, part, d))
+                length, d = self.fetch_one(uri, shuffleId, part, reduceId)
+                results.put((shuffleId, reduceId, part, length, d))
             except FetchFailed, e:
-                self.results.put(e)
-
-    def fetch(self, shuffleId, reduceId, func):
-        logger.debug("Fetching outputs for shuffle %d, reduce %d", shuffleId, reduceId)
-        serverUris = env.mapOutputTracker.getServerUris(shuffleId)
-        if not serverUris:
-            return
+                results.put(e)
 
-        parts = zip(range(len(serverUris)), serverUris)
-        random.shuffle(parts)
+    def fetch_parts(self, shuffleId, reduceId, parts, func):
+        # every call has its own results, so tasks in many threads
+        # can share the fetcher
+        results = Queue.Queue(self.nthreads)
+        failed = []
         for part, uri in parts:
-            self.requests.put((uri, shuffleId, part, reduceId))
+            self.requests.put((uri, shuffleId, part, reduceId, results, failed))
         
         from dpark.schedule import FetchFailed
-        for i in xrange(len(serverUris)):
-            r = self.results.get()
+        size = 0
+        for i in xrange(len(parts)):
+            r = results.get()
             if isinstance(r, FetchFailed):
-                self.stop() # restart
-                self.start()
+                # skip the rest, wait for the ones being fetched
+                failed.append(r)
+                for j in xrange(i + 1, len(parts)):
+                    results.get()
                 raise r
             
-            sid, rid, part, d = r
+            sid, rid, part, length, d = r
             func(d.iteritems())
+            size += length
+        return size
 
     def stop(self):
         logger.debug("stop parallel shuffle fetcher ...")
         while not self.requests.empty():
             self.requests.get_nowait()
-        while not self.results.empty():
-            self.results.get_nowait()
         for i in range(self.nthreads):
             self.requests.put(None)
         for t in self.threads:
@@ -197,20 +247,37 @@ class CoGroupMerger(object):
     def __init__(self, size):
         self.size = size
         self.combined = {}
+        self.archives = []
 
     def get_seq(self, k):
         return self.combined.setdefault(k, tuple([[] for i in range(self.size)]))
 
     def append(self, i, items):
-        for k, v in items:
+        for n, (k, v) in enumerate(items):
             self.get_seq(k)[i].append(v)
+            if not n & 0x3ff and memory_pressure():
+                self.rotate()
 
     def extend(self, i, items):
         for k, v in items:
             self.get_seq(k)[i].extend(v)
+        if memory_pressure():
+            self.rotate()
+
+    def rotate(self):
+        logger.info("memory pressure, spill %d keys of cogroup", len(self.combined))
+        self.archives.append(sorted_items(self.combined.iteritems()))
+        self.combined = {}
+        clear_memory_pressure()
 
     def __iter__(self):
-        return self.combined.iteritems()
+        if not self.archives:
+            return self.combined.iteritems()
+
+        if self.combined:
+            self.rotate()
+        return heap_merged(self.archives,
+                lambda x, y: tuple(a + b for a, b in zip(x, y)))
 
 def heap_merged(items_lists, combiner):
     heap = []
@@ -250,29 +317,30 @@ class sorted_items(object):
 
     def __init__(self, items):
         self.id = self.new_id()
-        self.path = path = os.path.join(LocalFileShuffle.shuffleDir,
-            'shuffle-%d-%d.tmp.gz' % (os.getpid(), self.id))
-        f = gzip.open(path, 'wb+')
+        self.path = path = LocalFileShuffle.getTempFile('shuffle-%d' % self.id)
 
         items = sorted(items)
         try:
-            for i in items:
-                s = marshal.dumps(i)
-                f.write(struct.pack("I", len(s)))
-                f.write(s)
+            self.write(items, marshal.dumps)
             self.loads = marshal.loads
-        except Exception, e:
-            f.rewind()
-            for i in items:
-                s = cPickle.dumps(i)
-                f.write(struct.pack("I", len(s)))
-                f.write(s)
+        except ValueError:
+            # not marshalable, write them again
+            self.write(items, lambda i: cPickle.dumps(i, -1))
             self.loads = cPickle.loads
-        f.close()
 
         self.f = gzip.open(path)
         self.c = 0
 
+    def write(self, items, dumps):
+        f = gzip.open(self.path, 'wb')
+        try:
+            for i in items:
+                s = dumps(i)
+                f.write(struct.pack("I", len(s)))
+                f.write(s)
+        finally:
+            f.close()
+
     def __iter__(self):
         self.f = gzip.open(self.path)
         self.c = 0
@@ -296,11 +364,36 @@ class sorted_items(object):
             os.remove(self.path)
 
 
-class DiskMerger(Merger):
+class SpillMerger(Merger):
+    "spill sorted runs to disk only under memory pressure"
     def __init__(self, total, combiner):
         Merger.__init__(self, total, combiner)
-        self.total = total
         self.archives = []
+
+    def merge(self, items):
+        Merger.merge(self, items)
+        if memory_pressure():
+            self.rotate()
+
+    def rotate(self):
+        logger.info("spill %d keys of shuffle to disk", len(self.combined))
+        self.archives.append(sorted_items(self.combined.iteritems()))
+        self.combined = {}
+        clear_memory_pressure()
+
+    def __iter__(self):
+        if not self.archives:
+            return self.combined.iteritems()
+
+        if self.combined:
+            self.rotate()
+        return heap_merged(self.archives, self.mergeCombiner)
+
+class DiskMerger(SpillMerger):
+    "also spill when it used more than MAX_SHUFFLE_MEMORY"
+    def __init__(self, total, combiner):
+        SpillMerger.__init__(self, total, combiner)
+        self.total = total
         self.base_memory = self.get_used_memory()
         self.max_merge = None
         self.merged = 0
@@ -321,28 +414,47 @@ class DiskMerger(Merger):
             if self.merged < self.total/5 and self.get_used_memory() - self.base_memory > MAX_SHUFFLE_MEMORY:
                 self.max_merge = self.merged
 
-        if self.max_merge is not None and self.merged >= self.max_merge:
+        if self.max_merge is not None and self.merged >= self.max_merge or memory_pressure():
             t = time.time()
             self.rotate()
             self.merged = 0
             #print 'after rotate', self.get_used_memory() - self.base_memory, time.time() - t
 
-    def rotate(self):
-        self.archives.append(sorted_items(self.combined.iteritems()))
-        self.combined = {}
-
-    def __iter__(self):
-        if not self.archives:
-            return self.combined.iteritems()
-
-        if self.combined:
-            self.rotate()
-        return heap_merged(self.archives, self.mergeCombiner)
+class SpilledBuckets(object):
+    "buckets of a map task spilled to disk under memory pressure"
+    def __init__(self, shuffleId, partition):
+        self.path = LocalFileShuffle.getTempFile('spill-%d-%d' % (shuffleId, partition))
+        self.f = open(self.path, 'wb+')
+        self.offsets = {} # bucket -> [offset]
+
+    def spill(self, buckets):
+        self.f.seek(0, 2)
+        for i, bucket in enumerate(buckets):
+            if bucket:
+                self.offsets.setdefault(i, []).append(self.f.tell())
+                cPickle.dump(bucket, self.f, -1)
+        clear_memory_pressure()
+
+    def merge(self, i, bucket, mergeCombiner):
+        "merge the spilled parts of bucket i into it"
+        for offset in self.offsets.pop(i, []):
+            self.f.seek(offset)
+            for k, v in cPickle.load(self.f).iteritems():
+                o = bucket.get(k)
+                bucket[k] = mergeCombiner(o, v) if o is not None else v
+        return bucket
+
+    def close(self):
+        self.f.close()
+        os.remove(self.path)
 
 class BaseMapOutputTracker(object):
     def registerMapOutputs(self, shuffleId, locs):
         pass
 
+    def registerMapOutput(self, shuffleId, mapId, loc):
+        pass
+
     def getServerUris(self):
         pass
 
@@ -359,6 +471,9 @@ class LocalMapOutputTracker(BaseMapOutputTracker):
     def registerMapOutputs(self, shuffleId, locs):
         self.serverUris[shuffleId] = locs
 
+    def registerMapOutput(self, shuffleId, mapId, loc):
+        self.serverUris[shuffleId][mapId] = loc
+
     def getServerUris(self, shuffleId):
         return self.serverUris.get(shuffleId)
 
@@ -373,6 +488,9 @@ class MapOutputTracker(BaseMapOutputTracker):
     def registerMapOutputs(self, shuffleId, locs):
         self.client.call(SetValueMessage('shuffle:%s' % shuffleId, locs))
 
+    def registerMapOutput(self, shuffleId, mapId, loc):
+        self.client.call(SetItemMessage('shuffle:%s' % shuffleId, mapId, loc))
+
     def getServerUris(self, shuffleId):
         locs = self.client.call(GetValueMessage('shuffle:%s' % shuffleId))
         logger.debug("Fetch done: %s", locs)
@@ -7,6 +7,7 @@ import itertools
 import msgpack
 
 from dpark.rdd import DerivedRDD, OutputTableFileRDD
+from dpark.disktable import collect_table
 from dpark.dependency import Aggregator, OneToOneDependency
 
 try:
@@ -263,9 +264,10 @@ class TableRDD(DerivedRDD):
 
     @table_join
     def leftOuterJoin(self, other, left_keys=None, right_keys=None):
-        o = other.indexBy(right_keys).collectAsMap()
+        o = collect_table(other.indexBy(right_keys))
         r = self.indexBy(left_keys).map(lambda (k,v):(k,(v,o.get(k))))
-        r.mem += (sys.getsizeof(o) * 10) >> 20 # memory used by broadcast obj
+        if isinstance(o, dict):
+            r.mem += (sys.getsizeof(o) * 10) >> 20 # memory used by broadcast obj
         return r
 
     @table_join
@@ -4,10 +4,12 @@ import marshal
 import cPickle
 import logging
 import struct
+import time
 
-from dpark.util import compress, decompress
+from dpark.util import compress, decompress, memory_pressure
+from dpark.accumulator import TaskMetrics
 from dpark.serialize import marshalable, load_func, dump_func
-from dpark.shuffle import LocalFileShuffle
+from dpark.shuffle import LocalFileShuffle, SpilledBuckets
 
 logger = logging.getLogger("dpark")
 
@@ -28,7 +30,17 @@ class Task:
         raise NotImplementedError
 
 
+MAX_DECODED_BINARIES = 64
+
 class DAGTask(Task):
+    # broadcast of the lineage shared by all tasks of the stage,
+    # the task itself only carries its split
+    binary = None
+    # uuid of binary -> decoded value, kept by long-lived workers
+    decoded = {}
+    # set when unpickled in workers, the driver never loads the binary
+    unpickled = False
+
     def __init__(self, stageId):
         Task.__init__(self)
         self.stageId = stageId
@@ -36,6 +48,32 @@ class DAGTask(Task):
     def __repr__(self):
         return '<task %d:%d>'%(self.stageId, self.id)
 
+    def __getattr__(self, name):
+        # lineage in binary is loaded at first use, broadcast is not
+        # ready yet when the task is unpickled in a new process
+        if not self.unpickled or self.binary is None or name.startswith('__'):
+            raise AttributeError(name)
+        start = time.time()
+        self.loadBinary()
+        TaskMetrics.add({'deserializeTime': time.time() - start})
+        if name not in self.__dict__:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def loadBinary(self):
+        raise NotImplementedError
+
+    def decodeBinary(self, decode):
+        "decode the binary once, shared by the tasks of the stage in a worker"
+        uuid = self.binary.uuid
+        value = DAGTask.decoded.get(uuid)
+        if value is None:
+            value = decode(self.binary.value)
+            if len(DAGTask.decoded) >= MAX_DECODED_BINARIES:
+                DAGTask.decoded.clear()
+            DAGTask.decoded[uuid] = value
+        return value
+
 
 class ResultTask(DAGTask):
     def __init__(self, stageId, rdd, func, partition, locs, outputId):
@@ -60,27 +98,49 @@ class ResultTask(DAGTask):
     def __getstate__(self):
         d = dict(self.__dict__)
         del d['func']
+        if self.binary is not None:
+            del d['rdd'], d['locs']
+            return d, None
         return d, dump_func(self.func)
 
     def __setstate__(self, state):
         self.__dict__, code = state
-        self.func = load_func(code)
+        self.unpickled = True
+        if code is not None:
+            self.func = load_func(code)
+
+    def loadBinary(self):
+        self.rdd, self.func = self.decodeBinary(
+                lambda (rdd, code): (rdd, load_func(code)))
 
 
 class ShuffleMapTask(DAGTask):
-    def __init__(self, stageId, rdd, dep, partition, locs):
+    def __init__(self, stageId, rdd, dep, partition, locs, split=None):
         DAGTask.__init__(self, stageId)
         self.rdd = rdd
         self.shuffleId = dep.shuffleId
         self.aggregator = dep.aggregator
         self.partitioner = dep.partitioner
         self.partition = partition
-        self.split = rdd.splits[partition]
+        self.split = split or rdd.splits[partition]
         self.locs = locs
 
     def __repr__(self):
         return '<ShuffleTask(%d, %d) of %s>' % (self.shuffleId, self.partition, self.rdd)
 
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        if self.binary is not None:
+            del d['rdd'], d['locs'], d['aggregator'], d['partitioner']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__ = d
+        self.unpickled = True
+
+    def loadBinary(self):
+        self.rdd, self.aggregator, self.partitioner = self.binary.value
+
     def preferredLocations(self):
         return self.locs
 
@@ -92,7 +152,8 @@ class ShuffleMapTask(DAGTask):
         createCombiner = self.aggregator.createCombiner
 
         buckets = [{} for i in range(numOutputSplits)]
-        for k,v in self.rdd.iterator(self.split):
+        spilled = None
+        for n, (k,v) in enumerate(self.rdd.iterator(self.split)):
             bucketId = getPartition(k)
             bucket = buckets[bucketId]
             r = bucket.get(k, None)
@@ -100,15 +161,26 @@ class ShuffleMapTask(DAGTask):
                 bucket[k] = mergeValue(r, v)
             else:
                 bucket[k] = createCombiner(v)
+            if not n & 0x3ff and memory_pressure():
+                logger.info("memory pressure, spill buckets of %s", self)
+                spilled = spilled or SpilledBuckets(self.shuffleId, self.partition)
+                spilled.spill(buckets)
+                buckets = [{} for i in range(numOutputSplits)]
 
+        start, written = time.time(), 0
         for i in range(numOutputSplits):
+            bucket = buckets[i]
+            buckets[i] = None
+            if spilled:
+                bucket = spilled.merge(i, bucket, self.aggregator.mergeCombiners)
             try:
-                if marshalable(buckets[i]):
-                    flag, d = 'm', marshal.dumps(buckets[i])
+                if marshalable(bucket):
+                    flag, d = 'm', marshal.dumps(bucket)
                 else:
-                    flag, d = 'p', cPickle.dumps(buckets[i], -1)
+                    flag, d = 'p', cPickle.dumps(bucket, -1)
             except ValueError:
-                flag, d = 'p', cPickle.dumps(buckets[i], -1)
+                flag, d = 'p', cPickle.dumps(bucket, -1)
+            bucket = None
             cd = compress(d)
             for tried in range(1, 4):
                 try:
@@ -119,6 +191,7 @@ class ShuffleMapTask(DAGTask):
                     f.write(cd)
                     f.close()
                     os.rename(tpath, path)
+                    written += 5 + len(cd)
                     break
                 except IOError, e:
                     logging.warning("write %s failed: %s, try again (%d)", path, e, tried)
@@ -127,4 +200,8 @@ class ShuffleMapTask(DAGTask):
             else:
                 raise
 
+        if spilled:
+            spilled.close()
+        TaskMetrics.add({'shuffleWriteBytes': written,
+            'shuffleWriteTime': time.time() - start})
         return LocalFileShuffle.getServerUri()
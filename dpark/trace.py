@@ -0,0 +1,149 @@
+""" timeline of a job in driver, saved in Chrome trace event format
+
+The saved file can be opened in chrome://tracing or Perfetto, stages
+are shown as rows of the driver, tasks as rows of the hosts running
+them, with the fetch phases and waits of late map outputs inside.
+"""
+import os
+import time
+import json
+import threading
+import logging
+
+from dpark.accumulator import TaskSpans
+from dpark.env import env
+
+logger = logging.getLogger("trace")
+
+DRIVER_PID = 0
+
+def is_tracing():
+    return bool(env.get('TRACE'))
+
+def record(name, start, end=None):
+    "record a phase of current task, sent to driver with the status"
+    if is_tracing():
+        TaskSpans.add([(name, start, end or time.time())])
+
+class JobTrace(object):
+    def __init__(self, jobId, name):
+        self.jobId = jobId
+        self.name = name
+        self.begin = time.time()
+        self.events = []
+        self.stages = {} # stage id -> submitted time
+        self.tasks = {} # task id -> {submitted, launched, running, host}
+        self.hosts = {} # host -> (pid, end time of lanes)
+        self.lock = threading.Lock()
+        self.meta('process_name', DRIVER_PID, 0, {'name': 'driver'})
+
+    def ts(self, t):
+        return int((t - self.begin) * 1e6)
+
+    def meta(self, name, pid, tid, args):
+        self.events.append({'name': name, 'ph': 'M', 'pid': pid,
+            'tid': tid, 'args': args})
+
+    def instant(self, name, args=None, t=None):
+        with self.lock:
+            self.events.append({'name': name, 'cat': 'scheduler', 'ph': 'i',
+                's': 'p', 'ts': self.ts(t or time.time()), 'pid': DRIVER_PID,
+                'tid': 0, 'args': args or {}})
+
+    def complete(self, name, cat, start, end, pid, tid, args=None):
+        self.events.append({'name': name, 'cat': cat, 'ph': 'X',
+            'ts': self.ts(start), 'dur': max(self.ts(end) - self.ts(start), 0),
+            'pid': pid, 'tid': tid, 'args': args or {}})
+
+    def lane(self, host, start, end):
+        # a free row of the host, tasks in one row do not overlap
+        if host not in self.hosts:
+            pid = len(self.hosts) + 1
+            self.hosts[host] = (pid, [])
+            self.meta('process_name', pid, 0, {'name': host})
+        pid, lanes = self.hosts[host]
+        for i, last in enumerate(lanes):
+            if last <= start:
+                lanes[i] = end
+                return pid, i
+        lanes.append(end)
+        return pid, len(lanes) - 1
+
+    def stageSubmitted(self, stage, ntasks):
+        now = time.time()
+        with self.lock:
+            self.stages.setdefault(stage.id, now)
+        self.instant('submit stage %d' % stage.id,
+            {'stage': str(stage), 'tasks': ntasks}, now)
+
+    def stageFinished(self, stage):
+        now = time.time()
+        with self.lock:
+            start = self.stages.pop(stage.id, None)
+            if start is not None:
+                self.meta('thread_name', DRIVER_PID, stage.id,
+                    {'name': 'stage %d' % stage.id})
+                self.complete('stage %d' % stage.id, 'stage', start, now,
+                    DRIVER_PID, stage.id, {'stage': str(stage)})
+
+    def taskSubmitted(self, task):
+        with self.lock:
+            self.tasks[task.id] = {'submitted': time.time()}
+
+    def taskLaunched(self, task, host):
+        with self.lock:
+            info = self.tasks.setdefault(task.id, {})
+            info['launched'] = time.time()
+            info['host'] = host
+            info.pop('running', None)
+
+    def taskRunning(self, task):
+        with self.lock:
+            info = self.tasks.get(task.id)
+            if info is not None and 'running' not in info:
+                info['running'] = time.time()
+
+    def taskEnded(self, task, reason, spans=None, final=True):
+        """ record an attempt of the task, spans are [(name, start, end)]
+        of the phases reported by the worker """
+        now = time.time()
+        with self.lock:
+            info = self.tasks.get(task.id)
+            if info is None:
+                return
+            if final:
+                del self.tasks[task.id]
+            submitted = info['submitted']
+            spans = spans or []
+            run = [b for name, b, e in spans if name == 'run']
+            # tasks of local schedulers are not launched by driver
+            start = info.get('launched', run and min(run) or submitted)
+            pid, tid = self.lane(info.get('host', 'localhost'), start, now)
+            args = {'stage': task.stageId, 'tried': getattr(task, 'tried', 1),
+                'reason': isinstance(reason, str) and reason or reason.__class__.__name__,
+                'queued': '%.3fs' % (start - submitted)}
+            if 'running' in info:
+                args['starting'] = '%.3fs' % (info['running'] - start)
+            self.complete('task %d' % task.id, 'task', start, now, pid, tid, args)
+            for name, b, e in spans:
+                # clock of the worker may be skewed
+                b, e = max(b, start), min(e, now)
+                if b < e:
+                    self.complete(name, 'phase', b, e, pid, tid)
+
+    def save(self, path):
+        end = time.time()
+        with self.lock:
+            self.complete('job %d' % self.jobId, 'job', self.begin, end,
+                DRIVER_PID, 0, {'rdd': self.name})
+            self.meta('thread_name', DRIVER_PID, 0, {'name': 'jobs'})
+            data = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+        try:
+            d = os.path.dirname(path)
+            if d and not os.path.exists(d):
+                os.makedirs(d)
+            with open(path, 'w') as f:
+                json.dump(data, f)
+            logger.info("timeline of job %d saved to %s", self.jobId, path)
+        except (IOError, OSError), e:
+            logger.warning("save timeline to %s failed: %s", path, e)
@@ -24,6 +24,12 @@ class AddItemMessage(TrackerMessage):
         self.key = key
         self.item = item
 
+class SetItemMessage(TrackerMessage):
+    def __init__(self, key, index, item):
+        self.key = key
+        self.index = index
+        self.item = item
+
 class RemoveItemMessage(TrackerMessage):
     def __init__(self, key, item):
         self.key = key
@@ -33,6 +39,10 @@ class GetValueMessage(TrackerMessage):
     def __init__(self, key):
         self.key = key
 
+class DeleteValueMessage(TrackerMessage):
+    def __init__(self, key):
+        self.key = key
+
 class TrackerServer(object):
     locs = {}
     def __init__(self):
@@ -66,10 +76,16 @@ class TrackerServer(object):
 
         self.locs[key].append(item)
 
+    def setitem(self, key, index, item):
+        self.locs[key][index] = item
+
     def remove(self, key, item):
         if item in self.locs[key]:
             self.locs[key].remove(item)
 
+    def delete(self, key):
+        self.locs.pop(key, None)
+
     def run(self):
         locs = self.locs
         sock = env.ctx.socket(zmq.REP)
@@ -86,11 +102,17 @@ class TrackerServer(object):
             elif isinstance(msg, AddItemMessage):
                 self.add(msg.key, msg.item)
                 reply('OK')
+            elif isinstance(msg, SetItemMessage):
+                self.setitem(msg.key, msg.index, msg.item)
+                reply('OK')
             elif isinstance(msg, RemoveItemMessage):
                 self.remove(msg.key, msg.item)
                 reply('OK')
             elif isinstance(msg, GetValueMessage):
                 reply(self.get(msg.key))
+            elif isinstance(msg, DeleteValueMessage):
+                self.delete(msg.key)
+                reply('OK')
             elif isinstance(msg, StopTrackerMessage):
                 reply('OK')
                 break
@@ -60,3 +60,19 @@ def izip(*its):
             yield tuple([it.next() for it in its])
     except StopIteration:
         pass
+
+# flag shared with the executor, set when the worker process uses more
+# memory than offered, then the structures able to spill to disk free
+# their memory and clear it
+_memory_pressure = None
+
+def set_memory_pressure_flag(flag):
+    global _memory_pressure
+    _memory_pressure = flag
+
+def memory_pressure():
+    return _memory_pressure is not None and _memory_pressure.value != 0
+
+def clear_memory_pressure():
+    if _memory_pressure is not None:
+        _memory_pressure.value = 0
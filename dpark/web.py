@@ -0,0 +1,114 @@
+""" http server of the driver, showing the progress of running jobs
+
+    /               summary in plain text
+    /api/status     everything in JSON
+    /api/jobs, /api/hosts, /api/shuffles, /api/cache
+                    parts of it
+
+The state is read from the scheduler only when requested, nothing is
+recorded for it in the scheduling loop.
+"""
+import time
+import json
+import socket
+import urlparse
+import logging
+import SocketServer
+import BaseHTTPServer
+
+from dpark.util import spawn
+from dpark.env import env
+
+logger = logging.getLogger("web")
+
+SECTIONS = ('jobs', 'hosts', 'shuffles', 'cache')
+
+def hostname(loc):
+    if '://' in loc:
+        return urlparse.urlparse(loc).hostname
+    return loc
+
+def cacheStatus():
+    result = []
+    snapshot = env.cacheTracker.getLocationsSnapshot()
+    for rddId, locs in sorted(snapshot.items()):
+        hosts = {}
+        for ls in list(locs):
+            for loc in ls[:]:
+                h = hostname(loc)
+                hosts[h] = hosts.get(h, 0) + 1
+        result.append({'rdd': rddId, 'partitions': len(locs),
+            'cached': len([ls for ls in locs if ls]), 'hosts': hosts})
+    return result
+
+def summary(status):
+    lines = []
+    for job in status['jobs']:
+        lines.append('job %d: %s, %d/%d finished, %.1fs' % (job['id'],
+            job['rdd'], job['finished'], job['partitions'], job['elapsed']))
+        for stage in job['stages']:
+            tasks = stage.get('tasks')
+            lines.append('  stage %d %s: %s, %d/%d outputs, %d pending tasks%s' % (
+                stage['id'], stage['state'], stage['rdd'], stage['available'],
+                stage['partitions'], stage['pendingTasks'],
+                tasks and ', running %(running)d, failures %(failures)d' % tasks or ''))
+    if not status['jobs']:
+        lines.append('no running job')
+    if status.get('hosts'):
+        lines.append('running tasks: ' + ', '.join('%s=%d' % (h, n)
+            for h, n in sorted(status['hosts'].items())))
+    return '\n'.join(lines) + '\n'
+
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        try:
+            status = self.server.getStatus()
+        except Exception, e:
+            logger.exception("get status failed")
+            return self.send_error(500, str(e))
+
+        if path == '':
+            return self.reply('text/plain', summary(status))
+        if path == '/api/status':
+            return self.reply('application/json', json.dumps(status))
+        if path.startswith('/api/') and path[5:] in SECTIONS:
+            return self.reply('application/json',
+                json.dumps(status.get(path[5:], [])))
+        self.send_error(404)
+
+    def reply(self, ctype, body):
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, sched, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('0.0.0.0', port), StatusHandler)
+        self.sched = sched
+        self.addr = 'http://%s:%d/' % (socket.gethostname(), self.server_address[1])
+
+    def start(self):
+        spawn(self.serve_forever)
+        logger.info("status of jobs is served at %s", self.addr)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def getStatus(self):
+        status = self.sched.getStatus()
+        status.setdefault('hosts', {})
+        status['cache'] = cacheStatus()
+        status['time'] = time.time()
+        return status
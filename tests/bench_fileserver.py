@@ -0,0 +1,73 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import shutil
+import httplib
+import urllib
+import tempfile
+import threading
+import SocketServer
+import SimpleHTTPServer
+
+from dpark.util import spawn
+from dpark.fileserver import FileServer
+
+class LocalizedHTTP(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # the handler used by executor before
+    basedir = None
+    def translate_path(self, path):
+        out = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+        return self.basedir + '/' + os.path.relpath(out)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_simple(basedir):
+    LocalizedHTTP.basedir = basedir
+    ss = SocketServer.TCPServer(('0.0.0.0', 0), LocalizedHTTP)
+    spawn(ss.serve_forever)
+    return ss.server_address[1]
+
+def run_clients(port, names, clients, keepalive):
+    # every client fetches all the files, like reducers fetching map outputs
+    def client():
+        conn = httplib.HTTPConnection('localhost', port)
+        for name in names:
+            if keepalive:
+                conn.request('GET', '/' + name)
+                conn.getresponse().read()
+            else:
+                urllib.urlopen('http://localhost:%d/%s' % (port, name)).read()
+        conn.close()
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+def bench(d, names, size, clients=8):
+    total = size * len(names) * clients
+    for name, port, keepalive in [
+            ('SimpleHTTPServer', start_simple(d), False),
+            ('FileServer', FileServer(d).start(), False),
+            ('FileServer keepalive', FileServer(d).start(), True)]:
+        used = run_clients(port, names, clients, keepalive)
+        print '%-22s %d clients x %d files of %dKB: %.3fs, %.1fMB/s, %.0f req/s' % (
+            name, clients, len(names), size >> 10, used,
+            total / used / (1 << 20), clients * len(names) / used)
+
+if __name__ == '__main__':
+    d = tempfile.mkdtemp(prefix='dpark-bench-')
+    try:
+        for size, n in [(4 << 10, 500), (1 << 20, 50), (32 << 20, 2)]:
+            names = []
+            for i in range(n):
+                name = '%d-%d' % (size, i)
+                with open(os.path.join(d, name), 'wb') as f:
+                    f.write(os.urandom(1024) * (size / 1024))
+                names.append(name)
+            bench(d, names, size)
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,56 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import random
+import logging
+
+import dpark.job
+from dpark.job import SimpleJob, TASK_RUNNING, TASK_FINISHED
+
+class MockSched:
+    def taskEnded(self, task, reason, result, update): pass
+    def requestMoreResources(self): pass
+    def jobFinished(self, job): pass
+    def killTask(self, job_id, task_id, tried): pass
+
+class MockTask:
+    def __init__(self, id, locs):
+        self.id = id
+        self.locs = locs
+    def preferredLocations(self):
+        return self.locs
+
+def bench_offers(n=100000, hosts=100, slots=2000):
+    # synthetic offers: `slots` tasks running at most, from random hosts
+    dpark.job.LOCALITY_WAIT = dpark.job.LOCALITY_WAIT_RACK = 0
+    names = ['10.0.%d.%d' % (i / 256, i % 256) for i in range(hosts)]
+    tasks = [MockTask(i, [names[i % hosts], names[(i * 7) % hosts]]) for i in xrange(n)]
+    start = time.time()
+    job = SimpleJob(MockSched(), tasks)
+    created = time.time() - start
+
+    start = time.time()
+    running = []
+    offers = 0
+    while job.tasksFinished < n:
+        while len(running) < slots:
+            offers += 1
+            t = job.slaveOffer(random.choice(names), 1, 1000, 'rack')
+            if t is None:
+                break
+            running.append(t)
+        # finish a half of running tasks
+        for t in running[:slots / 2]:
+            job.statusUpdate(t.id, t.tried, TASK_RUNNING)
+            job.statusUpdate(t.id, t.tried, TASK_FINISHED)
+        del running[:slots / 2]
+        job.last_check = 0
+        job.check_task_timeout()
+    used = time.time() - start
+    print '%d tasks on %d hosts: create %.2fs, %d offers in %.2fs, %.1fus per task' % (
+        n, hosts, created, offers, used, used * 1e6 / n)
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench_offers(n)
@@ -0,0 +1,43 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import logging
+import tempfile
+
+from dpark.context import DparkContext
+
+def bench_read(ctx, path, n=3):
+    rdd = ctx.textFile(path, splitSize=4<<20)
+    start = time.time()
+    for i in xrange(n):
+        rdd.map(lambda l:len(l)).reduce(lambda x,y:x+y)
+    used = (time.time() - start) / n
+    size = os.path.getsize(path)
+    print '%-10s read %dMB: %.3fs, %.1fMB/s' % (ctx.master, size>>20, used, size / used / (1<<20))
+
+def bench_latency(ctx, n=3):
+    # reads with 1ms latency, like fetching from remote storage
+    rdd = ctx.makeRDD(range(2000), 40).map(lambda x: time.sleep(0.001) or x)
+    start = time.time()
+    for i in xrange(n):
+        rdd.count()
+    used = (time.time() - start) / n
+    print '%-10s 2000 reads with 1ms latency: %.3fs' % (ctx.master, used)
+
+if __name__ == '__main__':
+    # compare: python bench_local.py -m local; python bench_local.py -m local[4]
+    logging.getLogger().setLevel(logging.WARNING)
+    ctx = DparkContext()
+    ctx.init()
+    logging.getLogger().setLevel(logging.WARNING)
+    path = tempfile.mktemp(prefix='dpark-bench-')
+    with open(path, 'w') as f:
+        line = 'x' * 99 + '\n'
+        for i in xrange((64 << 20) / len(line)):
+            f.write(line)
+    try:
+        bench_read(ctx, path)
+        bench_latency(ctx)
+    finally:
+        os.remove(path)
+    ctx.stop()
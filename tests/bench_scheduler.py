@@ -0,0 +1,30 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import logging
+
+from dpark.context import DparkContext
+
+def bench_small_jobs(ctx, n=200):
+    rdd = ctx.makeRDD(range(100), 2)
+    rdd.count() # warm up
+    start = time.time()
+    for i in xrange(n):
+        rdd.count()
+    used = time.time() - start
+    print '%d single-stage jobs: %.3fs, %.2fms per job' % (n, used, used * 1000 / n)
+
+    rdd = rdd.map(lambda x:(x % 10, x)).reduceByKey(lambda x,y:x+y, 2)
+    start = time.time()
+    for i in xrange(n):
+        rdd.collect()
+    used = time.time() - start
+    print '%d two-stage jobs: %.3fs, %.2fms per job' % (n, used, used * 1000 / n)
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    ctx = DparkContext()
+    ctx.init()
+    logging.getLogger().setLevel(logging.WARNING)
+    bench_small_jobs(ctx)
+    ctx.stop()
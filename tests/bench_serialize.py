@@ -0,0 +1,55 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import cPickle
+import logging
+
+from dpark.context import DparkContext
+from dpark.util import compress, decompress
+from dpark.task import ResultTask, ShuffleMapTask
+from dpark import serialize
+
+def encode(t):
+    # what MesosScheduler.createTask spends on a task
+    return compress(cPickle.dumps((t, 0), -1))
+
+def make_tasks(ctx, n):
+    words = ['a', 'b', 'c']
+    weights = dict((w, i) for i, w in enumerate(words))
+    rdd = ctx.makeRDD(range(n * 10), n).map(
+        lambda x: (words[x % len(words)], x * weights.get(words[x % 3], 1)))
+    reduced = rdd.reduceByKey(lambda x, y: x + y, n)
+    dep = reduced.dependencies[0]
+    limit = 10
+    func = lambda it: [x for x in it if x[1] > limit]
+    return ([ShuffleMapTask(1, rdd, dep, i, [], rdd.splits[i]) for i in range(n)],
+        [ResultTask(2, reduced, func, i, [], i) for i in range(n)])
+
+def bench(ctx, n=2000, jobs=5):
+    for name, cached in [('no cache', 0), ('cached', 256)]:
+        serialize.MAX_CACHED_FUNCS = cached
+        serialize.dumped_funcs.clear()
+        used = {'map': 0, 'result': 0, 'decode': 0}
+        for j in range(jobs):
+            maps, results = make_tasks(ctx, n)
+            for kind, tasks in [('map', maps), ('result', results)]:
+                start = time.time()
+                datas = [encode(t) for t in tasks]
+                used[kind] += time.time() - start
+                # like a worker running all of them
+                start = time.time()
+                for data in datas:
+                    cPickle.loads(decompress(data))
+                used['decode'] += time.time() - start
+        print '%-10s %d jobs x %d tasks: shuffle map %.3fs (%.1fus/task), ' \
+            'result %.3fs (%.1fus/task), decode %.3fs' % (
+            name, jobs, n, used['map'], used['map'] * 1e6 / n / jobs,
+            used['result'], used['result'] * 1e6 / n / jobs, used['decode'])
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    ctx = DparkContext()
+    ctx.init()
+    logging.getLogger().setLevel(logging.WARNING)
+    bench(ctx)
+    ctx.stop()
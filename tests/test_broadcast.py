@@ -0,0 +1,110 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import new
+import time
+import pickle
+import marshal
+import shutil
+import tempfile
+import threading
+import unittest
+
+from dpark.context import DparkContext
+from dpark.env import env
+from dpark.broadcast import HostStore, Broadcast, P2PBroadcast, numpy
+
+class TestHostStore(unittest.TestCase):
+    def test_receive_once(self):
+        d = tempfile.mkdtemp()
+        try:
+            store = HostStore(os.path.join(d, 'broadcast'))
+            received = []
+            def receive():
+                time.sleep(0.1)
+                received.append(1)
+                return '1' + pickle.dumps(range(10), -1)
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(store.get('uuid', receive)))
+                    for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(received), 1)
+            self.assertEqual(len(set(r[:] for r in results)), 1)
+            b = new.instance(Broadcast, {})
+            self.assertEqual(b.loadObject(results[0]), range(10))
+            self.assertEqual(b.loadObject(store.get('m', lambda: '0' + marshal.dumps({1: 2}))), {1: 2})
+        finally:
+            shutil.rmtree(d)
+
+    def test_clear(self):
+        env.start(True)
+        d = tempfile.mkdtemp()
+        try:
+            store = HostStore(d)
+            b = P2PBroadcast(range(10), False)
+            path = store.fetch(b.uuid, lambda: '0' + marshal.dumps(range(10)))
+            self.assertEqual(sorted(os.listdir(d)), [b.uuid, b.uuid + '.lock'])
+            b.clear()
+            # removed when the next one is stored
+            store.fetch('next', lambda: '0' + marshal.dumps(None))
+            self.assertEqual(sorted(os.listdir(d)), ['next', 'next.lock'])
+        finally:
+            env.stop()
+            shutil.rmtree(d)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_array(self):
+        b = new.instance(Broadcast, {'BlockSize': 1000})
+        d = tempfile.mkdtemp()
+        try:
+            store = HostStore(d)
+            for i, a in enumerate([numpy.arange(10000.0).reshape(100, 100),
+                    numpy.arange(10)[::2], numpy.zeros((0, 3))]):
+                blocks, size = b.blockifyObject(a)
+                s = b.joinBlocks(blocks)
+                # received by this worker, or mapped from the store
+                for c in [b.loadObject(s), b.loadObject(store.get(str(i), lambda: s))]:
+                    self.assertEqual(c.dtype, a.dtype)
+                    self.assertEqual(c.shape, a.shape)
+                    self.assertTrue((c == a).all())
+                    self.assertTrue(c.flags.writeable)
+        finally:
+            shutil.rmtree(d)
+
+
+class TestP2PReceive(unittest.TestCase):
+    def test_receive_blocks(self):
+        ctx = DparkContext('local')
+        ctx.start()
+        value = range(100000)
+        servers = []
+        try:
+            def server(blocks):
+                b = new.instance(P2PBroadcast, {'uuid': 'test', 'stopped': False})
+                b.blocks = blocks
+                b.startServer()
+                servers.append(b)
+                return b.server_addr
+            src = new.instance(P2PBroadcast, {'BlockSize': 4096})
+            blocks, _ = src.blockifyObject(value)
+            n = len(blocks)
+            half = [i % 2 and b or None for i, b in enumerate(blocks)]
+            sources = {server(blocks): [1] * n,
+                    server(half): [i % 2 for i in range(n)]}
+
+            r = new.instance(P2PBroadcast, {'stopped': False, 'server_addr': None})
+            r.blocks = [None] * n
+            self.assertEqual(r.receive_blocks(sources), n)
+            self.assertTrue(all(r.bitmap))
+            self.assertEqual(r.unBlockifyObject(r.blocks), value)
+            self.assertEqual(r.receive_blocks(sources), 0)
+        finally:
+            for b in servers:
+                b.stopServer(b.server_addr)
+            ctx.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
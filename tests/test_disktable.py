@@ -0,0 +1,71 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from dpark.context import DparkContext
+from dpark.broadcast import Broadcast, HostStore, TheBroadcast
+from dpark import disktable
+
+class TestDiskTable(unittest.TestCase):
+    def setUp(self):
+        self.ctx = DparkContext('local')
+        self.ctx.start()
+        self.saved = disktable.CHUNK_SIZE, disktable.DISK_TABLE_THRESHOLD
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        Broadcast.store = None
+        disktable.CHUNK_SIZE, disktable.DISK_TABLE_THRESHOLD = self.saved
+        shutil.rmtree(self.dir)
+        self.ctx.stop()
+
+    def test_lookup(self):
+        ctx = self.ctx
+        disktable.CHUNK_SIZE = 1000
+        rdd = ctx.makeRDD([(i, str(i)) for i in range(1000)], 4)
+        guides = len(TheBroadcast.guides)
+        table = disktable.collect_table(rdd, limit=100)
+        self.assertTrue(isinstance(table, disktable.DiskTable))
+        self.assertTrue(table.nchunks > 1)
+        # all chunks in one broadcast
+        self.assertEqual(len(TheBroadcast.guides), guides + 1)
+        self.assertEqual(len(table), 1000)
+        t = pickle.loads(pickle.dumps(table, -1))
+        self.assertEqual([t[i] for i in range(0, 1000, 7)], [str(i) for i in range(0, 1000, 7)])
+        self.assertFalse(1000 in t)
+        self.assertEqual(t.get(-1), None)
+        self.assertRaises(KeyError, lambda: t[-1])
+
+        disktable.DISK_TABLE_THRESHOLD = 100
+        a = ctx.makeRDD([(i, i) for i in range(0, 2000, 3)], 2)
+        self.assertEqual(sorted(a.innerJoin(rdd).collect()),
+                [(i, (i, str(i))) for i in range(0, 1000, 3)])
+
+        # received by a worker on other host
+        Broadcast.store = HostStore(self.dir)
+        b = pickle.loads(pickle.dumps(table.broadcast, -1))
+        b.origin = os.path.join(self.dir, 'not-exists')
+        self.assertTrue(b.value.startswith(self.dir))
+        self.assertEqual(open(b.value).read(), open(table.broadcast.origin).read())
+
+        path = table.broadcast.origin
+        table.clear()
+        self.assertFalse(os.path.exists(path))
+
+    def test_empty_chunks(self):
+        builder = disktable.DiskTableBuilder(8)
+        builder.add([(1, 'a'), ('b', [2])])
+        table = builder.build()
+        try:
+            self.assertEqual(len(table), 2)
+            self.assertEqual((table[1], table['b']), ('a', [2]))
+            self.assertEqual([k in table for k in range(2, 20)], [False] * 18)
+        finally:
+            table.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
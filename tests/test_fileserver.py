@@ -0,0 +1,47 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import httplib
+import tempfile
+import shutil
+import unittest
+
+from dpark.fileserver import FileServer
+
+class TestFileServer(unittest.TestCase):
+    def test_ranges(self):
+        d = tempfile.mkdtemp()
+        data = ''.join(chr(i % 256) for i in range(100000))
+        with open(os.path.join(d, 'data'), 'wb') as f:
+            f.write(data)
+        server = FileServer(d)
+        port = server.start()
+        conn = httplib.HTTPConnection('localhost', port)
+        def get(path, headers={}):
+            conn.request('GET', path, headers=headers)
+            r = conn.getresponse()
+            return r.status, r.getheader('content-type'), r.read()
+        try:
+            self.assertEqual(get('/data'), (200, 'application/octet-stream', data))
+            # on the same connection
+            self.assertEqual(get('/data', {'Range': 'bytes=10-19'})[::2], (206, data[10:20]))
+            self.assertEqual(get('/data', {'Range': 'bytes=-5'})[::2], (206, data[-5:]))
+            self.assertEqual(get('/data', {'Range': 'bytes=99990-'})[::2], (206, data[-10:]))
+            status, ctype, body = get('/data', {'Range': 'bytes=0-1,50000-50002'})
+            self.assertEqual(status, 206)
+            self.assertTrue(ctype.startswith('multipart/byteranges'))
+            self.assertTrue(data[:2] in body and data[50000:50003] in body)
+            self.assertTrue('Content-Range: bytes 50000-50002/100000' in body)
+            self.assertEqual(get('/data', {'Range': 'bytes=100000-'})[0], 416)
+            self.assertEqual(get('/data', {'Range': 'lines=1-2'})[::2], (200, data))
+            conn.close()
+            self.assertEqual(get('/../data')[0], 200)
+            conn.close()
+            self.assertEqual(get('/none')[0], 404)
+        finally:
+            conn.close()
+            server.stop()
+            shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,20 +8,24 @@ from dpark import pymesos as mesos
 from dpark.pymesos import mesos_pb2 as mesos_pb2
 
 class MockSchduler:
+    def __init__(self):
+        self.killed = []
+        self.ended = []
     def taskEnded(self, task, reason, result, update):
-        pass
+        self.ended.append((task.id, reason))
     def requestMoreResources(self):
         pass
     def jobFinished(self, job):
         pass
     def killTask(self, job_id, task_id, tried):
-        pass
+        self.killed.append((task_id, tried))
 
 class MockTask:
-    def __init__(self, id):
+    def __init__(self, id, locs=[]):
         self.id = id
+        self.locs = locs
     def preferredLocations(self):
-        return []
+        return self.locs
 
 class TestJob(unittest.TestCase):
     def test_job(self):
@@ -50,6 +54,100 @@ class TestJob(unittest.TestCase):
         job.statusUpdate(t.id, 1, mesos_pb2.TASK_FINISHED)
         assert job.tasksFinished == 10
 
+    def test_speculation(self):
+        sched = MockSchduler()
+        tasks = [MockTask(i) for i in range(4)]
+        job = SimpleJob(sched, tasks)
+        ts = [job.slaveOffer('localhost') for i in range(4)]
+        [job.statusUpdate(t.id, 1, mesos_pb2.TASK_RUNNING) for t in ts]
+        [job.statusUpdate(t.id, 1, mesos_pb2.TASK_FINISHED) for t in ts[:3]]
+        assert job.check_task_timeout() is False
+        ts[3].start -= 100
+        job.last_check = 0
+        assert job.check_task_timeout() is True
+        assert job.slaveOffer('localhost') is None # on different host
+        t = job.slaveOffer('localhost1')
+        assert t.id == 3 and t.tried == 2
+        assert job.slaveOffer('localhost2') is None
+        job.statusUpdate(t.id, 2, mesos_pb2.TASK_FINISHED)
+        assert job.tasksFinished == 4
+        assert sched.killed == [(3, 1)]
+        job.statusUpdate(t.id, 1, mesos_pb2.TASK_KILLED)
+        assert job.tasksFinished == 4
+
+    def test_speculated_failure(self):
+        sched = MockSchduler()
+        tasks = [MockTask(i) for i in range(4)]
+        job = SimpleJob(sched, tasks)
+        ts = [job.slaveOffer('localhost') for i in range(4)]
+        [job.statusUpdate(t.id, 1, mesos_pb2.TASK_RUNNING) for t in ts]
+        [job.statusUpdate(t.id, 1, mesos_pb2.TASK_FINISHED) for t in ts[:3]]
+        ts[3].start -= 100
+        start = ts[3].start
+        job.last_check = 0
+        assert job.check_task_timeout() is True
+        t = job.slaveOffer('localhost1')
+        job.statusUpdate(t.id, 2, mesos_pb2.TASK_RUNNING)
+        assert t.start == start
+        # the first attempt failed, the speculative one is still running
+        job.statusUpdate(t.id, 1, mesos_pb2.TASK_FAILED)
+        assert t.start == start
+        assert t.status == mesos_pb2.TASK_RUNNING
+        assert job.numRunning[3] == 1
+        assert job.slaveOffer('localhost2') is None
+        job.statusUpdate(t.id, 2, mesos_pb2.TASK_FINISHED)
+        assert job.tasksFinished == 4
+
+    def test_wait_for_running(self):
+        sched = MockSchduler()
+        job = SimpleJob(sched, [MockTask(0)])
+        t = job.slaveOffer('localhost')
+        t.start -= WAIT_FOR_RUNNING + 1
+        assert job.check_task_timeout() is True
+        assert sched.killed == [(0, 1)]
+        assert job.slaveOffer('localhost1') is t
+        job.statusUpdate(t.id, 2, mesos_pb2.TASK_RUNNING)
+        # the re-assigned attempt is not counted again
+        job.statusUpdate(t.id, 1, mesos_pb2.TASK_KILLED)
+        assert job.numRunning[0] == 1
+        assert job.numFailures[0] == 0
+        assert job.slaveOffer('localhost2') is None
+        job.statusUpdate(t.id, 2, mesos_pb2.TASK_FINISHED)
+        assert job.tasksFinished == 1
+
+    def test_fetch_failed(self):
+        from dpark.schedule import FetchFailed, Success
+        sched = MockSchduler()
+        tasks = [MockTask(i) for i in range(4)]
+        job = SimpleJob(sched, tasks)
+        ts = [job.slaveOffer('localhost') for i in range(2)]
+        job.statusUpdate(ts[1].id, 1, mesos_pb2.TASK_FINISHED)
+        reason = FetchFailed(None, 1, 0, 0)
+        job.statusUpdate(ts[0].id, 1, mesos_pb2.TASK_FAILED, reason)
+        t = job.slaveOffer('localhost1')
+        self.assertEqual(t.id, 0)
+        job.statusUpdate(t.id, 2, mesos_pb2.TASK_FAILED, reason)
+        # the tasks not launched are cancelled with it
+        self.assertEqual([(i, r is reason) for i, r in sched.ended
+            if not isinstance(r, Success)], [(0, True), (2, True), (3, True)])
+        self.assertEqual(job.tasksFinished, 4)
+
+    def test_locality(self):
+        sched = MockSchduler()
+        tasks = [MockTask(i, ['host%d' % (i % 2)]) for i in range(4)]
+        job = SimpleJob(sched, tasks)
+        t = job.slaveOffer('host0', rack='r0')
+        assert t.id == 0
+        job.slaveOffer('host1', rack='r1')
+        assert job.slaveOffer('host2', rack='r0') is None # wait for host0
+        job.lastLaunchTime -= LOCALITY_WAIT
+        t = job.slaveOffer('host2', rack='r0')
+        assert t.id == 2 # rack local
+        assert job.slaveOffer('host3') is None # wait for rack r1
+        job.lastLaunchTime -= LOCALITY_WAIT + LOCALITY_WAIT_RACK
+        assert job.slaveOffer('host3').id == 3
+        assert job.localityLaunched == [2, 1, 1, 0]
+
 if __name__ == '__main__':
     sys.path.append('../')
     logging.basicConfig(level=logging.INFO)
@@ -34,6 +34,7 @@ class TestRDD(unittest.TestCase):
         self.assertEqual(nums.filter(lambda x:x>1).collect(), [2, 3])
         self.assertEqual(nums.flatMap(lambda x:range(x)).collect(), [0, 0,1, 0,1,2])
         self.assertEqual(nums.union(nums).collect(), d + d)
+        self.assertEqual(list(nums.toLocalIterator()), d)
         self.assertEqual(nums.cartesian(nums).map(lambda (x,y):x*y).reduce(lambda x,y:x+y), 36)
         self.assertEqual(nums.glom().map(lambda x:list(x)).collect(),[[0,1],[2,3]])
         self.assertEqual(nums.mapPartitions(lambda x:[sum(x)]).collect(),[1, 5])
@@ -250,6 +251,21 @@ class TestRDD(unittest.TestCase):
         rdd = self.sc.makeRDD(l, p)
         self.assertEqual(sorted(rdd.enumeratePartition().collect()), d1)
         self.assertEqual(sorted(rdd.enumerate().collect()), d2)
+
+    def test_concurrent_jobs(self):
+        import threading
+        rdd = self.sc.makeRDD(range(100), 4).map(lambda x:(x%10, x)).reduceByKey(lambda x,y:x+y, 3)
+        expected = sorted(rdd.collect())
+        results = {}
+        def run(i):
+            results[i] = sorted(rdd.mapValue(lambda v:v+i).collect())
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(4):
+            self.assertEqual(results[i], [(k, v+i) for k,v in expected])
     
 #class TestRDDInProcess(TestRDD):
 #    def setUp(self):
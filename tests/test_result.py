@@ -0,0 +1,63 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import unittest
+import zmq
+
+from dpark.env import env
+from dpark.result import (ResultServer, send_result, RESULT_CHUNK_SIZE,
+    RESULT_DISCARD_TIMEOUT)
+
+class TestResult(unittest.TestCase):
+    def test_stream(self):
+        env.start(True)
+        server = ResultServer()
+        server.start()
+        data = os.urandom(1024) * (RESULT_CHUNK_SIZE / 1024 * 3 + 10)
+        send_result(server.addr, '1:1:1', data)
+        send_result(server.addr, '1:2:1', '')
+        self.assertEqual(server.get('1:1:1'), data)
+        self.assertEqual(server.get('1:2:1'), '')
+        self.assertRaises(IOError, server.get, '1:3:1', 0.1)
+
+        # an attempt failed while sending
+        sock = env.ctx.socket(zmq.PUSH)
+        sock.connect(server.addr)
+        try:
+            sock.send_multipart(['1:4:1', 'part'])
+            while '1:4:1' not in server.chunks:
+                time.sleep(0.01)
+            server.discard('1:4:1')
+            sock.send_multipart(['1:4:1', 'rest'])
+            sock.send_multipart(['1:4:1', ''])
+            # in order on the same socket
+            sock.send_multipart(['1:5:1', 'next'])
+            sock.send_multipart(['1:5:1', ''])
+            self.assertEqual(server.get('1:5:1'), 'next')
+            self.assertEqual(server.chunks, {})
+            self.assertEqual(server.finished, set())
+            # only the one timed out, its chunks may come later
+            self.assertEqual(server.discarded.keys(), ['1:3:1'])
+
+            # dropped before the first chunk arrived
+            server.discard('1:6:1')
+            sock.send_multipart(['1:6:1', 'late'])
+            sock.send_multipart(['1:6:1', ''])
+            sock.send_multipart(['1:7:1', 'next'])
+            sock.send_multipart(['1:7:1', ''])
+            self.assertEqual(server.get('1:7:1'), 'next')
+            self.assertEqual(server.chunks, {})
+            self.assertEqual(server.discarded.keys(), ['1:3:1'])
+
+            # the chunks never come
+            server.discard('1:8:1')
+            for k in server.discarded:
+                server.discarded[k] -= RESULT_DISCARD_TIMEOUT + 1
+            server.discard('1:9:1')
+            self.assertEqual(server.discarded.keys(), ['1:9:1'])
+        finally:
+            sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import sys
+import os
 import pickle
 import unittest
 
@@ -16,6 +17,565 @@ class MockDriver:
         self.tasks.extend(tasks)
 
 
+class MockRDD:
+    id = 0
+    mem = 0
+    dependencies = []
+
+class MockTask(Task):
+    rdd = MockRDD()
+    def preferredLocations(self):
+        return []
+
+class MockLocalTask(MockTask):
+    def preferredLocations(self):
+        return ['nohost']
+
+class MockOfferDriver:
+    def __init__(self):
+        self.launched = []
+    def reviveOffers(self):
+        pass
+    def launchTasks(self, oid, tasks, filters=None):
+        self.launched.extend(tasks)
+
+def make_offer(i, cpus=4, mem=10000):
+    offer = mesos_pb2.Offer()
+    offer.id.value = 'offer%d' % i
+    offer.framework_id.value = 'test'
+    offer.slave_id.value = 'slave%d' % i
+    offer.hostname = 'host%d' % i
+    for name, value in [('cpus', cpus), ('mem', mem)]:
+        r = offer.resources.add()
+        r.name = name
+        r.type = mesos_pb2.Value.SCALAR
+        r.scalar.value = value
+    return offer
+
+
+def make_sched():
+    env.start(True)
+    options = parse_options()
+    options.pool = 'batch'
+    options.parallel = 4
+    sched = MesosScheduler('localhost:5050', options)
+    sched.pools['adhoc'] = Pool('adhoc', minShare=4)
+    sched.driver = MockOfferDriver()
+    sched.executor = mesos_pb2.ExecutorInfo()
+    sched.started = sched.isRegistered = True
+    return sched
+
+
+class TestPool(unittest.TestCase):
+    def test_key(self):
+        high = Pool('high', priority=1)
+        needy = Pool('needy', minShare=10)
+        heavy = Pool('heavy', weight=4)
+        light = Pool('light')
+        pools = [(light, 2), (heavy, 4), (needy, 5), (high, 100)]
+        pools.sort(key=lambda (p, running): p.key(running))
+        self.assertEqual([p.name for p,_ in pools], ['high', 'needy', 'heavy', 'light'])
+
+    def test_offers(self):
+        sched = make_sched()
+        sched.submitTasks([MockTask() for i in range(20)])
+        sched.setPool('adhoc')
+        sched.submitTasks([MockTask() for i in range(4)])
+        batch, adhoc = sorted(sched.activeJobs.values(), key=lambda j: j.id)
+
+        sched.resourceOffers(sched.driver, [make_offer(i) for i in range(2)])
+        self.assertEqual(len(sched.driver.launched), 8)
+        self.assertEqual(len(sched.jobTasks[adhoc.id]), 4)
+        self.assertEqual(len(sched.jobTasks[batch.id]), 4)
+        self.assertEqual(sched.pools['adhoc'].numJobs, 1)
+
+    def test_blocked_job(self):
+        sched = make_sched()
+        sched.submitTasks([MockTask() for i in range(100)])
+        sched.setPool('adhoc')
+        sched.submitTasks([MockLocalTask()]) # waiting for its host
+        batch, adhoc = sorted(sched.activeJobs.values(), key=lambda j: j.id)
+        calls = []
+        slaveOffer = adhoc.slaveOffer
+        adhoc.slaveOffer = lambda *a: calls.append(a) or slaveOffer(*a)
+
+        offers = [make_offer(i) for i in range(10)]
+        sched.resourceOffers(sched.driver, offers)
+        self.assertEqual(len(sched.jobTasks[batch.id]), 40)
+        self.assertEqual(len(sched.jobTasks[adhoc.id]), 0)
+        self.assertEqual(len(calls), len(offers))
+
+
+    def test_urgent_job(self):
+        sched = make_sched()
+        sched.submitTasks([MockTask() for i in range(8)]) # reduce tasks
+        sched.resourceOffers(sched.driver, [make_offer(0)])
+        reduces, = sched.activeJobs.values()
+        # map outputs lost after the reduce tasks started
+        maps = [MockTask() for i in range(2)]
+        for t in maps:
+            t.urgent = True
+        sched.submitTasks(maps)
+        self.assertEqual(sched.pools['batch'].jobs[0].urgent, True)
+        sched.resourceOffers(sched.driver, [make_offer(1)])
+        launched = sched.driver.launched[4:]
+        self.assertEqual(len(launched), 4)
+        self.assertEqual(sorted(t.task_id.value.split(':')[1] for t in launched[:2]),
+            sorted(str(t.id) for t in maps))
+
+
+class TestStatusUpdate(unittest.TestCase):
+    def test_result_out_of_lock(self):
+        import marshal
+        from dpark.util import compress
+        sched = make_sched()
+        sched.submitTasks([MockTask()])
+        sched.resourceOffers(sched.driver, [make_offer(0)])
+        job, = sched.activeJobs.values()
+        tid = sched.driver.launched[0].task_id.value
+        locked = []
+        class MockResultServer:
+            def get(self, key):
+                def check(): # by other thread, it's a RLock
+                    free = sched.lock.acquire(False)
+                    if free:
+                        sched.lock.release()
+                    locked.append(not free)
+                t = threading.Thread(target=check)
+                t.start()
+                t.join()
+                return compress(marshal.dumps('result'))
+            def discard(self, key):
+                pass
+        sched.resultServer = MockResultServer()
+        results = []
+        job.statusUpdate = lambda *a: results.append(a)
+
+        status = mesos_pb2.TaskStatus()
+        status.task_id.value = tid
+        status.state = mesos_pb2.TASK_FINISHED
+        status.data = pickle.dumps((Success(), (2, None), {}, 0))
+        sched.statusUpdate(sched.driver, status)
+        self.assertEqual(locked, [False])
+        self.assertTrue(isinstance(results[0][3], Success))
+        self.assertEqual(results[0][4], 'result')
+
+
+class TestMemoryHistory(unittest.TestCase):
+    def test_signature(self):
+        from dpark.context import DparkContext
+        ctx = DparkContext('local')
+        def stage(n, f=lambda x:x+1):
+            rdd = ctx.makeRDD(range(n), 2).map(f).map(lambda x:(x,1))
+            return ResultTask(1, rdd, list, 0, [], 0)
+        self.assertEqual(stage_signature(stage(10)), stage_signature(stage(100)))
+        self.assertNotEqual(stage_signature(stage(10)),
+            stage_signature(stage(10, lambda x:x-1)))
+
+    def test_history(self):
+        import tempfile, shutil
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'history')
+            h = MemoryHistory(path)
+            self.assertEqual(h.get('sig'), None)
+            h.update('sig', 1000)
+            h.save()
+            self.assertEqual(MemoryHistory(path).get('sig'), 1201)
+            h.update('sig', 100) # a run on small input
+            self.assertEqual(h.history['sig'], 900)
+            h.update('sig', 2000)
+            self.assertEqual(h.history['sig'], 2000)
+        finally:
+            shutil.rmtree(d)
+
+    def test_explicit_memory(self):
+        sched = make_sched()
+        sched.memoryHistory = MemoryHistory(None)
+        task = MockTask()
+        sig = stage_signature(task)
+        sched.memoryHistory.update(sig, 100)
+        sched.submitTasks([task])
+        self.assertEqual(task.mem, 121)
+
+        class BigRDD(MockRDD):
+            mem = 2000 # by taskMemory
+        task = MockTask()
+        task.rdd = BigRDD()
+        sig = stage_signature(task)
+        sched.memoryHistory.update(sig, 100)
+        sched.submitTasks([task])
+        self.assertEqual(task.mem, 2000)
+        sched.memoryHistory.update(sig, 3000)
+        sched.submitTasks([task])
+        self.assertEqual(task.mem, 3601)
+
+    def test_explicit_option(self):
+        argv = sys.argv
+        sys.argv = ['test', '-M', '500']
+        try:
+            sched = make_sched()
+        finally:
+            sys.argv = argv
+        self.assertTrue(sched.options.explicit_mem)
+        sched.memoryHistory = MemoryHistory(None)
+        task = MockTask()
+        sched.memoryHistory.update(stage_signature(task), 100)
+        sched.submitTasks([task])
+        self.assertEqual(task.mem, 500)
+
+
+class TestLocalThreads(unittest.TestCase):
+    def test_threads(self):
+        import threading
+        from dpark.context import DparkContext
+        ctx = DparkContext('local[4]')
+        try:
+            acc = ctx.accumulator(0)
+            def f(x):
+                acc.add(1)
+                return (x % 10, threading.current_thread().name)
+            rdd = ctx.makeRDD(range(100), 8).map(f)
+            self.assertEqual(sorted(rdd.map(lambda (k, v): k).collect()), sorted(range(10) * 10))
+            self.assertEqual(acc.value, 100)
+            names = rdd.notThreadSafe().map(lambda (k, v): v).collect()
+            self.assertEqual(set(names), set([threading.current_thread().name]))
+            self.assertEqual(acc.value, 200)
+        finally:
+            ctx.stop()
+
+
+class TestForkScheduler(unittest.TestCase):
+    def test_fork(self):
+        from dpark.context import DparkContext
+        ctx = DparkContext('fork')
+        try:
+            acc = ctx.accumulator(0)
+            big = ctx.broadcast(range(1000))
+            def f(x):
+                acc.add(1)
+                return (x % 10, x + len(big.value))
+            rdd = ctx.makeRDD(range(100), 8).map(f).reduceByKey(lambda x,y:x+y, 3)
+            self.assertEqual(sorted(rdd.collect()),
+                [(k, sum(x + 1000 for x in range(k, 100, 10))) for k in range(10)])
+            self.assertEqual(acc.value, 100)
+            self.assertRaises(Exception, ctx.makeRDD(range(10), 2).map(lambda x:1/0).collect)
+        finally:
+            ctx.stop()
+
+    def test_held_logging_lock(self):
+        # another thread of the driver is writing a log while forking
+        from dpark.context import DparkContext
+        handler = logging.StreamHandler(open(os.devnull, 'w'))
+        log = logging.getLogger('test_fork')
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        ctx = DparkContext('fork')
+        try:
+            ctx.start()
+            handler.acquire()
+            def f(x):
+                log.info('in worker %s', x)
+                return x
+            result = []
+            t = spawn(lambda: result.extend(ctx.makeRDD(range(4), 2).map(f).collect()))
+            t.join(10)
+            handler.release()
+            t.join(10)
+            self.assertEqual(result, range(4))
+        finally:
+            ctx.stop()
+            log.removeHandler(handler)
+
+
+class MockDAGScheduler(LocalScheduler):
+    "keep the tasks, they are finished by the test"
+    def __init__(self):
+        LocalScheduler.__init__(self)
+        self.submitted = Queue.Queue()
+
+    def submitTasks(self, tasks):
+        for t in tasks:
+            self.submitted.put(t)
+
+    def finish(self, task, reason, result=None):
+        self.taskEnded(task, reason, result, {})
+
+
+class TestSlowStart(unittest.TestCase):
+    def test_fetch_failed(self):
+        import dpark.schedule
+        from dpark.context import DparkContext
+        ctx = DparkContext('local')
+        ctx.start()
+        timeout = dpark.schedule.RESUBMIT_TIMEOUT
+        dpark.schedule.RESUBMIT_TIMEOUT = 0
+        try:
+            sched = MockDAGScheduler()
+            sched.slowStart = 0.5
+            rdd = ctx.makeRDD(range(4), 4).map(lambda x:(x, 1)).reduceByKey(lambda x,y:x+y, 2)
+            results = []
+            t = threading.Thread(target=lambda: results.extend(
+                sched.runJob(rdd, lambda it: 'done', range(2), False)))
+            t.daemon = True
+            t.start()
+            get = lambda: sched.submitted.get(timeout=5)
+
+            maps = [get() for i in range(4)]
+            sched.finish(maps[0], Success(), 'host1')
+            sched.finish(maps[1], Success(), 'host1')
+            # started by slow start, map stage is still running
+            reduces = [get(), get()]
+            self.assertTrue(all(isinstance(r, ResultTask) for r in reduces))
+            sched.finish(reduces[0], FetchFailed('host1', maps[0].shuffleId, 0, 0))
+            sched.finish(maps[2], Success(), 'host2')
+            # outputs lost on host1 are computed again
+            again = [get(), get()]
+            self.assertEqual(sorted(m.partition for m in again), [0, 1])
+            # before the waiting reduce tasks
+            self.assertTrue(all(m.urgent for m in again))
+            for m in again + maps[3:]:
+                sched.finish(m, Success(), 'host2')
+            sched.finish(reduces[1], Success(), 'done')
+            for r in iter(lambda: sched.submitted.get(timeout=5), None):
+                if isinstance(r, ResultTask) and r.partition == 0:
+                    sched.finish(r, Success(), 'done')
+                    break
+            t.join(5)
+            self.assertEqual(results, ['done', 'done'])
+        finally:
+            dpark.schedule.RESUBMIT_TIMEOUT = timeout
+            ctx.stop()
+
+    def test_option(self):
+        argv = sys.argv
+        try:
+            for v in ['0', '1.5']:
+                sys.argv = ['test', '--slow-start', v]
+                self.assertRaises(SystemExit, parse_options)
+            sys.argv = ['test', '--slow-start', '0.5']
+            self.assertEqual(parse_options().slow_start, 0.5)
+        finally:
+            sys.argv = argv
+
+
+class TestSplitTasks(unittest.TestCase):
+    def test_split(self):
+        import tempfile, shutil
+        import dpark.rdd
+        from dpark.context import DparkContext
+        from dpark.tracker import GetValueMessage, SetValueMessage
+        ctx = DparkContext('local')
+        ctx.start()
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'lines')
+            lines = ['%08d' % i for i in range(300000)]
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            rdd = ctx.textFile(path, splitSize=2 << 20)
+            self.assertFalse(Stage(rdd.map(str), None, []).splittable)
+            self.assertFalse(Stage(rdd.mapPartitions(list), object(), []).splittable)
+            self.assertFalse(Stage(rdd.map(str).cache(), object(), []).splittable)
+            stage = Stage(rdd.map(str).filter(bool), object(), [])
+            self.assertTrue(stage.splittable)
+
+            dpark.rdd.SPLIT_CHECK_INTERVAL = 0
+            split = PartialSplit(0, 0, rdd.splits[0].end)
+            split.ctrl = 'split:test'
+            client = env.trackerClient
+            client.call(SetValueMessage(split.ctrl, [3]))
+            first = list(rdd.compute(split))
+            self.assertFalse(client.call(GetValueMessage(split.ctrl)))
+            cut, end = client.call(GetValueMessage(split.ctrl + ':reply'))
+            self.assertEqual(end, split.end)
+            self.assertTrue(0 < cut < end)
+
+            added = stage.splitPartition(0, cut, end, 3)
+            self.assertEqual(added, range(len(rdd), len(rdd) + 3))
+            self.assertEqual(stage.numPartitions, len(rdd) + 3)
+            self.assertEqual(len(stage.outputLocs), stage.numPartitions)
+            self.assertEqual(stage.getSplit(0).end, cut)
+            self.assertEqual(stage.getSplit(1), rdd.splits[1])
+            got = first
+            for p in added:
+                got.extend(rdd.compute(stage.getSplit(p)))
+            self.assertEqual(got, list(rdd.compute(rdd.splits[0])))
+
+            # the keys are removed from tracker after the stage finished
+            sched = LocalScheduler()
+            task = MockTask()
+            task.stageId, task.split = stage.id, split
+            sched.requestSplit(task, 2)
+            self.assertEqual(client.call(GetValueMessage(split.ctrl)), [2])
+            sched.clearSplits(stage)
+            self.assertFalse(sched.splitKeys)
+            self.assertTrue(split.ctrl not in env.trackerServer.locs)
+            self.assertTrue(split.ctrl + ':reply' not in env.trackerServer.locs)
+        finally:
+            ctx.stop()
+            shutil.rmtree(d)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profile(self):
+        from cStringIO import StringIO
+        from dpark import profiler
+        from dpark.accumulator import Accumulator, Profiles
+        class ProfiledTask(DAGTask):
+            def run(self, aid):
+                return sum(i for i in range(10000))
+        class MockStage:
+            id = 1000
+        stage = MockStage()
+        for i in range(3):
+            Accumulator.clear()
+            self.assertEqual(profiler.run_task(ProfiledTask(stage.id), 1), 49995000)
+            Accumulator.merge(Accumulator.values())
+        stats = Profiles.value[stage.id]
+        run = [v for (path, line, func), v in stats.items() if func == 'run']
+        self.assertEqual(len(run), 1)
+        self.assertEqual(run[0][1], 3) # called by 3 tasks
+        out = StringIO()
+        profiler.report([stage], out=out)
+        self.assertTrue('Profile of %s' % stage in out.getvalue())
+        self.assertTrue('test_schedule' in out.getvalue())
+        self.assertFalse(stage.id in Profiles.value)
+
+
+class TestTrace(unittest.TestCase):
+    def test_trace(self):
+        import json, time, tempfile, shutil
+        from dpark.trace import JobTrace
+        class MockStage:
+            id = 1
+        stage = MockStage()
+        jobTrace = JobTrace(1, 'rdd')
+        tasks = [DAGTask(stage.id) for i in range(3)]
+        for t in tasks:
+            jobTrace.taskSubmitted(t)
+        jobTrace.stageSubmitted(stage, len(tasks))
+        jobTrace.taskLaunched(tasks[0], 'host1')
+        jobTrace.taskLaunched(tasks[1], 'host1')
+        jobTrace.taskRunning(tasks[0])
+        jobTrace.taskEnded(tasks[1], 'TASK_LOST', final=False)
+        jobTrace.taskLaunched(tasks[1], 'host2')
+        now = time.time()
+        jobTrace.taskEnded(tasks[0], Success(), [('fetch', now - 0.01, now)])
+        jobTrace.taskEnded(tasks[1], Success())
+        jobTrace.taskEnded(tasks[2], OtherFailure('error'))
+        jobTrace.stageFinished(stage)
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'trace', 'job.json')
+            jobTrace.save(path)
+            events = json.load(open(path))['traceEvents']
+        finally:
+            shutil.rmtree(d)
+        slices = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(sorted(e['name'] for e in slices), ['fetch', 'job 1',
+            'stage 1', 'task %d' % tasks[0].id, 'task %d' % tasks[1].id,
+            'task %d' % tasks[1].id, 'task %d' % tasks[2].id])
+        hosts = dict((e['args']['name'], e['pid']) for e in events
+            if e['name'] == 'process_name')
+        self.assertEqual(sorted(hosts), ['driver', 'host1', 'host2', 'localhost'])
+        lost, = [e for e in slices if e['args'].get('reason') == 'TASK_LOST']
+        self.assertEqual(lost['pid'], hosts['host1'])
+        self.assertFalse(jobTrace.tasks)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        from dpark import metrics
+        from dpark.accumulator import Accumulator, TaskMetrics
+        self.assertEqual(metrics.quantiles(range(101)[::-1]), [0, 25, 50, 75, 100])
+        self.assertEqual(metrics.quantiles([3]), [3] * 5)
+
+        Accumulator.clear()
+        TaskMetrics.add({'fetchBytes': 100, 'fetchTime': 0.5})
+        TaskMetrics.add({'fetchBytes': 200, 'fetchTime': 0.5})
+        record = Accumulator.values()[TaskMetrics.id]
+        self.assertEqual(record, {'fetchBytes': 300, 'fetchTime': 1.0})
+
+        records = [record, {'fetchBytes': 1 << 20, 'fetchTime': 2.0, 'inputRecords': 10}]
+        lines = metrics.summarize('<Stage(1)>', records)
+        self.assertTrue('2 tasks in <Stage(1)>' in lines[0])
+        self.assertEqual([l.split()[0] for l in lines[1:]],
+            ['inputRecords', 'fetchBytes', 'fetchTime'])
+        self.assertEqual(lines[2].split()[1:], ['300.0B'] * 4 + ['1024.0KB'])
+
+
+class TestStatus(unittest.TestCase):
+    def test_status(self):
+        import json, urllib2
+        from dpark.context import DparkContext
+        from dpark.web import StatusServer
+        ctx = DparkContext('local')
+        ctx.start()
+        server = StatusServer(ctx.scheduler, 0)
+        server.start()
+        url = 'http://localhost:%d' % server.server_address[1]
+        try:
+            seen = []
+            def f(x):
+                if not seen:
+                    seen.append(json.load(urllib2.urlopen(url + '/api/jobs')))
+                    seen.append(urllib2.urlopen(url + '/').read())
+                return x
+            rdd = ctx.makeRDD(range(10), 2).cache()
+            rdd.map(lambda x:(x % 3, 1)).reduceByKey(lambda x,y:x+y, 2).map(f).collect()
+            jobs, text = seen
+            self.assertEqual(len(jobs), 1)
+            self.assertEqual(jobs[0]['partitions'], 2)
+            self.assertEqual(jobs[0]['finished'], 0)
+            self.assertEqual([s['state'] for s in jobs[0]['stages']], ['running'])
+            self.assertTrue(text.startswith('job %d:' % jobs[0]['id']))
+
+            status = json.load(urllib2.urlopen(url + '/api/status'))
+            self.assertEqual(status['jobs'], [])
+            shuffle, = status['shuffles']
+            self.assertEqual(shuffle['available'], 2)
+            self.assertTrue(shuffle['bytes'] > 0)
+            cache, = [c for c in status['cache'] if c['rdd'] == rdd.id]
+            self.assertEqual(cache['partitions'], 2)
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + '/api/none')
+        finally:
+            server.stop()
+            ctx.stop()
+
+
+class TestDecodedBinary(unittest.TestCase):
+    def test_decode_once(self):
+        from dpark.serialize import dump_func
+        class MockBinary:
+            def __init__(self, uuid, value):
+                self.uuid = uuid
+                self.value = value
+        b1 = MockBinary('stage-1', (None, dump_func(lambda x: x + 1)))
+        b2 = MockBinary('stage-2', (None, dump_func(lambda x: x + 2)))
+        import new
+        tasks = []
+        for b in [b1, b1, b2]:
+            t = new.instance(ResultTask, {})
+            t.__setstate__(({'binary': b}, None)) # as in workers
+            tasks.append(t)
+        self.assertEqual([t.func(1) for t in tasks], [2, 2, 3])
+        self.assertTrue(tasks[0].func is tasks[1].func)
+        self.assertFalse(tasks[0].func is tasks[2].func)
+
+    def test_not_in_driver(self):
+        class BrokenBinary:
+            uuid = 'stage-3'
+            @property
+            def value(self):
+                raise Exception("loaded in driver")
+        import new
+        t = new.instance(ResultTask, {'binary': BrokenBinary()})
+        self.assertEqual(getattr(t, 'splitting', False), False)
+        self.assertEqual(getattr(t, 'host', None), None)
+        self.assertFalse('stage-3' in DAGTask.decoded)
+
+
 class TestScheduler(unittest.TestCase):
     def setUp(self):
         return
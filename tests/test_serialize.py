@@ -0,0 +1,43 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+
+from dpark import serialize
+from dpark.serialize import dump_func, load_func, loads
+from dpark.rdd import Split
+
+class TestFuncCache(unittest.TestCase):
+    def test_dump_once(self):
+        words = ['a']
+        fs = [lambda x, i=i: (x + i, words) for i in range(3)]
+        self.assertTrue(dump_func(fs[0]) is dump_func(fs[0]))
+        self.assertEqual([load_func(dump_func(f))(1) for f in fs],
+            [(1, ['a']), (2, ['a']), (3, ['a'])])
+        b = dump_func(fs[0])
+        words.append('b') # changed in place
+        self.assertNotEqual(dump_func(fs[0]), b)
+        self.assertEqual(load_func(dump_func(fs[0]))(0), (0, ['a', 'b']))
+
+    def test_changed_instance(self):
+        conf = Split(1)
+        f = lambda x: x * conf.index
+        n = len(serialize.dumped_funcs)
+        self.assertEqual(loads(dump_func(f))(10), 10)
+        conf.index = 3
+        self.assertEqual(loads(dump_func(f))(10), 30)
+        self.assertEqual(len(serialize.dumped_funcs), n)
+
+    def test_new_function_per_load(self):
+        seen = set()
+        def f(x):
+            seen.add(x)
+            return len(seen)
+        b = dump_func(f)
+        f1, f2 = load_func(b), load_func(b)
+        self.assertFalse(f1 is f2)
+        self.assertEqual(f1(1), 1)
+        self.assertEqual(f2(2), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+import multiprocessing
+
+from dpark.context import DparkContext
+from dpark.util import set_memory_pressure_flag
+from dpark.env import env
+from dpark.shuffle import SpillMerger, DiskMerger, CoGroupMerger, sorted_items, ShuffleFetcher
+from dpark.schedule import FetchFailed
+from dpark.rdd import Split
+
+class TestMemoryPressure(unittest.TestCase):
+    def setUp(self):
+        self.ctx = DparkContext('local')
+        self.ctx.start()
+        self.flag = multiprocessing.RawValue('b', 0)
+        set_memory_pressure_flag(self.flag)
+
+    def tearDown(self):
+        set_memory_pressure_flag(None)
+        self.ctx.stop()
+
+    def test_spill(self):
+        flag = self.flag
+        def press(x):
+            if x % 3000 == 0:
+                flag.value = 1 # set by executor
+            return x
+        rdd = self.ctx.makeRDD(range(10000), 2).map(press).map(lambda x:(x % 100, 1))
+        self.assertEqual(rdd.reduceByKey(lambda x,y:x+y, 3).collectAsMap(),
+                dict((i, 100) for i in range(100)))
+        self.assertEqual(flag.value, 0)
+
+        for cls in [SpillMerger, DiskMerger]:
+            m = cls(10, lambda x,y:x+y)
+            flag.value = 1
+            m.merge([(1, 1), (2, 1)])
+            m.merge([(1, 1)])
+            self.assertEqual(len(m.archives), 1)
+            self.assertEqual(sorted(m), [(1, 2), (2, 1)])
+
+        m = CoGroupMerger(2)
+        flag.value = 1
+        m.append(0, [(1, 'a'), (2, 'b')])
+        flag.value = 1
+        m.extend(1, [(1, ['c']), (3, ['d'])])
+        self.assertEqual(len(m.archives), 2)
+        self.assertEqual(sorted(m), [(1, (['a'], ['c'])), (2, (['b'], [])),
+            (3, ([], ['d']))])
+
+    def test_spill_unmarshalable(self):
+        items = list(sorted_items([(2, Split(2)), (1, Split(1))]))
+        self.assertEqual([(k, v.index) for k, v in items], [(1, 1), (2, 2)])
+
+        def merge(x, y):
+            return Split(x.index + y.index)
+        m = SpillMerger(10, merge)
+        m.merge([(1, Split(1)), (2, Split(2))])
+        self.flag.value = 1
+        m.merge([(1, Split(10))])
+        self.assertEqual(len(m.archives), 1)
+        m.merge([(2, Split(20))])
+        self.assertEqual(sorted((k, v.index) for k, v in m), [(1, 11), (2, 22)])
+
+
+class MockOutputTracker:
+    def __init__(self, uris):
+        self.uris = uris
+    def getServerUris(self, shuffleId):
+        return list(self.uris)
+
+class MockFetcher(ShuffleFetcher):
+    def __init__(self):
+        self.fetched = []
+    def fetch_parts(self, shuffleId, reduceId, parts, func):
+        self.fetched.extend(part for part, _ in parts)
+        return 0
+
+class TestLateOutput(unittest.TestCase):
+    def setUp(self):
+        import dpark.shuffle
+        self.wait = dpark.shuffle.LATE_OUTPUT_WAIT, dpark.shuffle.LATE_OUTPUT_TIMEOUT
+        dpark.shuffle.LATE_OUTPUT_WAIT = 0.01
+        dpark.shuffle.LATE_OUTPUT_TIMEOUT = 0.1
+        self.tracker = getattr(env, 'mapOutputTracker', None)
+
+    def tearDown(self):
+        import dpark.shuffle
+        dpark.shuffle.LATE_OUTPUT_WAIT, dpark.shuffle.LATE_OUTPUT_TIMEOUT = self.wait
+        env.mapOutputTracker = self.tracker
+
+    def test_lost_output(self):
+        # the map output is lost after the reduce task started
+        env.mapOutputTracker = MockOutputTracker(['host1', None])
+        fetcher = MockFetcher()
+        try:
+            fetcher.fetch(1, 0, None)
+            self.fail('no FetchFailed')
+        except FetchFailed, e:
+            self.assertEqual((e.shuffleId, e.mapId, e.reduceId), (1, 1, 0))
+        self.assertEqual(fetcher.fetched, [0])
+
+    def test_late_output(self):
+        tracker = env.mapOutputTracker = MockOutputTracker(['host1', None])
+        fetcher = MockFetcher()
+        fetch_parts = fetcher.fetch_parts
+        def late(*a):
+            tracker.uris[1] = 'host2'
+            return fetch_parts(*a)
+        fetcher.fetch_parts = late
+        fetcher.fetch(1, 0, None)
+        self.assertEqual(fetcher.fetched, [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()